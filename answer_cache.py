@@ -0,0 +1,219 @@
+import os
+import json
+import atexit
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from langchain.docstore.document import Document
+
+
+# Constants
+
+CACHE_PATH = os.environ.get("ANSWER_CACHE_PATH", "./answer_cache.json")
+SIMILARITY_THRESHOLD = float(os.environ.get("ANSWER_CACHE_THRESHOLD", "0.92"))  # cosine 相似度門檻
+MAX_ENTRIES = int(os.environ.get("ANSWER_CACHE_MAX_ENTRIES", "500"))
+TTL_SECONDS = int(os.environ.get("ANSWER_CACHE_TTL", str(7 * 24 * 3600)))
+SAVE_INTERVAL = float(os.environ.get("ANSWER_CACHE_SAVE_INTERVAL", "30"))  # 新答案最多隔幾秒寫回檔案
+
+
+def corpus_fingerprint(data_dir: str) -> str:
+    """sha256 of every .txt under data_dir, used to invalidate the cache when regulations change"""
+    h = hashlib.sha256()
+    if not os.path.isdir(data_dir):
+        return ""
+    for filename in sorted(os.listdir(data_dir)):
+        if filename.endswith(".txt"):
+            h.update(filename.encode("utf-8"))
+            with open(os.path.join(data_dir, filename), "rb") as f:
+                h.update(f.read())
+    return h.hexdigest()
+
+
+class SemanticAnswerCache:
+    """
+    Question -> (answer, context) cache matched by embedding similarity
+
+    entries are kept in LRU order, expire after ttl seconds and are persisted
+    to a json file so they survive restarts; new entries are written at most
+    every save_interval seconds and by flush() at exit, not on every store()
+    """
+
+    def __init__(self, embed_fn, data_dir: str, path: str = CACHE_PATH,
+                 threshold: float = SIMILARITY_THRESHOLD, max_entries: int = MAX_ENTRIES,
+                 ttl: int = TTL_SECONDS, save_interval: float = SAVE_INTERVAL):
+        self.embed_fn = embed_fn
+        self.data_dir = data_dir
+        self.path = path
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.save_interval = save_interval
+
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # question -> entry dict
+        self._fingerprint = ""
+        self._stat_signature = None
+        self._dirty = False
+        self._saved_at = time.monotonic()
+
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+        self._load()
+        self._check_corpus()
+        atexit.register(self.flush)
+
+    # persistence
+
+    def _load(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                raw = json.load(f)
+        except Exception as e:
+            import logging
+            logging.exception(f"[Answer Cache Load Error] {str(e)}")
+            return
+        self._fingerprint = raw.get("fingerprint", "")
+        for item in raw.get("entries", []):
+            item["embedding"] = np.asarray(item["embedding"], dtype=np.float32)
+            self._entries[item["question"]] = item
+
+    def _save(self):
+        if not self.path:
+            return
+        raw = {
+            "fingerprint": self._fingerprint,
+            "entries": [dict(item, embedding=item["embedding"].tolist()) for item in self._entries.values()],
+        }
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(raw, f, ensure_ascii=False)
+        os.replace(tmp_path, self.path)
+        self._dirty = False
+        self._saved_at = time.monotonic()
+
+    def _save_quietly(self):
+        try:
+            self._save()
+        except Exception as e:
+            import logging
+            logging.exception(f"[Answer Cache Save Error] {str(e)}")
+
+    # invalidation
+
+    def _check_corpus(self):
+        # 只在檔案 mtime / size 改變時才重新計算 hash
+        signature = None
+        if os.path.isdir(self.data_dir):
+            signature = tuple(sorted(
+                (entry.name, entry.stat().st_size, entry.stat().st_mtime_ns)
+                for entry in os.scandir(self.data_dir) if entry.name.endswith(".txt")
+            ))
+        if signature == self._stat_signature:
+            return
+        self._stat_signature = signature
+
+        fingerprint = corpus_fingerprint(self.data_dir)
+        if fingerprint != self._fingerprint:
+            if self._entries:
+                self.invalidations += 1
+            self._entries.clear()
+            self._fingerprint = fingerprint
+            self._save()
+
+    def _evict(self, now: float):
+        expired = [q for q, item in self._entries.items() if now - item["created"] > self.ttl]
+        for q in expired:
+            del self._entries[q]
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    # public api
+
+    def embed(self, question: str) -> np.ndarray:
+        vec = np.asarray(self.embed_fn(question), dtype=np.float32)
+        norm = np.linalg.norm(vec)
+        return vec / norm if norm else vec
+
+    def lookup(self, question: str, embedding: np.ndarray = None):
+        """
+        return (hit, embedding)
+        hit is {'answer': str, 'context': list[Document], 'score': float} or None
+        the embedding is returned so store() does not need to embed again
+        """
+        if embedding is None:
+            embedding = self.embed(question)
+        now = time.time()
+        with self._lock:
+            self._check_corpus()
+            self._evict(now)
+            if not self._entries:
+                self.misses += 1
+                return None, embedding
+
+            questions = list(self._entries.keys())
+            matrix = np.stack([self._entries[q]["embedding"] for q in questions])
+            scores = matrix @ embedding
+            best = int(np.argmax(scores))
+            if scores[best] < self.threshold:
+                self.misses += 1
+                return None, embedding
+
+            item = self._entries[questions[best]]
+            self._entries.move_to_end(questions[best])
+            self.hits += 1
+            context = [Document(page_content=c["page_content"], metadata=c["metadata"]) for c in item["context"]]
+            return {"answer": item["answer"], "context": context, "score": float(scores[best])}, embedding
+
+    def store(self, question: str, answer: str, context: list, embedding: np.ndarray = None):
+        if embedding is None:
+            embedding = self.embed(question)
+        with self._lock:
+            self._entries[question] = {
+                "question": question,
+                "embedding": embedding,
+                "answer": answer,
+                "context": [{"page_content": doc.page_content, "metadata": dict(doc.metadata)} for doc in context],
+                "created": time.time(),
+            }
+            self._entries.move_to_end(question)
+            self._evict(time.time())
+            # 每次 miss 都整份重寫 json 太貴，累積一段時間再寫
+            self._dirty = True
+            if time.monotonic() - self._saved_at >= self.save_interval:
+                self._save_quietly()
+
+    def flush(self):
+        """write entries stored since the last save"""
+        with self._lock:
+            if self._dirty:
+                self._save_quietly()
+
+    def set_data_dir(self, data_dir: str):
+        """fingerprint another corpus directory (e.g. a newly swapped index version), clearing entries if it differs"""
+        with self._lock:
+            self.data_dir = data_dir
+            self._check_corpus()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._save()
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 4) if total else 0.0,
+            "size": len(self._entries),
+            "invalidations": self.invalidations,
+            "threshold": self.threshold,
+        }
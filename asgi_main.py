@@ -0,0 +1,427 @@
+# asyncio serving mode: uvicorn asgi_main:app
+# the Flask app in main.py stays available, both share Firebase setup and answer helpers
+import os
+import time
+import json
+import asyncio
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+
+from linebot.v3 import WebhookParser
+from linebot.v3.exceptions import InvalidSignatureError
+from linebot.v3.messaging import AsyncApiClient, AsyncMessagingApi, ReplyMessageRequest, TextMessage, PushMessageRequest
+from linebot.v3.webhooks import MessageEvent, TextMessageContent, FollowEvent
+from openai import APIStatusError, APIConnectionError, APITimeoutError
+
+# Key
+from config import CHANNEL_SECRET
+
+# pooled clients / settings shared with the Flask app
+from clients import line_configuration, use_line_host, get_async_openai_client, aclose as close_clients, stats as client_stats
+
+# generate the quiz
+from generate import agenerate_quiz_question
+
+# RAG
+from rag_module import aget_response, get_cache_stats, get_embedding_cache_stats, get_all_rules, get_index_status
+from faq_router import ROUTER_ENABLED as FAQ_ROUTER_ENABLED, get_faq_router, get_faq_router_stats
+from conversation import aprepare_turn
+
+# spans / Prometheus metrics
+from instrumentation import trace, span, record_tokens, process_memory, render as render_metrics
+
+# shared with the Flask app (Firebase init happens on import)
+from main import (
+    MAX_HISTORY, BUSY_TEXT, ERROR_TEXT, QUIZ_ERROR_TEXT, FALLBACK_MODEL, WELCOME_TEXT,
+    get_memory, append_memory, get_asked_questions, pick_bank_quiz, save_current_quiz,
+    special_case_messages, route_faq, needs_fallback, fallback_messages, compose_answer, degraded_answer,
+    answer_flex_message, quiz_message, sessions, warmer, WARMING_TEXT, deduplicator, flight,
+)
+from singleflight import flight_key
+from deadline import Deadline, FALLBACK_MIN, FALLBACK_TIMEOUT
+
+
+# constant
+MAX_INFLIGHT = int(os.environ.get("ASYNC_MAX_INFLIGHT", "2000"))  # 同時處理中的對話上限，超過就回覆忙碌
+FIREBASE_WORKERS = int(os.environ.get("ASYNC_FIREBASE_WORKERS", "32"))
+
+# lineBot Setup
+configuration = line_configuration()
+parser = WebhookParser(CHANNEL_SECRET)
+
+# Firebase Admin SDK 是同步的（session cache 沒命中時才會連線），固定丟到這個 executor 執行
+firebase_executor = ThreadPoolExecutor(max_workers=FIREBASE_WORKERS, thread_name_prefix="firebase")
+
+_line_client = None
+_line_bot_api = None
+_tasks = set()
+_user_locks = {}  # user_id -> [asyncio.Lock, 使用中的數量]
+_inflight = 0
+_handled = 0
+
+
+def get_line_bot_api() -> AsyncMessagingApi:
+    # aiohttp session 必須在 event loop 裡建立，所以延後到第一次使用
+    global _line_client, _line_bot_api
+    if _line_bot_api is None:
+        _line_client = AsyncApiClient(configuration)
+        _line_bot_api = use_line_host(AsyncMessagingApi(_line_client))
+    return _line_bot_api
+
+async def run_firebase(fn, *args):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(firebase_executor, fn, *args)
+
+
+class user_lock:
+    """per-user asyncio lock so one user's messages are handled in order"""
+
+    def __init__(self, user_id):
+        self.user_id = user_id
+
+    async def __aenter__(self):
+        entry = _user_locks.setdefault(self.user_id, [asyncio.Lock(), 0])
+        entry[1] += 1
+        await entry[0].acquire()
+
+    async def __aexit__(self, *exc):
+        entry = _user_locks[self.user_id]
+        entry[0].release()
+        entry[1] -= 1
+        if entry[1] == 0:
+            del _user_locks[self.user_id]
+
+
+async def reply(reply_token, messages):
+    await get_line_bot_api().reply_message(
+        ReplyMessageRequest(
+            reply_token=reply_token,
+            messages=messages
+        )
+    )
+
+async def push(user_id, messages):
+    await get_line_bot_api().push_message(
+        PushMessageRequest(
+            to=user_id,
+            messages=messages
+        )
+    )
+
+async def ask_fallback(history_context, user_input, retrieval_query=None, timeout=None):
+    client = get_async_openai_client()
+    if timeout:
+        client = client.with_options(timeout=timeout, max_retries=0)
+    try:
+        # 挑選條文需要 embedding，丟到 executor 執行（帶著 context，span 才會記在這個請求的 trace 上）
+        messages = await asyncio.get_running_loop().run_in_executor(
+            None, contextvars.copy_context().run, fallback_messages, history_context, user_input, retrieval_query
+        )
+        completion = await client.chat.completions.create(
+            model=FALLBACK_MODEL,
+            messages=messages
+        )
+    except APIStatusError as e:
+        return f"伺服器錯誤：{e.status_code}"
+    record_tokens(FALLBACK_MODEL, completion.usage)
+    return completion.choices[0].message.content.strip()
+
+async def fallback_within(deadline, key, history_context, user_input, retrieval_query=None):
+    """async version of main.fallback_within"""
+    if not deadline.allows(FALLBACK_MIN):
+        deadline.degrade("skip_fallback")
+        return None
+    timeout = deadline.timeout(FALLBACK_TIMEOUT)
+    try:
+        with span("fallback"):
+            if key:
+                fallback_answer, _ = await flight.ado(("fallback", key), ask_fallback, "", user_input,
+                                                      retrieval_query, timeout=timeout)
+                return fallback_answer
+            return await ask_fallback(history_context, user_input, retrieval_query, timeout=timeout)
+    except APITimeoutError:
+        deadline.degrade("fallback_timeout")
+        return None
+    except APIConnectionError as e:
+        import logging
+        logging.exception(f"[Fallback Error] {str(e)}")
+        deadline.degrade("fallback_error")
+        return None
+
+
+async def handle_event(event):
+    global _inflight, _handled
+    _inflight += 1
+    try:
+        if isinstance(event, FollowEvent):
+            await reply(event.reply_token, [TextMessage(text=WELCOME_TEXT)])
+        elif isinstance(event, MessageEvent) and isinstance(event.message, TextMessageContent):
+            await handle_message(event)
+    except Exception as e:
+        import logging
+        logging.exception(f"[Async Event Error] {str(e)}")
+    finally:
+        _inflight -= 1
+        _handled += 1
+
+async def handle_message(event):
+    user_input = event.message.text.strip()
+    user_id = getattr(event.source, 'user_id', None)
+    if _inflight > MAX_INFLIGHT:
+        await reply(event.reply_token, [TextMessage(text=BUSY_TEXT)])
+        return
+
+    if user_input == "測驗":
+        await reply(event.reply_token, [TextMessage(text="✏️ 生成試題中，請稍候...")])
+        async with user_lock(user_id):
+            await generate_quiz_and_push(user_id)
+        return
+
+    # 等同一位使用者前一題的時間也算在預算內
+    deadline = Deadline()
+    async with user_lock(user_id):
+        await process_gpt_and_push(event, deadline)
+
+async def process_gpt_and_push(event, deadline=None):
+    with trace("process_gpt_and_push", mode="async") as attrs:
+        await _process_gpt_and_push(event, attrs, deadline or Deadline())
+
+async def _process_gpt_and_push(event, attrs, deadline):
+    answer = ERROR_TEXT
+    user_input = event.message.text.strip()
+    user_id = getattr(event.source, 'user_id', None)
+    if not user_id:
+        import logging
+        logging.warning("⚠️ 無法取得 user_id，跳過處理")
+        return
+
+    messages = await run_firebase(special_case_messages, user_id, user_input)
+    if messages is not None:
+        attrs["route"] = "special"
+        with span("line.reply"):
+            await reply(event.reply_token, messages)
+        return
+
+    if not warmer.ready():
+        attrs["route"] = "warming_up"
+        warmer.start()
+        with span("line.reply"):
+            await reply(event.reply_token, [TextMessage(text=WARMING_TEXT)])
+        return
+
+    # embedding 是 CPU 工作；to_thread 會帶著 contextvars，faq_router span 仍記在這個 trace 裡
+    faq = await asyncio.to_thread(route_faq, user_input)
+    if faq and faq["action"] == "answer":
+        attrs["route"] = "faq"
+        attrs["faq"] = faq["question"]
+        with span("line.reply"):
+            await reply(event.reply_token, [TextMessage(text=faq["answer"])])
+        await run_firebase(append_memory, user_id, user_input, faq["answer"])
+        return
+    if not (faq and faq["action"] == "suggest"):
+        faq = None
+    suggestion = faq and faq["question"]
+
+    attrs["route"] = "rag"
+    try:
+        with span("line.reply"):
+            await reply(event.reply_token, [TextMessage(text="思考中，請稍候...")])
+    except Exception as e:
+        import logging
+        logging.exception(f"[Push Pre-message Error] {str(e)}")
+
+    try:
+        with span("firebase.read_memory"):
+            history = await run_firebase(get_memory, user_id, MAX_HISTORY)
+        turn = await aprepare_turn(history, user_input, deadline=deadline)
+        attrs["condensed"] = turn.condensed
+
+        cache_key = turn.cache_key
+        key = flight_key(cache_key) if cache_key else None
+        rag_start = time.perf_counter()
+        with span("rag"):
+            if key:
+                res, attrs["coalesced"] = await flight.ado(("rag", key), aget_response, user_input,
+                                                           retrieval_query=turn.retrieval_query, cache_key=cache_key,
+                                                           deadline=deadline)
+            else:
+                res = await aget_response(user_input, history=turn.history_text,
+                                          retrieval_query=turn.retrieval_query, deadline=deadline)
+
+        fallback_answer = None
+        # 流程判斷用區域變數，attrs 只給 trace 記錄
+        fallback = attrs["fallback"] = needs_fallback(res)
+        if fallback:
+            fallback_answer = await fallback_within(deadline, key, turn.history_text, user_input, turn.retrieval_query)
+
+        if (res.get("degraded") and not res["answer"]) or (fallback and fallback_answer is None):
+            answer = degraded_answer(res, faq)
+        else:
+            answer = compose_answer(res, fallback_answer)
+        attrs["degraded"] = ",".join(deadline.degraded) or res.get("degraded")  # 合併的提問沿用領頭者的結果
+        if FAQ_ROUTER_ENABLED:
+            get_faq_router().record_rag_seconds(time.perf_counter() - rag_start)
+        with span("firebase.write_memory"):
+            await run_firebase(append_memory, user_id, user_input, answer)
+    except Exception as e:
+        import logging
+        logging.exception(f"[RAG GPT Error] {str(e)}")
+
+    try:
+        with span("line.push"):
+            await push(user_id, [answer_flex_message(answer, suggestion)])
+    except Exception as e:
+        import logging
+        logging.exception(f"[GPT or Flex render Error] {str(e)}")
+
+async def generate_quiz_and_push(user_id):
+    with trace("generate_quiz_and_push", mode="async") as attrs:
+        with span("firebase.read_quiz_history"):
+            asked_questions = await run_firebase(get_asked_questions, user_id)
+
+        with span("quiz.bank"):
+            quiz = pick_bank_quiz(asked_questions)
+        attrs["source"] = "bank" if quiz else "llm"
+        if quiz:
+            q, opt, ans = quiz
+        else:
+            with span("quiz.generate"):
+                q, opt, ans = await agenerate_quiz_question(get_async_openai_client(), get_all_rules(), asked_questions)
+        if not q:
+            with span("line.push"):
+                await push(user_id, [TextMessage(text=QUIZ_ERROR_TEXT)])
+            return
+
+        with span("firebase.write_quiz"):
+            await run_firebase(save_current_quiz, user_id, q, ans)
+        with span("line.push"):
+            await push(user_id, [quiz_message(q, opt)])
+
+
+def spawn(coro):
+    # 保留 task 的參考，避免還沒跑完就被 GC
+    task = asyncio.get_running_loop().create_task(coro)
+    _tasks.add(task)
+    task.add_done_callback(_tasks.discard)
+
+
+# ASGI
+
+async def read_body(receive) -> bytes:
+    body = b""
+    while True:
+        message = await receive()
+        body += message.get("body", b"")
+        if not message.get("more_body"):
+            return body
+
+async def respond(send, status, body, content_type="text/plain; charset=utf-8"):
+    if isinstance(body, str):
+        body = body.encode("utf-8")
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [(b"content-type", content_type.encode()), (b"content-length", str(len(body)).encode())],
+    })
+    await send({"type": "http.response.body", "body": body})
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            # 暖機在背景 thread 進行，不擋住啟動
+            warmer.start()
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            if _tasks:
+                await asyncio.wait(list(_tasks), timeout=30)
+            if _line_client is not None:
+                await _line_client.close()
+            await close_clients()
+            await run_firebase(sessions.flush)
+            firebase_executor.shutdown(wait=False)
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+async def callback(scope, receive, send):
+    headers = dict(scope["headers"])
+    signature = headers.get(b"x-line-signature", b"").decode()
+    body = (await read_body(receive)).decode("utf-8")
+
+    try:
+        events = parser.parse(body, signature)
+    except InvalidSignatureError:
+        await respond(send, 400, "Bad Request")
+        return
+    except Exception as e:
+        import logging
+        logging.exception(f"[Webhook Crash] {str(e)}")
+        await respond(send, 500, "Internal Server Error")
+        return
+
+    # 逾時重送的事件直接丟掉（Firebase backend 會連線，丟到 executor 同時確認）
+    fresh = await asyncio.gather(*(run_firebase(deduplicator.claim_event, event) for event in events))
+
+    # 先回 200 給 LINE，事件在背景同時處理
+    for event, is_fresh in zip(events, fresh):
+        if is_fresh:
+            spawn(handle_event(event))
+    await respond(send, 200, "OK")
+
+async def stats(scope, receive, send):
+    body = {
+        "answer_cache": get_cache_stats(),
+        "embedding_cache": get_embedding_cache_stats(),
+        "faq_router": get_faq_router_stats(),
+        "webhook_dedup": deduplicator.stats(),
+        "singleflight": flight.stats(),
+        "index": get_index_status(),
+        "sessions": sessions.stats(),
+        "http": client_stats(),
+        "warmup": warmer.status(),
+        "process": process_memory(),
+        "async": {
+            "inflight": _inflight,
+            "handled": _handled,
+            "max_inflight": MAX_INFLIGHT,
+            "active_users": len(_user_locks),
+        },
+    }
+    await respond(send, 200, json.dumps(body), "application/json")
+
+async def metrics(scope, receive, send):
+    await respond(send, 200, render_metrics(), "text/plain; version=0.0.4; charset=utf-8")
+
+async def healthz(scope, receive, send):
+    body = {"status": "ok", "uptime_s": warmer.status()["uptime_s"]}
+    await respond(send, 200, json.dumps(body), "application/json")
+
+async def ready(scope, receive, send):
+    await respond(send, 200 if warmer.ready() else 503, json.dumps(warmer.status()), "application/json")
+
+async def app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        await lifespan(receive, send)
+        return
+    if scope["type"] != "http":
+        return
+
+    route = (scope["method"], scope["path"])
+    if route == ("POST", "/callback"):
+        await callback(scope, receive, send)
+    elif route == ("GET", "/stats"):
+        await stats(scope, receive, send)
+    elif route == ("GET", "/metrics"):
+        await metrics(scope, receive, send)
+    elif route == ("GET", "/healthz"):
+        await healthz(scope, receive, send)
+    elif route == ("GET", "/ready"):
+        await ready(scope, receive, send)
+    else:
+        await respond(send, 404, "Not Found")
+
+
+if __name__ == "__main__":
+    import uvicorn
+    port = int(os.environ.get("PORT", 8080))
+    uvicorn.run(app, host="0.0.0.0", port=port)
@@ -0,0 +1,473 @@
+# offline end-to-end benchmark: process_gpt_and_push / generate_quiz_and_push / get_response
+# OpenAI, LINE and Firebase are replaced by in-process stand-ins with fixed (seeded) latency, nothing leaves the machine
+# usage: python bench_pipeline.py [--questions 50] [--quizzes 10] [--openai-ms 800] [--output bench_pipeline.json]
+#        python bench_pipeline.py --mode recall [--k 3]
+#        python bench_pipeline.py --compare old.json new.json
+# the embedding model (and the tiktoken encoding used by the fallback) must already be in the local cache,
+# or pass --embeddings hash to use a deterministic character-bigram stand-in
+import os
+import sys
+import json
+import time
+import shutil
+import random
+import hashlib
+import tempfile
+import argparse
+import threading
+import subprocess
+from collections import defaultdict
+from unittest import mock
+
+import numpy as np
+
+from langchain_core.embeddings import Embeddings
+
+from regulations import REGULATION_FILES
+
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+QUESTIONS = [
+    "董事任期幾年？",
+    "董事長由誰選出？",
+    "監察人有哪些職權？",
+    "基金會的會計年度怎麼算？",
+    "董事會多久開一次會？",
+    "檢舉信箱是什麼？",
+    "利益衝突時應該怎麼做？",
+    "基金會要主動公開哪些資訊？",
+    "基金會的設立基金是多少？",
+    "執行長怎麼聘任？",
+    "檢舉資料要保存幾年？",
+    "可以收受廠商的禮物嗎？",
+]
+
+# (question, source, article) pairs for --mode recall
+RECALL_PAIRS = [
+    ("基金會的名稱是什麼？", "Donation-charter.txt", "第一條"),
+    ("基金會解散後剩下的財產歸誰？", "Donation-charter.txt", "第三條"),
+    ("基金會的主事務所在哪裡？", "Donation-charter.txt", "第四條"),
+    ("設立基金有多少錢？", "Donation-charter.txt", "第五條"),
+    ("基金會成立的目的是什麼？", "Donation-charter.txt", "第六條"),
+    ("董事會有幾位董事？", "Donation-charter.txt", "第八條"),
+    ("董事長怎麼產生？", "Donation-charter.txt", "第九條"),
+    ("董事任期幾年？可以連任嗎？", "Donation-charter.txt", "第十條"),
+    ("董事會有哪些職權？", "Donation-charter.txt", "第十一條"),
+    ("董事有沒有薪水？", "Donation-charter.txt", "第十二條"),
+    ("執行長由誰提名？", "Donation-charter.txt", "第十三條"),
+    ("監察人任期多久？", "Donation-charter.txt", "第十三條之一"),
+    ("監察人的職權有哪些？", "Donation-charter.txt", "第十三條之三"),
+    ("董事會多久至少開會一次？", "Donation-charter.txt", "第十五條"),
+    ("董事會開會需要多少董事出席？", "Donation-charter.txt", "第十六條"),
+    ("基金會的會計年度從何時開始？", "Donation-charter.txt", "第二十二條"),
+    ("捐助章程怎麼修改？", "Donation-charter.txt", "第二十五條"),
+    ("基金會要遵守哪些法律？", "Integrity-norm.txt", "三"),
+    ("誰要向員工說明誠信經營政策？", "Integrity-norm.txt", "四"),
+    ("可以收受不正當利益嗎？", "Integrity-norm.txt", "六"),
+    ("遇到利益衝突要怎麼做？", "Integrity-norm.txt", "七"),
+    ("基金會要主動公開哪些資訊？", "Integrity-norm.txt", "九"),
+    ("發現違反誠信可以向哪裡檢舉？", "Integrity-norm.txt", "十"),
+    ("檢舉人的身分會保密嗎？", "Integrity-norm.txt", "十二"),
+    ("檢舉的調查文件要保存多久？", "Integrity-norm.txt", "十三"),
+]
+
+
+# stand-ins
+
+class Latency:
+    """fixed latency per service with seeded +-jitter, so two runs inject the same delays"""
+
+    def __init__(self, seed, jitter, **base_ms):
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self.jitter = jitter
+        self.base_ms = base_ms
+
+    def sleep(self, service):
+        with self._lock:
+            factor = 1 + self._rng.uniform(-self.jitter, self.jitter)
+        time.sleep(self.base_ms[service] * factor / 1000)
+
+
+class Phases:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.samples = defaultdict(list)
+
+    def add(self, name, seconds):
+        with self._lock:
+            self.samples[name].append(seconds)
+
+    def timed(self, name, fn):
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self.add(name, time.perf_counter() - start)
+        return wrapper
+
+    def summary(self) -> dict:
+        result = {}
+        with self._lock:
+            for name, values in sorted(self.samples.items()):
+                ms = np.asarray(values) * 1000
+                result[name] = {
+                    "count": len(values),
+                    "mean_ms": round(float(ms.mean()), 2),
+                    "p50_ms": round(float(np.percentile(ms, 50)), 2),
+                    "p95_ms": round(float(np.percentile(ms, 95)), 2),
+                    "p99_ms": round(float(np.percentile(ms, 99)), 2),
+                }
+        return result
+
+
+class FakeOpenAI:
+    """httpx handler answering /chat/completions like the real API"""
+
+    def __init__(self, latency, fallback_rate):
+        self.latency = latency
+        self.fallback_rate = fallback_rate
+        self.requests = 0
+
+    def reply_text(self, body):
+        messages = body.get("messages", [])
+        system = next((m["content"] for m in messages if m["role"] == "system"), "")
+        user = messages[-1]["content"] if messages else ""
+        if body.get("response_format", {}).get("type") == "json_object":
+            return json.dumps({"questions": []})  # 題庫補題：不產生題目，測驗一律走即時出題
+        if "請輸出格式如下" in user:
+            return "題目：董事任期幾年？\n選項：\nA. 一年\nB. 三年\nC. 五年\n答案：B"
+        if "規章QA機器人" in system:
+            # 依問題內容決定要不要回 unsure，同樣的問題每次結果相同
+            bucket = int(hashlib.sha1(user.encode("utf-8")).hexdigest(), 16) % 100
+            if bucket < self.fallback_rate * 100:
+                return "unsure"
+            return "依捐助章程第十條，董事任期為三年，連選得連任。"
+        return "根據誠信經營規範第七點，有利益衝突時應自行迴避。"
+
+    def __call__(self, request):
+        import httpx
+        self.requests += 1
+        self.latency.sleep("openai")
+        body = json.loads(request.content or b"{}")
+        return httpx.Response(200, json={
+            "id": f"chatcmpl-{self.requests}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get("model", ""),
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": self.reply_text(body)}, "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0},
+        })
+
+
+class FakeLineApi:
+    def __init__(self, latency, phases):
+        self.latency = latency
+        self.phases = phases
+        self.sent = 0
+
+    def _send(self, phase):
+        start = time.perf_counter()
+        self.latency.sleep("line")
+        self.sent += 1
+        self.phases.add(phase, time.perf_counter() - start)
+
+    def reply_message_with_http_info(self, request):
+        self._send("line_reply")
+
+    def push_message_with_http_info(self, request):
+        self._send("push")
+
+
+class FakeReference:
+    """the subset of firebase_admin.db.Reference used by chat_memory / session_store"""
+
+    def __init__(self, store, path, query=None):
+        self.store = store
+        self.parts = [p for p in path.split("/") if p]
+        self.query = query or {}
+
+    def _node(self, create=False):
+        node = self.store.root
+        for part in self.parts:
+            if not isinstance(node, dict) or part not in node:
+                if not create:
+                    return None
+                node[part] = {}
+            node = node[part]
+        return node
+
+    def _parent(self):
+        node = self.store.root
+        for part in self.parts[:-1]:
+            node = node.setdefault(part, {})
+        return node
+
+    def order_by_key(self):
+        return FakeReference(self.store, "/".join(self.parts), dict(self.query, order_by_key=True))
+
+    def limit_to_last(self, n):
+        return FakeReference(self.store, "/".join(self.parts), dict(self.query, limit_to_last=n))
+
+    def get(self, shallow=False):
+        self.store.latency.sleep("firebase")
+        with self.store.lock:
+            node = self._node()
+            if isinstance(node, dict):
+                if shallow:
+                    return {k: True for k in node}
+                items = sorted(node.items())
+                if self.query.get("limit_to_last"):
+                    items = items[-self.query["limit_to_last"]:]
+                return json.loads(json.dumps(dict(items))) or None
+            return node
+
+    def set(self, value):
+        self.store.latency.sleep("firebase")
+        with self.store.lock:
+            if self.parts:
+                self._parent()[self.parts[-1]] = value
+
+    def delete(self):
+        self.store.latency.sleep("firebase")
+        with self.store.lock:
+            if self.parts:
+                self._parent().pop(self.parts[-1], None)
+
+    def push(self, value):
+        key = f"-{time.time_ns():020d}"
+        FakeReference(self.store, "/".join(self.parts + [key])).set(value)
+
+    def update(self, values):
+        self.store.latency.sleep("firebase")
+        with self.store.lock:
+            for path, value in values.items():
+                ref = FakeReference(self.store, "/".join(self.parts + [path]))
+                if value is None:
+                    ref._parent().pop(ref.parts[-1], None)
+                else:
+                    ref._parent()[ref.parts[-1]] = value
+
+
+class FakeFirebase:
+    def __init__(self, latency):
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.root = {}
+
+    def reference(self, path="/"):
+        return FakeReference(self, path)
+
+
+class HashEmbeddings(Embeddings):
+    """deterministic character-bigram hashing, for machines without the embedding model cached"""
+
+    dim = 384
+
+    def embed_query(self, text):
+        vec = np.zeros(self.dim, dtype=np.float32)
+        text = "".join(text.split())
+        for i in range(len(text) - 1):
+            vec[int(hashlib.md5(text[i:i + 2].encode("utf-8")).hexdigest(), 16) % self.dim] += 1
+        norm = np.linalg.norm(vec)
+        return (vec / norm if norm else vec).tolist()
+
+    def embed_documents(self, texts):
+        return [self.embed_query(t) for t in texts]
+
+
+# setup
+
+def prepare_workdir(workdir):
+    # 在獨立目錄裡跑：索引、快取、題庫都從零開始，也不會動到正式的檔案
+    os.makedirs(os.path.join(workdir, "data"), exist_ok=True)
+    for filename in REGULATION_FILES:
+        shutil.copy(os.path.join(REPO_DIR, filename), os.path.join(workdir, filename))
+        shutil.copy(os.path.join(REPO_DIR, filename), os.path.join(workdir, "data", filename))
+    os.chdir(workdir)
+
+def install_stand_ins(args):
+    import httpx
+    import firebase_admin
+    from firebase_admin import credentials
+
+    latency = Latency(args.seed, args.jitter, openai=args.openai_ms, line=args.line_ms, firebase=args.firebase_ms)
+    firebase = FakeFirebase(latency)
+    openai_handler = FakeOpenAI(latency, args.fallback_rate)
+
+    mock.patch.object(credentials, "Certificate").start()
+    mock.patch.object(firebase_admin, "initialize_app").start()
+    mock.patch("firebase_admin.db.reference", firebase.reference).start()
+
+    import clients
+    clients._pid = os.getpid()
+    clients._httpx_client = httpx.Client(transport=httpx.MockTransport(openai_handler))
+
+    import rag_module
+    if args.embeddings == "hash":
+        mock.patch.object(rag_module, "load_embeddings", lambda *a, **kw: HashEmbeddings()).start()
+    # 不連 HuggingFace 登入，其餘暖機步驟照常
+    steps = rag_module.warm_up_steps
+    mock.patch.object(rag_module, "warm_up_steps", lambda: [s for s in steps() if s[0] != "huggingface login"]).start()
+    return latency, firebase, openai_handler
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "-C", REPO_DIR, "rev-parse", "--short", "HEAD"], text=True).strip()
+    except Exception:
+        return ""
+
+
+# modes
+
+class Event:
+    """the attributes of a LINE MessageEvent that process_gpt_and_push reads"""
+
+    def __init__(self, user_id, text, n):
+        self.reply_token = f"token-{n}"
+        self.source = type("Source", (), {"user_id": user_id})()
+        self.message = type("Message", (), {"text": text})()
+
+def run_pipeline(args, phases, latency):
+    import main
+    import rag_module
+
+    start = time.perf_counter()
+    main.warmer.wait()
+    warmup_s = time.perf_counter() - start
+
+    line_api = FakeLineApi(latency, phases)
+    index = rag_module.get_index()
+    patches = [
+        mock.patch.object(main, "get_line_bot_api", lambda: line_api),
+        mock.patch.object(main, "get_memory", phases.timed("memory_fetch", main.get_memory)),
+        mock.patch.object(main, "append_memory", phases.timed("persistence", main.append_memory)),
+        mock.patch.object(main, "route_faq", phases.timed("faq_router", main.route_faq)),
+        mock.patch.object(main, "ask_fallback", phases.timed("fallback", main.ask_fallback)),
+        mock.patch.object(main, "get_response", phases.timed("get_response", main.get_response)),
+        mock.patch.object(main, "get_asked_questions", phases.timed("quiz_history", main.get_asked_questions)),
+        mock.patch.object(main, "pick_bank_quiz", phases.timed("quiz_bank", main.pick_bank_quiz)),
+        mock.patch.object(main, "generate_quiz_question", phases.timed("quiz_llm", main.generate_quiz_question)),
+        mock.patch.object(main, "save_current_quiz", phases.timed("quiz_save", main.save_current_quiz)),
+        mock.patch.object(main.sessions, "flush", phases.timed("firebase_flush", main.sessions.flush)),
+        mock.patch.object(type(index.retriever), "invoke", phases.timed("retrieval", type(index.retriever).invoke)),
+        mock.patch.object(type(rag_module._llm), "invoke", phases.timed("llm", type(rag_module._llm).invoke)),
+    ]
+    for patch in patches:
+        patch.start()
+
+    process = phases.timed("process_gpt_and_push", main.process_gpt_and_push)
+    quiz = phases.timed("generate_quiz_and_push", main.generate_quiz_and_push)
+    for n in range(args.questions):
+        user_id = f"bench-user-{n % args.users}"
+        process(Event(user_id, QUESTIONS[n % len(QUESTIONS)], n))
+    for n in range(args.quizzes):
+        quiz(f"bench-user-{n % args.users}")
+    main.sessions.flush()
+
+    for patch in reversed(patches):
+        patch.stop()
+
+    # get_response 單獨量測（不經過 LINE / Firebase）
+    direct = phases.timed("get_response_direct", rag_module.get_response)
+    for n in range(args.questions):
+        direct(QUESTIONS[n % len(QUESTIONS)])
+    return {"warmup_s": round(warmup_s, 3), "faq_router": main.get_faq_router_stats()}
+
+def run_recall(args):
+    import rag_module
+
+    index = rag_module.get_index()
+    results = {"dense": [], "retriever": []}
+    for question, source, article in RECALL_PAIRS:
+        rankings = {
+            "dense": index.vector_store.similarity_search(question, k=args.k),
+            "retriever": index.retriever.invoke(question),
+        }
+        for name, docs in rankings.items():
+            rank = next(
+                (i + 1 for i, doc in enumerate(docs)
+                 if doc.metadata.get("source") == source and doc.metadata.get("article") == article),
+                None
+            )
+            results[name].append({"question": question, "article": f"{source} {article}", "rank": rank})
+
+    summary = {}
+    for name, rows in results.items():
+        summary[name] = {
+            "k": args.k if name == "dense" else f"{rag_module.RETRIEVER_MODE} (configured)",
+            "recall": round(sum(1 for r in rows if r["rank"]) / len(rows), 3),
+            "mrr": round(sum(1 / r["rank"] for r in rows if r["rank"]) / len(rows), 3),
+            "misses": [r["question"] for r in rows if not r["rank"]],
+        }
+    return summary
+
+def compare(old_path, new_path):
+    with open(old_path, encoding="utf-8") as f:
+        old = json.load(f)
+    with open(new_path, encoding="utf-8") as f:
+        new = json.load(f)
+    print(f"{old.get('commit', old_path)} -> {new.get('commit', new_path)}")
+    print(f"{'phase':>24}  {'p50 old':>9}  {'p50 new':>9}  {'p95 old':>9}  {'p95 new':>9}")
+    for name in sorted(set(old.get("phases", {})) | set(new.get("phases", {}))):
+        a, b = old["phases"].get(name, {}), new["phases"].get(name, {})
+        cells = [a.get("p50_ms"), b.get("p50_ms"), a.get("p95_ms"), b.get("p95_ms")]
+        print(f"{name:>24}  " + "  ".join(f"{c:>9.1f}" if c is not None else f"{'-':>9}" for c in cells))
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="offline latency / recall benchmark of the bot pipeline")
+    arg_parser.add_argument("--mode", choices=["pipeline", "recall"], default="pipeline")
+    arg_parser.add_argument("--questions", type=int, default=50)
+    arg_parser.add_argument("--quizzes", type=int, default=10)
+    arg_parser.add_argument("--users", type=int, default=5)
+    arg_parser.add_argument("--openai-ms", type=float, default=800)
+    arg_parser.add_argument("--line-ms", type=float, default=60)
+    arg_parser.add_argument("--firebase-ms", type=float, default=40)
+    arg_parser.add_argument("--jitter", type=float, default=0.2, help="+- fraction added to every injected latency")
+    arg_parser.add_argument("--fallback-rate", type=float, default=0.2, help="share of questions the RAG stand-in answers unsure")
+    arg_parser.add_argument("--seed", type=int, default=0)
+    arg_parser.add_argument("--k", type=int, default=3)
+    arg_parser.add_argument("--embeddings", choices=["model", "hash"], default="model")
+    arg_parser.add_argument("--workdir", help="reuse this directory (index / caches) instead of a fresh temp dir")
+    arg_parser.add_argument("--output", default="bench_pipeline.json")
+    arg_parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"))
+    args = arg_parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        sys.exit(0)
+
+    output = os.path.abspath(args.output)
+    workdir = args.workdir or tempfile.mkdtemp(prefix="bench_pipeline_")
+    prepare_workdir(workdir)
+    phases = Phases()
+    latency, firebase, openai_handler = install_stand_ins(args)
+
+    result = {
+        "commit": git_commit(),
+        "mode": args.mode,
+        "params": {k: v for k, v in vars(args).items() if k not in ("compare", "output", "workdir")},
+    }
+    if args.mode == "recall":
+        result["recall"] = run_recall(args)
+        print(json.dumps(result["recall"], ensure_ascii=False, indent=1))
+    else:
+        result.update(run_pipeline(args, phases, latency))
+        result["phases"] = phases.summary()
+        result["openai_requests"] = openai_handler.requests
+        print(f"warm-up {result['warmup_s']:.2f}s, {openai_handler.requests} OpenAI calls")
+        print(f"faq router: {result['faq_router']}\n")
+        print(f"{'phase':>24}  {'count':>5}  {'p50_ms':>8}  {'p95_ms':>8}  {'p99_ms':>8}")
+        for name, row in result["phases"].items():
+            print(f"{name:>24}  {row['count']:>5}  {row['p50_ms']:>8.1f}  {row['p95_ms']:>8.1f}  {row['p99_ms']:>8.1f}")
+
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(result, f, ensure_ascii=False, indent=1)
+    print(f"\nsaved {output}")
+    if not args.workdir:
+        if "rag_module" in sys.modules:
+            sys.modules["rag_module"].flush_answer_cache()  # 答案快取寫在 workdir 裡，刪掉前先寫完
+        shutil.rmtree(workdir, ignore_errors=True)
@@ -0,0 +1,102 @@
+# Chroma vs NumpyVectorStore: load time and query latency on the regulation corpus
+# usage: python bench_vectorstore.py [--queries 200]
+import time
+import shutil
+import argparse
+import tempfile
+
+import numpy as np
+
+from langchain_community.vectorstores import Chroma
+
+from numpy_store import NumpyVectorStore
+from index_manifest import sync_index
+from rag_module import generate_document, get_embeddings
+
+
+QUESTIONS = [
+    "我可以請幾天病假？",
+    "董事任期幾年？",
+    "檢舉信箱是什麼？",
+    "監察人有哪些職權？",
+    "基金會的會計年度怎麼算？",
+    "捐助章程變更需要多少董事同意？",
+    "利益衝突時應該怎麼做？",
+    "基金會要主動公開哪些資訊？",
+]
+
+
+class FixedQueryEmbeddings:
+    """reuse precomputed query vectors so only the store itself is timed"""
+
+    def __init__(self, embeddings, questions):
+        self.embeddings = embeddings
+        self.vectors = dict(zip(questions, embeddings.embed_documents(questions)))
+
+    def embed_documents(self, texts):
+        return self.embeddings.embed_documents(texts)
+
+    def embed_query(self, text):
+        return self.vectors.get(text) or self.embeddings.embed_query(text)
+
+
+def percentile(values, q):
+    return float(np.percentile(values, q)) * 1000 if values else 0.0
+
+def time_queries(store, n):
+    sim, mmr = [], []
+    for i in range(n):
+        question = QUESTIONS[i % len(QUESTIONS)]
+        start = time.perf_counter()
+        store.similarity_search(question, k=3)
+        sim.append(time.perf_counter() - start)
+        start = time.perf_counter()
+        store.max_marginal_relevance_search(question, k=3, fetch_k=5)
+        mmr.append(time.perf_counter() - start)
+    return sim, mmr
+
+def bench(name, open_store, docs, n):
+    directory = tempfile.mkdtemp(prefix=f"bench_{name}_")
+    try:
+        start = time.perf_counter()
+        sync_index(open_store(directory), docs, directory)
+        build = time.perf_counter() - start
+
+        start = time.perf_counter()
+        store = open_store(directory)
+        store.similarity_search(QUESTIONS[0], k=1)  # 第一次查詢才真正載入
+        load = time.perf_counter() - start
+
+        sim, mmr = time_queries(store, n)
+        return {
+            "backend": name,
+            "build_s": build,
+            "load_ms": load * 1000,
+            "sim_p50_ms": percentile(sim, 50),
+            "sim_p95_ms": percentile(sim, 95),
+            "mmr_p50_ms": percentile(mmr, 50),
+            "mmr_p95_ms": percentile(mmr, 95),
+        }
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="benchmark Chroma against NumpyVectorStore")
+    arg_parser.add_argument("--queries", type=int, default=200)
+    args = arg_parser.parse_args()
+
+    docs = generate_document()
+    embeddings = FixedQueryEmbeddings(get_embeddings(), QUESTIONS)
+    print(f"{len(docs)} chunks, {args.queries} queries per backend\n")
+
+    results = [
+        bench("chroma", lambda d: Chroma(embedding_function=embeddings, persist_directory=d), docs, args.queries),
+        bench("numpy-f32", lambda d: NumpyVectorStore(embeddings, d, dtype="float32"), docs, args.queries),
+        bench("numpy-f16", lambda d: NumpyVectorStore(embeddings, d, dtype="float16"), docs, args.queries),
+    ]
+
+    columns = ["backend", "build_s", "load_ms", "sim_p50_ms", "sim_p95_ms", "mmr_p50_ms", "mmr_p95_ms"]
+    print("  ".join(f"{c:>11}" for c in columns))
+    for row in results:
+        print("  ".join(f"{row[c]:>11}" if isinstance(row[c], str) else f"{row[c]:>11.3f}" for c in columns))
@@ -0,0 +1,75 @@
+import os
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from firebase_admin import db
+
+
+# Constants
+
+MEMORY_RETENTION = int(os.environ.get("MEMORY_RETENTION", "20"))  # 每位使用者最多保留幾筆對話
+TRIM_INTERVAL = int(os.environ.get("MEMORY_TRIM_INTERVAL", "300"))  # 同一位使用者多久最多整理一次（秒）
+
+# 整理舊紀錄不在使用者等待的路徑上，交給背景 thread
+_trim_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="memory-trim")
+_last_trim = {}
+_lock = threading.Lock()
+
+
+def get_memory_items(user_id, limit=None):
+    """[(push key, {"user", "bot"})] for the last `limit` turns (all when None), oldest first"""
+    ref = db.reference(f"/chat_memory/{user_id}")
+    query = ref.order_by_key()
+    if limit:
+        query = query.limit_to_last(limit)
+    raw_data = query.get()
+    if not raw_data:
+        return []
+    try:
+        # 排序 key（Firebase 的 push key 可排序）
+        return sorted(raw_data.items())  # [(key1, {...}), (key2, {...})...]
+    except Exception as e:
+        import logging
+        logging.exception(f"[Memory Parse Error] {str(e)}")
+        return []
+
+def get_memory(user_id, limit=None):
+    """last `limit` turns (all when None), oldest first; only those entries are downloaded"""
+    return [item[1] for item in get_memory_items(user_id, limit)]  # 取 value list
+
+def append_memory(user_id, user_text, bot_text):
+    ref = db.reference(f"/chat_memory/{user_id}")
+    ref.push({"user": user_text, "bot": bot_text})
+    schedule_trim(user_id)
+
+def clear_memory(user_id):
+    db.reference(f"/chat_memory/{user_id}").delete()
+
+def trim_memory(user_id, keep=MEMORY_RETENTION):
+    """delete everything but the newest `keep` entries, return how many were removed"""
+    ref = db.reference(f"/chat_memory/{user_id}")
+    keys = ref.get(shallow=True)
+    if not keys or len(keys) <= keep:
+        return 0
+    old_keys = sorted(keys)[:-keep] if keep else sorted(keys)
+    # 一次 multi-path update 刪除
+    ref.update({key: None for key in old_keys})
+    return len(old_keys)
+
+def schedule_trim(user_id):
+    now = time.time()
+    with _lock:
+        if now - _last_trim.get(user_id, 0) < TRIM_INTERVAL:
+            return
+        _last_trim[user_id] = now
+    _trim_executor.submit(_trim_quietly, user_id)
+
+def _trim_quietly(user_id):
+    try:
+        removed = trim_memory(user_id)
+        if removed:
+            print(f"[DEBUG] 整理 {user_id} 的對話紀錄，刪除 {removed} 筆")
+    except Exception as e:
+        import logging
+        logging.exception(f"[Memory Trim Error] {str(e)}")
@@ -0,0 +1,253 @@
+import os
+import time
+import threading
+from collections import deque
+from urllib.parse import urlsplit
+
+import httpx
+import numpy as np
+from urllib3.util.retry import Retry
+
+from linebot.v3.messaging import Configuration, ApiClient, MessagingApi
+from openai import OpenAI, AsyncOpenAI, DefaultHttpxClient, DefaultAsyncHttpxClient
+
+from config import ACCESS_TOKEN, OPENAI_API_KEY
+
+
+# Constants
+
+HTTP_POOL_SIZE = int(os.environ.get("HTTP_POOL_SIZE", "16"))  # 每個 host 保留的 keep-alive 連線數
+HTTP_CONNECT_TIMEOUT = float(os.environ.get("HTTP_CONNECT_TIMEOUT", "5"))
+HTTP_READ_TIMEOUT = float(os.environ.get("HTTP_READ_TIMEOUT", "30"))
+HTTP_RETRIES = int(os.environ.get("HTTP_RETRIES", "2"))
+HTTP_BACKOFF_FACTOR = float(os.environ.get("HTTP_BACKOFF_FACTOR", "0.5"))  # 0.5s, 1s, 2s ...
+HTTP_BACKOFF_JITTER = float(os.environ.get("HTTP_BACKOFF_JITTER", "0.3"))  # 每次再加上 0~0.3s 的亂數
+LATENCY_WINDOW = 500  # 每個 host 保留最近幾筆延遲
+LINE_API_HOST = os.environ.get("LINE_API_HOST", "")  # 壓測時指向 mock_services.py，空字串 = https://api.line.me
+
+
+class HostStats:
+    """per-host request count, new connections and latency of the last LATENCY_WINDOW calls"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._hosts = {}
+
+    def _host(self, host):
+        entry = self._hosts.get(host)
+        if entry is None:
+            entry = self._hosts[host] = {"requests": 0, "connections": 0, "latencies": deque(maxlen=LATENCY_WINDOW)}
+        return entry
+
+    def record(self, host, seconds):
+        with self._lock:
+            entry = self._host(host)
+            entry["requests"] += 1
+            entry["latencies"].append(seconds)
+
+    def connected(self, host):
+        with self._lock:
+            self._host(host)["connections"] += 1
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            result = {}
+            for host, entry in self._hosts.items():
+                latencies = list(entry["latencies"])
+                requests, connections = entry["requests"], entry["connections"]
+                result[host] = {
+                    "requests": requests,
+                    "connections": connections,
+                    "reuse_ratio": round(1 - connections / requests, 3) if requests else 0.0,
+                    "p50_ms": round(float(np.percentile(latencies, 50)) * 1000, 1) if latencies else 0.0,
+                    "p95_ms": round(float(np.percentile(latencies, 95)) * 1000, 1) if latencies else 0.0,
+                }
+            return result
+
+
+host_stats = HostStats()
+
+_lock = threading.RLock()
+_pid = None
+_line_client = None
+_line_bot_api = None
+_httpx_client = None
+_async_httpx_client = None
+_openai_client = None
+_async_openai_client = None
+
+
+# LINE (urllib3)
+
+def line_configuration() -> Configuration:
+    configuration = Configuration(access_token=ACCESS_TOKEN)
+    configuration.connection_pool_maxsize = HTTP_POOL_SIZE
+    # reply token 只能用一次、push 重送會讓使用者收到兩則，所以只重試還沒送出的連線錯誤
+    configuration.retries = Retry(
+        total=HTTP_RETRIES,
+        connect=HTTP_RETRIES,
+        read=0,
+        status=0,
+        backoff_factor=HTTP_BACKOFF_FACTOR,
+        backoff_jitter=HTTP_BACKOFF_JITTER,
+    )
+    return configuration
+
+
+class PooledApiClient(ApiClient):
+    """ApiClient with a default (connect, read) timeout and per-host latency recorded in host_stats"""
+
+    def request(self, method, url, *args, _request_timeout=None, **kwargs):
+        start = time.perf_counter()
+        try:
+            return super().request(
+                method, url, *args,
+                _request_timeout=_request_timeout or (HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT),
+                **kwargs
+            )
+        finally:
+            host_stats.record(urlsplit(url).hostname, time.perf_counter() - start)
+
+    def pool_stats(self) -> dict:
+        # urllib3 自己記錄每個 pool 開過幾條連線、送過幾個 request
+        pools = self.rest_client.pool_manager.pools
+        result = {}
+        for key in pools.keys():
+            pool = pools[key]
+            result[pool.host] = {"connections": pool.num_connections, "requests": pool.num_requests}
+        return result
+
+
+# OpenAI (httpx)
+
+def _trace(host):
+    def trace(event_name, info):
+        if event_name == "connection.connect_tcp.complete":
+            host_stats.connected(host)
+    return trace
+
+def _on_request(request):
+    request.extensions["trace"] = _trace(request.url.host)
+    request.extensions["start"] = time.perf_counter()
+
+def _on_response(response):
+    start = response.request.extensions.get("start")
+    if start is not None:
+        host_stats.record(response.request.url.host, time.perf_counter() - start)
+
+async def _aon_request(request):
+    # httpcore 的 async trace callback 必須是 coroutine
+    host = request.url.host
+
+    async def trace(event_name, info):
+        if event_name == "connection.connect_tcp.complete":
+            host_stats.connected(host)
+    request.extensions["trace"] = trace
+    request.extensions["start"] = time.perf_counter()
+
+async def _aon_response(response):
+    _on_response(response)
+
+def _limits() -> httpx.Limits:
+    return httpx.Limits(max_connections=HTTP_POOL_SIZE, max_keepalive_connections=HTTP_POOL_SIZE)
+
+def _timeout() -> httpx.Timeout:
+    return httpx.Timeout(HTTP_READ_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT)
+
+
+def _check_fork():
+    # 連線池不能跨 process 共用，fork 之後全部重新建立
+    global _pid, _line_client, _line_bot_api, _httpx_client, _async_httpx_client, _openai_client, _async_openai_client
+    if _pid != os.getpid():
+        _pid = os.getpid()
+        _line_client = _line_bot_api = None
+        _httpx_client = _async_httpx_client = _openai_client = _async_openai_client = None
+
+def use_line_host(api):
+    # MessagingApi 每個 endpoint 都用 line_base_path，不看 Configuration.host
+    if LINE_API_HOST:
+        api.line_base_path = LINE_API_HOST.rstrip("/")
+    return api
+
+def get_line_bot_api() -> MessagingApi:
+    global _line_client, _line_bot_api
+    with _lock:
+        _check_fork()
+        if _line_bot_api is None:
+            _line_client = PooledApiClient(line_configuration())
+            _line_bot_api = use_line_host(MessagingApi(_line_client))
+        return _line_bot_api
+
+def get_httpx_client() -> httpx.Client:
+    """keep-alive pool for api.openai.com, shared by the OpenAI client and ChatOpenAI"""
+    global _httpx_client
+    with _lock:
+        _check_fork()
+        if _httpx_client is None:
+            _httpx_client = DefaultHttpxClient(
+                limits=_limits(),
+                timeout=_timeout(),
+                event_hooks={"request": [_on_request], "response": [_on_response]},
+            )
+        return _httpx_client
+
+def get_async_httpx_client() -> httpx.AsyncClient:
+    global _async_httpx_client
+    with _lock:
+        _check_fork()
+        if _async_httpx_client is None:
+            _async_httpx_client = DefaultAsyncHttpxClient(
+                limits=_limits(),
+                timeout=_timeout(),
+                event_hooks={"request": [_aon_request], "response": [_aon_response]},
+            )
+        return _async_httpx_client
+
+def get_openai_client() -> OpenAI:
+    """process-wide OpenAI client; the SDK retries 429/5xx with jittered exponential backoff"""
+    global _openai_client
+    with _lock:
+        _check_fork()
+        if _openai_client is None:
+            _openai_client = OpenAI(
+                api_key=OPENAI_API_KEY,
+                max_retries=HTTP_RETRIES,
+                timeout=_timeout(),
+                http_client=get_httpx_client(),
+            )
+        return _openai_client
+
+def get_async_openai_client() -> AsyncOpenAI:
+    global _async_openai_client
+    with _lock:
+        _check_fork()
+        if _async_openai_client is None:
+            _async_openai_client = AsyncOpenAI(
+                api_key=OPENAI_API_KEY,
+                max_retries=HTTP_RETRIES,
+                timeout=_timeout(),
+                http_client=get_async_httpx_client(),
+            )
+        return _async_openai_client
+
+async def aclose():
+    # async 連線池綁在 event loop 上，ASGI shutdown 時關閉
+    global _async_httpx_client, _async_openai_client
+    if _async_httpx_client is not None:
+        await _async_httpx_client.aclose()
+    _async_httpx_client = _async_openai_client = None
+
+def stats() -> dict:
+    hosts = host_stats.snapshot()
+    if _line_client is not None:
+        # LINE 走 urllib3，連線數以 pool 的計數為準
+        for host, counts in _line_client.pool_stats().items():
+            entry = hosts.setdefault(host, {"p50_ms": 0.0, "p95_ms": 0.0})
+            entry.update(counts)
+            entry["reuse_ratio"] = round(1 - counts["connections"] / counts["requests"], 3) if counts["requests"] else 0.0
+    return {
+        "pool_size": HTTP_POOL_SIZE,
+        "timeout": [HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT],
+        "retries": HTTP_RETRIES,
+        "hosts": hosts,
+    }
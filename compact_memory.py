@@ -0,0 +1,39 @@
+# one-off migration: trim every oversized /chat_memory/{user_id} node down to MEMORY_RETENTION entries
+# usage: python compact_memory.py [--keep 20] [--dry-run]
+import argparse
+
+import firebase_admin
+from firebase_admin import credentials, db
+
+from config import FIREBASE_URL
+from chat_memory import MEMORY_RETENTION, trim_memory
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="compact oversized chat memory nodes")
+    arg_parser.add_argument("--keep", type=int, default=MEMORY_RETENTION)
+    arg_parser.add_argument("--dry-run", action="store_true")
+    args = arg_parser.parse_args()
+
+    cred = credentials.Certificate("firebase_service_key.json")
+    if not firebase_admin._apps:
+        firebase_admin.initialize_app(cred, {
+            'databaseURL': FIREBASE_URL
+        })
+
+    # shallow 只下載 user id，不會把整棵樹抓下來
+    user_ids = db.reference("/chat_memory").get(shallow=True) or {}
+    total_removed = 0
+    for user_id in sorted(user_ids):
+        count = len(db.reference(f"/chat_memory/{user_id}").get(shallow=True) or {})
+        if count <= args.keep:
+            continue
+        if args.dry_run:
+            removed = count - args.keep
+        else:
+            removed = trim_memory(user_id, keep=args.keep)
+        total_removed += removed
+        print(f"{user_id}: {count} -> {count - removed}")
+
+    action = "would remove" if args.dry_run else "removed"
+    print(f"{len(user_ids)} users checked, {action} {total_removed} entries")
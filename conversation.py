@@ -0,0 +1,207 @@
+import os
+import re
+
+from openai import APIStatusError, APIConnectionError, APITimeoutError
+
+from clients import get_openai_client, get_async_openai_client
+from instrumentation import span, inc, record_tokens
+from section_index import count_tokens
+from deadline import CONDENSE_MIN, CONDENSE_TIMEOUT, LLM_MIN
+
+
+# Constants
+
+CONDENSE_QUERY = os.environ.get("CONDENSE_QUERY", "auto")  # auto（像追問才改寫）/ always / off
+CONDENSE_MODEL = "gpt-4o-mini"
+RECENT_TURNS = int(os.environ.get("HISTORY_RECENT_TURNS", "2"))  # 原文保留的最近幾輪
+SUMMARY_TOKEN_BUDGET = int(os.environ.get("HISTORY_SUMMARY_TOKENS", "200"))  # 較舊對話摘要的 token 上限
+RECENT_ANSWER_CHARS = 300  # 最近幾輪的回答也只留前面一段
+SUMMARY_ANSWER_CHARS = 40
+
+# 像追問時才值得花一次 LLM 呼叫把問題改寫成獨立問題；單字（「這」「其」「如果」）太常見，
+# 只比對指涉前文的詞組，或固定出現在句首 / 整句的說法
+FOLLOW_UP_PHRASES = ["上述", "剛剛", "剛才", "前面提到", "上面提到", "你說的", "你提到", "這條", "那條", "該條",
+                     "這項規定", "這個規定", "這種情況", "這樣的話", "那這樣", "也一樣", "一樣嗎"]
+FOLLOW_UP_PREFIXES = ["那", "所以", "還有", "然後", "同樣"]  # 「那事假呢」「所以要扣薪嗎」
+FOLLOW_UP_REPLIES = ["為什麼", "為何", "怎麼說", "確定嗎", "真的嗎", "例如", "然後呢", "還有嗎"]
+FOLLOW_UP_PATTERN = re.compile(
+    "|".join(map(re.escape, FOLLOW_UP_PHRASES))
+    + "|^(?:" + "|".join(map(re.escape, FOLLOW_UP_PREFIXES)) + ")"
+    + "|^(?:" + "|".join(map(re.escape, FOLLOW_UP_REPLIES)) + ")$"
+    + "|^.{1,4}呢$"  # 「病假呢」「特休假呢」：只說主題的短問句
+)
+
+CONDENSE_PROMPT = (
+    "請根據對話紀錄，把使用者最後的提問改寫成一個不需要上下文也能理解的完整問題，"
+    "保留原本的用語與規章名稱，不要回答問題，只輸出改寫後的問題。\n\n"
+    "對話紀錄：\n{history}\n\n使用者最後的提問：{question}"
+)
+
+
+class Turn:
+    """
+    one user turn: the query used for retrieval and the compacted history shown to the LLM
+
+    a turn that is not a follow-up stands on its own, so it can be answered without
+    the history and share the answer cache with other users (see cache_key)
+    """
+
+    def __init__(self, question, retrieval_query, history_text, condensed=False, follow_up=False):
+        self.question = question
+        self.retrieval_query = retrieval_query
+        self.history_text = history_text
+        self.condensed = condensed
+        self.follow_up = follow_up
+
+    @property
+    def cache_key(self):
+        return None if self.follow_up else self.retrieval_query
+
+
+# history compaction
+
+def strip_answer(text: str) -> str:
+    # 回答後面附的參考條文、原文連結不需要再帶進下一輪
+    return text.split("\n\n🔎", 1)[0].strip()
+
+def shorten(text: str, limit: int) -> str:
+    text = " ".join(text.split())
+    return text if len(text) <= limit else text[:limit] + "…"
+
+def summarize_turns(turns: list, budget: int = SUMMARY_TOKEN_BUDGET) -> str:
+    """one line per older turn (question + start of the answer), newest kept first until budget is reached"""
+    lines = []
+    used = 0
+    for item in reversed(turns):
+        line = f"- 問：{shorten(item['user'], SUMMARY_ANSWER_CHARS * 2)}（答：{shorten(strip_answer(item['bot']), SUMMARY_ANSWER_CHARS)}）"
+        tokens = count_tokens(line)
+        if used + tokens > budget:
+            break
+        lines.append(line)
+        used += tokens
+    return "\n".join(reversed(lines))
+
+def compact_history(history: list, recent_turns: int = RECENT_TURNS, budget: int = SUMMARY_TOKEN_BUDGET) -> str:
+    """
+    history: [{"user", "bot"}, ...] oldest first
+    the last recent_turns turns are kept (answers without references),
+    older ones become a short summary under budget tokens
+    """
+    if not history:
+        return ""
+    split = max(len(history) - recent_turns, 0)
+    older, recent = history[:split], history[split:]
+    blocks = []
+    summary = summarize_turns(older, budget)
+    if summary:
+        blocks.append("較早的對話摘要：\n" + summary)
+    if recent:
+        blocks.append("\n".join(
+            f"User: {item['user']}\nBot: {shorten(strip_answer(item['bot']), RECENT_ANSWER_CHARS)}" for item in recent
+        ))
+    return "\n\n".join(blocks)
+
+
+# query condensing
+
+def is_follow_up(question: str) -> bool:
+    # 不計前後空白與標點，「為什麼？」「病假呢」整句比對
+    return bool(FOLLOW_UP_PATTERN.search(question.strip(" ？?！!。，,～~")))
+
+def should_condense(history: list, question: str, mode: str = CONDENSE_QUERY) -> bool:
+    if not history or mode == "off":
+        return False
+    return mode == "always" or is_follow_up(question)
+
+def condense_client(timeout: float = None):
+    client = get_openai_client()
+    return client.with_options(timeout=timeout, max_retries=0) if timeout else client
+
+def acondense_client(timeout: float = None):
+    client = get_async_openai_client()
+    return client.with_options(timeout=timeout, max_retries=0) if timeout else client
+
+def condense_messages(history_text: str, question: str) -> list:
+    return [{"role": "user", "content": CONDENSE_PROMPT.format(history=history_text, question=question)}]
+
+def parse_condensed(text: str, question: str) -> str:
+    condensed = (text or "").strip().strip("「」\"'")
+    # 模型沒照指示（空白或長篇回答）就退回原本的提問
+    if not condensed or len(condensed) > max(len(question) * 4, 80):
+        return question
+    return condensed
+
+def condense_query(history_text: str, question: str, timeout: float = None) -> str:
+    """timeout: limit the call and skip SDK retries, the original question is used if it runs out"""
+    try:
+        with span("condense"):
+            completion = condense_client(timeout).chat.completions.create(
+                model=CONDENSE_MODEL,
+                messages=condense_messages(history_text, question),
+                temperature=0,
+                max_tokens=100
+            )
+    except APITimeoutError:
+        inc("condense_timeouts_total")  # 沿用原本的提問
+        return question
+    except (APIStatusError, APIConnectionError) as e:
+        import logging
+        logging.exception(f"[Condense Error] {str(e)}")
+        return question
+    record_tokens(CONDENSE_MODEL, completion.usage)
+    return parse_condensed(completion.choices[0].message.content, question)
+
+async def acondense_query(history_text: str, question: str, timeout: float = None) -> str:
+    """async version of condense_query"""
+    try:
+        with span("condense"):
+            completion = await acondense_client(timeout).chat.completions.create(
+                model=CONDENSE_MODEL,
+                messages=condense_messages(history_text, question),
+                temperature=0,
+                max_tokens=100
+            )
+    except APITimeoutError:
+        inc("condense_timeouts_total")  # 沿用原本的提問
+        return question
+    except (APIStatusError, APIConnectionError) as e:
+        import logging
+        logging.exception(f"[Condense Error] {str(e)}")
+        return question
+    record_tokens(CONDENSE_MODEL, completion.usage)
+    return parse_condensed(completion.choices[0].message.content, question)
+
+
+# turn
+
+def condense_timeout(deadline):
+    # 改寫逾時也要留下產生答案的時間
+    return deadline and deadline.timeout(CONDENSE_TIMEOUT, keep=LLM_MIN)
+
+def affords_condense(deadline) -> bool:
+    if deadline is None or deadline.allows(CONDENSE_MIN):
+        return True
+    deadline.degrade("skip_condense")
+    return False
+
+def prepare_turn(history: list, question: str, mode: str = CONDENSE_QUERY, deadline=None) -> Turn:
+    """
+    retrieval only sees the current question (or its condensed form for follow-ups),
+    the LLM gets the compacted history instead of every full previous answer;
+    with a deadline.Deadline the rewrite is skipped when too little time is left
+    """
+    history_text = compact_history(history)
+    follow_up = bool(history) and is_follow_up(question)
+    if should_condense(history, question, mode) and affords_condense(deadline):
+        query = condense_query(history_text, question, condense_timeout(deadline))
+        return Turn(question, query, history_text, condensed=query != question, follow_up=follow_up)
+    return Turn(question, question, history_text, follow_up=follow_up)
+
+async def aprepare_turn(history: list, question: str, mode: str = CONDENSE_QUERY, deadline=None) -> Turn:
+    """async version of prepare_turn"""
+    history_text = compact_history(history)
+    follow_up = bool(history) and is_follow_up(question)
+    if should_condense(history, question, mode) and affords_condense(deadline):
+        query = await acondense_query(history_text, question, condense_timeout(deadline))
+        return Turn(question, query, history_text, condensed=query != question, follow_up=follow_up)
+    return Turn(question, question, history_text, follow_up=follow_up)
@@ -0,0 +1,52 @@
+import os
+import time
+
+from instrumentation import inc
+
+
+# Constants
+
+ANSWER_BUDGET = float(os.environ.get("ANSWER_BUDGET", "20"))  # 收到提問到推播答案的總預算（秒）
+PUSH_RESERVE = float(os.environ.get("DEADLINE_PUSH_RESERVE", "2"))  # 留給寫回記憶與推播，不分給前面的階段
+CONDENSE_MIN = float(os.environ.get("DEADLINE_CONDENSE_MIN", "12"))  # 剩餘少於此就不改寫追問，直接用原提問檢索
+LLM_MIN = float(os.environ.get("DEADLINE_LLM_MIN", "4"))  # 剩餘少於此就不呼叫 gpt-4o，改送檢索到的條文
+FALLBACK_MIN = float(os.environ.get("DEADLINE_FALLBACK_MIN", "6"))  # 剩餘少於此就不跑 gpt-4o-mini fallback
+CONDENSE_TIMEOUT = 5.0
+FALLBACK_TIMEOUT = 30.0
+MIN_CALL_TIMEOUT = 0.5  # 再短的 HTTP timeout 只會白白失敗
+
+
+class Deadline:
+    """
+    Time budget of one question, created when the webhook arrives and passed to every phase
+
+    remaining() already leaves PUSH_RESERVE for the memory write and the push, so
+    a phase that fits in remaining() never pushes the answer past the budget;
+    phases that take a cheaper path record it with degrade()
+    """
+
+    def __init__(self, budget: float = ANSWER_BUDGET, reserve: float = PUSH_RESERVE):
+        self.budget = budget
+        self.start = time.monotonic()
+        self.expires = self.start + budget - reserve
+        self.degraded = []
+
+    def elapsed(self) -> float:
+        return time.monotonic() - self.start
+
+    def remaining(self) -> float:
+        return max(0.0, self.expires - time.monotonic())
+
+    def allows(self, seconds: float) -> bool:
+        return self.remaining() >= seconds
+
+    def timeout(self, cap: float = None, keep: float = 0.0) -> float:
+        """timeout for the next upstream call: what is left minus keep (for later phases), at most cap"""
+        remaining = self.remaining() - keep
+        if cap is not None:
+            remaining = min(remaining, cap)
+        return max(remaining, MIN_CALL_TIMEOUT)
+
+    def degrade(self, reason: str):
+        self.degraded.append(reason)
+        inc("deadline_degraded_total", reason=reason)
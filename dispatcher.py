@@ -0,0 +1,110 @@
+import os
+import time
+import queue
+import threading
+from collections import deque
+
+
+# Constants
+
+WORKERS = int(os.environ.get("DISPATCHER_WORKERS", "8"))
+MAX_QUEUE = int(os.environ.get("DISPATCHER_MAX_QUEUE", "100"))  # 等待中的工作上限，超過就回覆忙碌
+WAIT_SAMPLES = 1000
+
+
+class Dispatcher:
+    """
+    Fixed-size worker pool with a bounded backlog
+
+    tasks from the same user_id run one at a time in submit order, so two quick
+    messages from one user never touch /chat_memory/{user_id} concurrently
+    """
+
+    def __init__(self, workers: int = WORKERS, max_queue: int = MAX_QUEUE):
+        self.workers = workers
+        self.max_queue = max_queue
+
+        self._lock = threading.Lock()
+        self._ready = queue.Queue()
+        self._lanes = {}  # user_id -> deque of tasks waiting behind the running one
+        self._pending = 0
+        self._pid = None
+
+        self.submitted = 0
+        self.rejected = 0
+        self.completed = 0
+        self.failed = 0
+        self._waits = deque(maxlen=WAIT_SAMPLES)
+        self._wait_max = 0.0
+
+    def _ensure_started(self):
+        # worker threads 不會跟著 fork 過去，換了 process 就重新啟動
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            for i in range(self.workers):
+                threading.Thread(target=self._worker, name=f"dispatcher-{i}", daemon=True).start()
+
+    def submit(self, user_id, fn, *args) -> bool:
+        """queue fn(*args) behind other tasks of user_id, return False when the backlog is full"""
+        self._ensure_started()
+        # 沒有 user_id 的工作不需要排序
+        lane_key = user_id if user_id is not None else object()
+        task = (lane_key, fn, args, time.monotonic())
+        with self._lock:
+            if self._pending >= self.max_queue:
+                self.rejected += 1
+                return False
+            self._pending += 1
+            self.submitted += 1
+            if lane_key in self._lanes:
+                self._lanes[lane_key].append(task)
+            else:
+                self._lanes[lane_key] = deque()
+                self._ready.put(task)
+        return True
+
+    def _worker(self):
+        while True:
+            lane_key, fn, args, enqueued = self._ready.get()
+            wait = time.monotonic() - enqueued
+            with self._lock:
+                self._pending -= 1
+                self._waits.append(wait)
+                self._wait_max = max(self._wait_max, wait)
+            try:
+                fn(*args)
+                self.completed += 1
+            except Exception as e:
+                self.failed += 1
+                import logging
+                logging.exception(f"[Dispatcher Task Error] {str(e)}")
+            finally:
+                with self._lock:
+                    lane = self._lanes.get(lane_key)
+                    if lane:
+                        self._ready.put(lane.popleft())
+                    else:
+                        self._lanes.pop(lane_key, None)
+
+    def stats(self) -> dict:
+        with self._lock:
+            waits = sorted(self._waits)
+            depth = self._pending
+            active_users = len(self._lanes)
+        return {
+            "workers": self.workers,
+            "queue_depth": depth,
+            "max_queue": self.max_queue,
+            "active_users": active_users,
+            "submitted": self.submitted,
+            "rejected": self.rejected,
+            "completed": self.completed,
+            "failed": self.failed,
+            "wait_avg": round(sum(waits) / len(waits), 4) if waits else 0.0,
+            "wait_p95": round(waits[int(len(waits) * 0.95)], 4) if waits else 0.0,
+            "wait_max": round(self._wait_max, 4),
+        }
@@ -0,0 +1,200 @@
+import os
+import time
+import threading
+import argparse
+
+import numpy as np
+
+from langchain_core.embeddings import Embeddings
+
+
+# Constants
+
+EMBED_BACKEND = os.environ.get("EMBED_BACKEND", "torch")  # torch / onnx / onnx-int8
+ONNX_DIR = os.environ.get("ONNX_MODEL_DIR", "./onnx_model")
+ONNX_FILES = {"onnx": "model.onnx", "onnx-int8": "model_int8.onnx"}
+EMBED_BATCH_SIZE = int(os.environ.get("EMBED_BATCH_SIZE", "32"))
+EMBED_THREADS = int(os.environ.get("EMBED_THREADS", "0"))  # 0 = onnxruntime 自行決定
+MAX_SEQ_LENGTH = 256  # all-MiniLM-L6-v2 的 max_seq_length
+
+
+class OnnxEmbeddings(Embeddings):
+    """
+    Sentence-transformers model (mean pooling + L2 normalize) run with onnxruntime
+
+    no torch at runtime: the tokenizer comes from tokenizer.json and the
+    model from an exported .onnx file (see `python embedding_backends.py export`)
+    """
+
+    def __init__(self, model_dir: str = ONNX_DIR, model_file: str = ONNX_FILES["onnx"],
+                 batch_size: int = EMBED_BATCH_SIZE, threads: int = EMBED_THREADS):
+        from tokenizers import Tokenizer
+
+        self.batch_size = batch_size
+        self.tokenizer = Tokenizer.from_file(os.path.join(model_dir, "tokenizer.json"))
+        self.tokenizer.enable_truncation(max_length=MAX_SEQ_LENGTH)
+        self.tokenizer.enable_padding()  # 補到同一批中最長的長度
+        # tokenizer 的設定只在這裡改，之後 encode_batch 只讀；仍加鎖避免多 thread 同時借用
+        self._tokenizer_lock = threading.Lock()
+
+        self.model_path = os.path.join(model_dir, model_file)
+        self.threads = threads
+        self.session = self._new_session()
+        self.input_names = {i.name for i in self.session.get_inputs()}
+
+    def _new_session(self):
+        import onnxruntime as ort
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if self.threads:
+            options.intra_op_num_threads = self.threads
+        self._pid = os.getpid()
+        # InferenceSession.run 本身是 thread-safe，同一個 process 的多個 thread 可以共用同一個 session
+        return ort.InferenceSession(self.model_path, options, providers=["CPUExecutionProvider"])
+
+    def _encode(self, texts: list[str]) -> np.ndarray:
+        if self._pid != os.getpid():
+            # onnxruntime 的 thread pool 不會跟著 fork 過去（gunicorn preload），換了 process 就重建 session
+            self.session = self._new_session()
+        with self._tokenizer_lock:
+            encodings = self.tokenizer.encode_batch(texts)
+        input_ids = np.array([e.ids for e in encodings], dtype=np.int64)
+        attention_mask = np.array([e.attention_mask for e in encodings], dtype=np.int64)
+        feeds = {"input_ids": input_ids, "attention_mask": attention_mask}
+        if "token_type_ids" in self.input_names:
+            feeds["token_type_ids"] = np.array([e.type_ids for e in encodings], dtype=np.int64)
+
+        token_embeddings = self.session.run(None, {k: v for k, v in feeds.items() if k in self.input_names})[0]
+        # mean pooling（排除 padding），再做 L2 normalize，與 sentence-transformers 的輸出一致
+        mask = attention_mask[..., None].astype(np.float32)
+        pooled = (token_embeddings * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+        norms = np.linalg.norm(pooled, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return pooled / norms
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        if not texts:
+            return []
+        # 依長度排序後分批，減少 padding 浪費
+        order = sorted(range(len(texts)), key=lambda i: len(texts[i]))
+        vectors = np.zeros((len(texts), 0), dtype=np.float32)
+        for start in range(0, len(order), self.batch_size):
+            batch = order[start:start + self.batch_size]
+            encoded = self._encode([texts[i] for i in batch])
+            if vectors.shape[1] == 0:
+                vectors = np.zeros((len(texts), encoded.shape[1]), dtype=np.float32)
+            vectors[batch] = encoded
+        return vectors.tolist()
+
+    def embed_query(self, text: str) -> list[float]:
+        return self._encode([text])[0].tolist()
+
+
+def load_embeddings(model_name: str, backend: str = EMBED_BACKEND,
+                    model_kwargs: dict = None, encode_kwargs: dict = None) -> Embeddings:
+    """embeddings object for EMBED_BACKEND; torch imports sentence-transformers, onnx* only onnxruntime"""
+    if backend == "torch":
+        from langchain_huggingface import HuggingFaceEmbeddings
+        return HuggingFaceEmbeddings(
+            model_name=model_name,
+            model_kwargs=model_kwargs or {},
+            encode_kwargs=dict(encode_kwargs or {}, batch_size=EMBED_BATCH_SIZE),
+        )
+    if backend in ONNX_FILES:
+        if not os.path.exists(os.path.join(ONNX_DIR, ONNX_FILES[backend])):
+            raise FileNotFoundError(
+                f"{ONNX_DIR}/{ONNX_FILES[backend]} not found, run: python embedding_backends.py export"
+            )
+        return OnnxEmbeddings(model_file=ONNX_FILES[backend])
+    raise ValueError(f"unknown EMBED_BACKEND: {backend}")
+
+
+# export / parity / bench commands
+
+def export_onnx(model_name: str, model_dir: str = ONNX_DIR) -> None:
+    """export the transformer to ONNX and write a dynamic int8 quantized copy next to it (needs torch once)"""
+    import torch
+    from transformers import AutoTokenizer, AutoModel
+    from onnxruntime.quantization import quantize_dynamic, QuantType
+
+    os.makedirs(model_dir, exist_ok=True)
+    tokenizer = AutoTokenizer.from_pretrained(model_name)
+    tokenizer.save_pretrained(model_dir)  # 產生 tokenizer.json
+    model = AutoModel.from_pretrained(model_name).eval()
+
+    sample = tokenizer(["暖機"], return_tensors="pt")
+    names = [n for n in ("input_ids", "attention_mask", "token_type_ids") if n in sample]
+    dynamic_axes = {n: {0: "batch", 1: "sequence"} for n in names}
+    dynamic_axes["last_hidden_state"] = {0: "batch", 1: "sequence"}
+    onnx_path = os.path.join(model_dir, ONNX_FILES["onnx"])
+    torch.onnx.export(
+        model, tuple(sample[n] for n in names), onnx_path,
+        input_names=names, output_names=["last_hidden_state"],
+        dynamic_axes=dynamic_axes, opset_version=14,
+    )
+    quantize_dynamic(onnx_path, os.path.join(model_dir, ONNX_FILES["onnx-int8"]), weight_type=QuantType.QInt8)
+    print(f"exported {onnx_path} and {ONNX_FILES['onnx-int8']}")
+
+def parity(model_name: str, backend: str, texts: list[str], min_cosine: float) -> bool:
+    """cosine similarity between the torch vectors and `backend` vectors for the same texts"""
+    reference = np.asarray(load_embeddings(model_name, "torch").embed_documents(texts), dtype=np.float32)
+    candidate = np.asarray(load_embeddings(model_name, backend).embed_documents(texts), dtype=np.float32)
+    reference /= np.linalg.norm(reference, axis=1, keepdims=True)
+    candidate /= np.linalg.norm(candidate, axis=1, keepdims=True)
+    cosine = (reference * candidate).sum(axis=1)
+    print(f"{backend} vs torch on {len(texts)} texts: min {cosine.min():.5f}  mean {cosine.mean():.5f}")
+    return bool(cosine.min() >= min_cosine)
+
+def bench(model_name: str, backend: str, texts: list[str], queries: int) -> dict:
+    """startup time, RSS and per-query latency of one backend (run once per process for a clean RSS)"""
+    import resource
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.perf_counter()
+    embeddings = load_embeddings(model_name, backend)
+    embeddings.embed_query("暖機")
+    startup = time.perf_counter() - start
+
+    start = time.perf_counter()
+    embeddings.embed_documents(texts)
+    index = time.perf_counter() - start
+
+    latencies = []
+    for i in range(queries):
+        start = time.perf_counter()
+        embeddings.embed_query(texts[i % len(texts)])
+        latencies.append(time.perf_counter() - start)
+    return {
+        "backend": backend,
+        "startup_s": round(startup, 3),
+        "index_s": round(index, 3),
+        "query_p50_ms": round(float(np.percentile(latencies, 50)) * 1000, 2),
+        "query_p95_ms": round(float(np.percentile(latencies, 95)) * 1000, 2),
+        "max_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        "rss_growth_mb": round((resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss_before) / 1024, 1),
+    }
+
+
+if __name__ == "__main__":
+    from rag_module import EMBED_MODEL, generate_document
+
+    arg_parser = argparse.ArgumentParser(description="export / check / benchmark embedding backends")
+    commands = arg_parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("export", help="export EMBED_MODEL to ONNX (+ int8) under ONNX_MODEL_DIR")
+    parity_parser = commands.add_parser("parity", help="compare an ONNX backend with the torch output")
+    parity_parser.add_argument("--backend", default="onnx-int8", choices=list(ONNX_FILES))
+    parity_parser.add_argument("--min-cosine", type=float, default=0.99)
+    bench_parser = commands.add_parser("bench", help="startup / RSS / latency of one backend")
+    bench_parser.add_argument("--backend", default=EMBED_BACKEND, choices=["torch"] + list(ONNX_FILES))
+    bench_parser.add_argument("--queries", type=int, default=200)
+    args = arg_parser.parse_args()
+
+    if args.command == "export":
+        export_onnx(EMBED_MODEL)
+    else:
+        texts = [doc.page_content for doc in generate_document()]
+        if args.command == "parity":
+            ok = parity(EMBED_MODEL, args.backend, texts, args.min_cosine)
+            print("OK" if ok else f"FAILED: some vectors below cosine {args.min_cosine}")
+            raise SystemExit(0 if ok else 1)
+        print(bench(EMBED_MODEL, args.backend, texts, args.queries))
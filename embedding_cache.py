@@ -0,0 +1,161 @@
+import os
+import time
+import sqlite3
+import hashlib
+import threading
+import unicodedata
+
+import numpy as np
+
+from langchain_core.embeddings import Embeddings
+
+from instrumentation import span, inc
+
+
+# Constants
+
+CACHE_PATH = os.environ.get("EMBED_CACHE_PATH", "./embedding_cache.sqlite")  # 空字串 = 不使用快取
+MAX_ENTRIES = int(os.environ.get("EMBED_CACHE_MAX_ENTRIES", "50000"))
+SQL_BATCH = 500  # 單一 SQL 的參數上限內
+
+
+def normalize_text(text: str) -> str:
+    # 全形 / 半形、多餘空白不同的相同句子共用一個向量
+    return " ".join(unicodedata.normalize("NFKC", text).split())
+
+def cache_key(model_id: str, text: str) -> str:
+    return hashlib.sha1(f"{model_id}\n{normalize_text(text)}".encode("utf-8")).hexdigest()
+
+
+class CachedEmbeddings(Embeddings):
+    """
+    Embeddings wrapper that stores every vector in a local sqlite file
+
+    keys are sha1(model id + normalized text); only texts that are not in the
+    cache reach the wrapped model, least recently used rows are evicted once
+    the table grows past max_entries; queries and documents share keys, which
+    holds for sentence-transformers models without query prompts
+    """
+
+    def __init__(self, embeddings: Embeddings, model_id: str, path: str = CACHE_PATH, max_entries: int = MAX_ENTRIES):
+        self.embeddings = embeddings
+        self.model_id = model_id
+        self.path = path
+        self.max_entries = max_entries
+
+        self._lock = threading.Lock()
+        self._conn = None
+        self._pid = None
+        self._count = None
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    # storage
+
+    def _db(self) -> sqlite3.Connection:
+        # sqlite 連線不能跨 fork 共用
+        if self._conn is None or self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings ("
+                "key TEXT PRIMARY KEY, vector BLOB NOT NULL, last_used REAL NOT NULL)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)")
+            self._count = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+        return self._conn
+
+    def _get_many(self, keys: list[str]) -> dict:
+        found = {}
+        with self._lock:
+            db = self._db()
+            for start in range(0, len(keys), SQL_BATCH):
+                batch = keys[start:start + SQL_BATCH]
+                marks = ",".join("?" * len(batch))
+                for key, blob in db.execute(f"SELECT key, vector FROM embeddings WHERE key IN ({marks})", batch):
+                    found[key] = np.frombuffer(blob, dtype=np.float32).tolist()
+                if found:
+                    # 更新使用時間，讓常用的向量不被淘汰
+                    db.execute(f"UPDATE embeddings SET last_used = ? WHERE key IN ({marks})", [time.time()] + batch)
+        return found
+
+    def _put_many(self, items: dict) -> None:
+        now = time.time()
+        with self._lock:
+            db = self._db()
+            db.execute("BEGIN")
+            db.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, vector, last_used) VALUES (?, ?, ?)",
+                [(key, np.asarray(vector, dtype=np.float32).tobytes(), now) for key, vector in items.items()]
+            )
+            db.execute("COMMIT")
+            self._count += len(items)
+            if self._count > self.max_entries:
+                self._evict(db)
+
+    def _evict(self, db):
+        self._count = db.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+        # 一次多刪 10%，避免每次寫入都觸發淘汰
+        overflow = self._count - int(self.max_entries * 0.9)
+        if overflow <= 0:
+            return
+        db.execute(
+            "DELETE FROM embeddings WHERE key IN (SELECT key FROM embeddings ORDER BY last_used LIMIT ?)", (overflow,)
+        )
+        self._count -= overflow
+        self.evictions += overflow
+
+    # Embeddings
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        if not texts:
+            return []
+        keys = [cache_key(self.model_id, text) for text in texts]
+        found = self._get_many(list(dict.fromkeys(keys)))
+
+        # 沒命中的文字（重複的只算一次）一起交給模型
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in found and key not in missing:
+                missing[key] = text
+        self.hits += len(texts) - len(missing)
+        self.misses += len(missing)
+        inc("embedding_cache_total", len(texts) - len(missing), result="hit")
+        inc("embedding_cache_total", len(missing), result="miss")
+        if missing:
+            with span("embedding", texts=len(missing)):
+                vectors = self.embeddings.embed_documents(list(missing.values()))
+            computed = dict(zip(missing.keys(), vectors))
+            self._put_many(computed)
+            found.update(computed)
+        return [list(found[key]) for key in keys]
+
+    def embed_query(self, text: str) -> list[float]:
+        key = cache_key(self.model_id, text)
+        found = self._get_many([key])
+        if key in found:
+            self.hits += 1
+            inc("embedding_cache_total", result="hit")
+            return found[key]
+        self.misses += 1
+        inc("embedding_cache_total", result="miss")
+        with span("embedding", texts=1):
+            vector = self.embeddings.embed_query(text)
+        self._put_many({key: vector})
+        return list(vector)
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "model": self.model_id,
+            "entries": self._count,
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 3) if total else 0.0,
+            "evictions": self.evictions,
+        }
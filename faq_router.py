@@ -0,0 +1,133 @@
+import os
+import time
+import threading
+
+import numpy as np
+
+from instrumentation import span, inc
+
+
+# Constants
+
+ROUTER_ENABLED = os.environ.get("FAQ_ROUTER_ENABLED", "1") == "1"
+ANSWER_THRESHOLD = float(os.environ.get("FAQ_ROUTER_THRESHOLD", "0.85"))  # 高於此 cosine 直接回 FAQ 答案
+SUGGEST_THRESHOLD = float(os.environ.get("FAQ_SUGGEST_THRESHOLD", "0.6"))  # 高於此只在回答下方建議該 FAQ
+RAG_SECONDS_PRIOR = 3.0  # 還沒量到 RAG 耗時前，估算省下時間用的預設值
+
+
+class FaqRouter:
+    """
+    Matches a question against every FAQ_ANSWERS key with one matrix product
+
+    the keys are embedded once into a normalized (n_faq, dim) matrix;
+    route() returns the nearest key with its score and whether to answer
+    from FAQ_ANSWERS directly, suggest it, or leave the question to RAG
+    """
+
+    def __init__(self, embeddings, faq_answers: dict,
+                 answer_threshold: float = ANSWER_THRESHOLD, suggest_threshold: float = SUGGEST_THRESHOLD):
+        self.embeddings = embeddings
+        self.faq_answers = faq_answers
+        self.answer_threshold = answer_threshold
+        self.suggest_threshold = suggest_threshold
+
+        self.keys = list(faq_answers.keys())
+        self.matrix = self._normalize(np.asarray(embeddings.embed_documents(self.keys), dtype=np.float32)) \
+            if self.keys else np.zeros((0, 0), dtype=np.float32)
+
+        self._lock = threading.Lock()
+        self.lookups = 0
+        self.hits = 0
+        self.suggestions = 0
+        self.route_seconds = 0.0
+        self.rag_seconds = None  # RAG 路徑耗時的移動平均
+
+    @staticmethod
+    def _normalize(vectors: np.ndarray) -> np.ndarray:
+        norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return vectors / norms
+
+    def scores(self, question: str) -> np.ndarray:
+        if not self.keys:
+            return np.zeros(0, dtype=np.float32)
+        query = self._normalize(np.asarray(self.embeddings.embed_query(question), dtype=np.float32))
+        return self.matrix @ query
+
+    def route(self, question: str) -> dict:
+        """{'action': 'answer' | 'suggest' | None, 'question': nearest FAQ key, 'answer', 'score'}"""
+        start = time.perf_counter()
+        with span("faq_router") as attrs:
+            scores = self.scores(question)
+            best = int(np.argmax(scores)) if len(scores) else None
+            score = float(scores[best]) if best is not None else 0.0
+            action = None
+            if best is not None and score >= self.answer_threshold:
+                action = "answer"
+            elif best is not None and score >= self.suggest_threshold:
+                action = "suggest"
+            attrs["action"] = action or "rag"
+            attrs["score"] = round(score, 3)
+
+        with self._lock:
+            self.lookups += 1
+            self.route_seconds += time.perf_counter() - start
+            if action == "answer":
+                self.hits += 1
+            elif action == "suggest":
+                self.suggestions += 1
+        inc("faq_router_total", result=action or "miss")
+        if best is None:
+            return {"action": None, "question": None, "answer": None, "score": 0.0}
+        key = self.keys[best]
+        return {"action": action, "question": key, "answer": self.faq_answers[key], "score": score}
+
+    def record_rag_seconds(self, seconds: float):
+        # 用 RAG 實際耗時估算每次命中省下的時間
+        with self._lock:
+            self.rag_seconds = seconds if self.rag_seconds is None else 0.9 * self.rag_seconds + 0.1 * seconds
+
+    def stats(self) -> dict:
+        rag_seconds = self.rag_seconds if self.rag_seconds is not None else RAG_SECONDS_PRIOR
+        route_avg = self.route_seconds / self.lookups if self.lookups else 0.0
+        return {
+            "faqs": len(self.keys),
+            "lookups": self.lookups,
+            "hits": self.hits,
+            "suggestions": self.suggestions,
+            "hit_rate": round(self.hits / self.lookups, 4) if self.lookups else 0.0,
+            "route_avg_ms": round(route_avg * 1000, 2),
+            "rag_avg_s": round(rag_seconds, 3),
+            "saved_s_estimate": round(self.hits * rag_seconds - self.lookups * route_avg, 1),
+            "answer_threshold": self.answer_threshold,
+            "suggest_threshold": self.suggest_threshold,
+        }
+
+
+_router = None
+
+def get_faq_router() -> FaqRouter:
+    global _router
+    if _router is None:
+        from config import FAQ_ANSWERS
+        from rag_module import get_embeddings
+        _router = FaqRouter(get_embeddings(), FAQ_ANSWERS)
+    return _router
+
+def get_faq_router_stats() -> dict:
+    return _router.stats() if _router is not None else {}
+
+
+if __name__ == "__main__":
+    import argparse
+
+    arg_parser = argparse.ArgumentParser(description="show the nearest FAQ keys for a question (threshold tuning)")
+    arg_parser.add_argument("question")
+    arg_parser.add_argument("--top", type=int, default=5)
+    args = arg_parser.parse_args()
+
+    router = get_faq_router()
+    scores = router.scores(args.question)
+    for i in np.argsort(-scores)[:args.top]:
+        print(f"{scores[i]:.3f}  {router.keys[i]}")
+    print(router.route(args.question)["action"] or "rag")
@@ -0,0 +1,56 @@
+# production serving: gunicorn -c gunicorn.conf.py main:app
+# the master imports main.py and warms up (embedding model, vector index, chain) once before forking,
+# workers share those pages copy-on-write instead of each loading their own copy
+import os
+import gc
+import sys
+
+
+# Constants
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '8080')}"
+# session_store 的快取、dispatcher 的每人排序、webhook 去重與 singleflight 都只在單一 process 內有效，
+# 預設一個 worker；要多個 worker 得先讓這些狀態跨 process 共用
+workers = int(os.environ.get("WEB_CONCURRENCY", "1"))
+threads = int(os.environ.get("GUNICORN_THREADS", "8"))  # 每個 worker 的 thread 數（gthread）
+worker_class = "gthread"
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", "120"))
+graceful_timeout = 30
+keepalive = 5
+preload_app = True
+accesslog = "-" if os.environ.get("GUNICORN_ACCESS_LOG") == "1" else None
+
+# 每個 worker 的 torch 運算 thread 數，預設把 CPU 平分給各 worker，避免 N 個 worker 各自開滿所有核心
+TORCH_THREADS = int(os.environ.get("TORCH_THREADS", "0")) or max(1, (os.cpu_count() or 1) // workers)
+WARMUP_ATTEMPTS = int(os.environ.get("WARMUP_ATTEMPTS", "2"))  # master 內暖機失敗幾次後交給 worker 重試
+
+# main.py 不在 import 時開背景暖機 thread（thread 不會跟著 fork），改由 when_ready 在 master 同步執行
+os.environ["WARMUP_DEFER"] = "1"
+os.environ.setdefault("TOKENIZERS_PARALLELISM", "false")
+
+
+def when_ready(server):
+    # preload_app：此時 main 已在 master import 完成，worker 還沒 fork
+    from main import warmer
+    if not warmer.run(attempts=WARMUP_ATTEMPTS):
+        server.log.warning(f"warm-up failed in master ({warmer.error}), workers will retry")
+    server.log.info(f"warm-up: {warmer.status()}")
+    # 把目前所有物件移到永久世代，GC 不再掃描（改寫）它們，共用的 page 不會因此被複製
+    gc.freeze()
+
+def post_fork(server, worker):
+    torch = sys.modules.get("torch")
+    if torch is not None:
+        torch.set_num_threads(TORCH_THREADS)
+    import rag_module
+    rag_module.reopen_after_fork()
+    rag_module.start_index_watcher()  # master 的 watcher thread 不會跟著 fork 過來
+    from main import warmer
+    warmer.start()  # master 已暖機完成時不做事
+
+def worker_exit(server, worker):
+    # 把還沒寫回 Firebase 的 session 送出去
+    from session_store import sessions
+    sessions.flush()
+    import rag_module
+    rag_module.flush_answer_cache()
@@ -0,0 +1,95 @@
+import re
+import math
+from collections import Counter, defaultdict
+
+from pydantic import ConfigDict
+from langchain.docstore.document import Document
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_core.retrievers import BaseRetriever
+
+
+# Constants
+
+NGRAM_RANGE = (2, 3)
+BM25_K1 = 1.5
+BM25_B = 0.75
+RRF_K = 60  # reciprocal rank fusion 常數
+
+_SKIP_RE = re.compile(r"[\s，。、；：「」『』（）()〔〕【】？！?!,.;:]+")
+
+
+def char_ngrams(text: str, ngram_range: tuple = NGRAM_RANGE) -> list[str]:
+    """character n-grams of every punctuation-free run of text (bigram + trigram by default)"""
+    grams = []
+    for run in _SKIP_RE.split(text.lower()):
+        for n in range(ngram_range[0], ngram_range[1] + 1):
+            grams.extend(run[i:i + n] for i in range(len(run) - n + 1))
+        if 0 < len(run) < ngram_range[0]:
+            grams.append(run)
+    return grams
+
+def doc_key(doc: Document) -> str:
+    return doc.metadata.get("id") or doc.page_content
+
+
+class NgramBM25:
+    """in-process BM25 over character n-grams, so exact terms like 病假 or 第十三條 still match"""
+
+    def __init__(self, docs: list[Document], k1: float = BM25_K1, b: float = BM25_B):
+        self.docs = docs
+        self.k1 = k1
+        self.b = b
+        self.postings = defaultdict(dict)  # term -> {doc index: term frequency}
+        self.lengths = []
+        for i, doc in enumerate(docs):
+            grams = Counter(char_ngrams(doc.page_content))
+            self.lengths.append(sum(grams.values()))
+            for term, tf in grams.items():
+                self.postings[term][i] = tf
+        self.avg_length = sum(self.lengths) / len(self.lengths) if self.lengths else 0.0
+
+    def idf(self, term: str) -> float:
+        df = len(self.postings.get(term, ()))
+        return math.log(1 + (len(self.docs) - df + 0.5) / (df + 0.5))
+
+    def search(self, query: str, k: int) -> list[tuple[int, float]]:
+        scores = defaultdict(float)
+        for term in set(char_ngrams(query)):
+            postings = self.postings.get(term)
+            if not postings:
+                continue
+            idf = self.idf(term)
+            for i, tf in postings.items():
+                norm = self.k1 * (1 - self.b + self.b * self.lengths[i] / self.avg_length)
+                scores[i] += idf * tf * (self.k1 + 1) / (tf + norm)
+        return sorted(scores.items(), key=lambda x: -x[1])[:k]
+
+
+class HybridRetriever(BaseRetriever):
+    """dense retriever results fused with NgramBM25 results by reciprocal rank fusion"""
+
+    model_config = ConfigDict(arbitrary_types_allowed=True)
+
+    dense_retriever: BaseRetriever
+    lexical_index: NgramBM25
+    k: int = 3
+    lexical_k: int = 5
+    rrf_k: int = RRF_K
+
+    @classmethod
+    def from_documents(cls, dense_retriever: BaseRetriever, docs: list[Document], **kwargs):
+        return cls(dense_retriever=dense_retriever, lexical_index=NgramBM25(docs), **kwargs)
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun) -> list[Document]:
+        dense_docs = self.dense_retriever.invoke(query, config={"callbacks": run_manager.get_child()})
+        lexical_docs = [self.lexical_index.docs[i] for i, _ in self.lexical_index.search(query, self.lexical_k)]
+
+        scores = defaultdict(float)
+        by_key = {}
+        for ranked in (dense_docs, lexical_docs):
+            for rank, doc in enumerate(ranked):
+                key = doc_key(doc)
+                scores[key] += 1.0 / (self.rrf_k + rank + 1)
+                by_key.setdefault(key, doc)
+        best = sorted(scores, key=lambda key: -scores[key])[:self.k]
+        return [by_key[key] for key in best]
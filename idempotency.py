@@ -0,0 +1,176 @@
+import os
+import time
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from firebase_admin import db
+
+from instrumentation import inc
+
+
+# Constants
+
+DEDUP_TTL = float(os.environ.get("WEBHOOK_DEDUP_TTL", "3600"))  # 同一個 webhookEventId 記住多久（秒）
+DEDUP_MAX_ENTRIES = int(os.environ.get("WEBHOOK_DEDUP_MAX_ENTRIES", "100000"))
+DEDUP_BACKEND = os.environ.get("WEBHOOK_DEDUP_BACKEND", "memory")  # memory / firebase（多個 instance 共用）
+DEDUP_PATH = "/webhook_events"
+PRUNE_INTERVAL = 300  # 清理 Firebase 上過期 id 的最短間隔（秒）
+PRUNE_BATCH = 500
+
+ULID_CHARS = "0123456789ABCDEFGHJKMNPQRSTVWXYZ"  # Crockford base32
+
+# 清理舊紀錄不在 webhook 的路徑上
+_prune_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="dedup-prune")
+
+
+def ulid_prefix(ms: int) -> str:
+    """first 10 ULID characters (the millisecond timestamp), webhookEventIds sort by time"""
+    chars = []
+    for _ in range(10):
+        chars.append(ULID_CHARS[ms % 32])
+        ms //= 32
+    return "".join(reversed(chars))
+
+
+class EventDeduplicator:
+    """
+    Remembers webhookEventIds for ttl seconds so redelivered events are dropped before any work
+
+    ids are kept in a bounded in-memory LRU; with backend="firebase" an id is
+    also claimed with a transaction under /webhook_events, so a redelivery that
+    lands on another instance is dropped too; if Firebase fails the event is processed
+    """
+
+    def __init__(self, ttl: float = DEDUP_TTL, max_entries: int = DEDUP_MAX_ENTRIES, backend: str = DEDUP_BACKEND):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.backend = backend
+
+        self._lock = threading.Lock()
+        self._seen = OrderedDict()  # event id -> expires (monotonic)
+        self._last_prune = 0.0
+
+        self.accepted = 0
+        self.duplicates = 0     # 同一個 id 再次出現（丟棄）
+        self.redeliveries = 0   # deliveryContext.isRedelivery 為 true 的事件
+        self.released = 0       # 處理失敗、讓重送可以再處理的 id
+        self.backend_errors = 0
+
+    # local LRU
+
+    def _claim_local(self, event_id) -> bool:
+        now = time.monotonic()
+        with self._lock:
+            expires = self._seen.get(event_id)
+            if expires is not None and expires > now:
+                return False
+            self._seen[event_id] = now + self.ttl
+            self._seen.move_to_end(event_id)
+            # TTL 固定，最舊的 id 在最前面
+            while self._seen and (len(self._seen) > self.max_entries or next(iter(self._seen.values())) <= now):
+                self._seen.popitem(last=False)
+            return True
+
+    # shared backend
+
+    def _claim_firebase(self, event_id) -> bool:
+        now = time.time()
+        claimed = [False]
+
+        def claim(current):
+            # transaction 可能被重試，以最後一次的結果為準
+            if current and current.get("expires", 0) > now:
+                claimed[0] = False
+                return current
+            claimed[0] = True
+            return {"expires": now + self.ttl}
+
+        try:
+            db.reference(f"{DEDUP_PATH}/{event_id}").transaction(claim)
+        except Exception as e:
+            import logging
+            logging.exception(f"[Dedup Error] {str(e)}")
+            self.backend_errors += 1
+            return True
+        self._schedule_prune()
+        return claimed[0]
+
+    def _schedule_prune(self):
+        with self._lock:
+            if time.monotonic() - self._last_prune < PRUNE_INTERVAL:
+                return
+            self._last_prune = time.monotonic()
+        _prune_executor.submit(self._prune_quietly)
+
+    def _prune_quietly(self):
+        try:
+            self.prune()
+        except Exception as e:
+            import logging
+            logging.exception(f"[Dedup Prune Error] {str(e)}")
+
+    def prune(self) -> int:
+        """delete ids older than ttl from Firebase (keys are ULIDs, so no index is needed)"""
+        cutoff = ulid_prefix(int((time.time() - self.ttl) * 1000))
+        ref = db.reference(DEDUP_PATH)
+        old = ref.order_by_key().end_at(cutoff).limit_to_first(PRUNE_BATCH).get() or {}
+        if old:
+            ref.update({key: None for key in old})
+        return len(old)
+
+    # public
+
+    def claim(self, event_id, redelivery=False) -> bool:
+        """True the first time event_id is seen (process it), False for a duplicate (drop it)"""
+        if redelivery:
+            self.redeliveries += 1
+        if not event_id:
+            self.accepted += 1
+            inc("webhook_events_total", result="accepted")
+            return True
+        fresh = self._claim_local(event_id)
+        if fresh and self.backend == "firebase":
+            fresh = self._claim_firebase(event_id)
+        if fresh:
+            self.accepted += 1
+        else:
+            self.duplicates += 1
+        inc("webhook_events_total", result="accepted" if fresh else "duplicate")
+        return fresh
+
+    def claim_event(self, event) -> bool:
+        event_id = getattr(event, "webhook_event_id", None)
+        context = getattr(event, "delivery_context", None)
+        return self.claim(event_id, redelivery=bool(context and context.is_redelivery))
+
+    def release(self, event_id):
+        """forget event_id after a failed attempt, so LINE's redelivery is processed"""
+        if not event_id:
+            return
+        with self._lock:
+            self._seen.pop(event_id, None)
+        self.released += 1
+        if self.backend == "firebase":
+            try:
+                db.reference(f"{DEDUP_PATH}/{event_id}").delete()
+            except Exception as e:
+                import logging
+                logging.exception(f"[Dedup Error] {str(e)}")
+                self.backend_errors += 1
+
+    def stats(self) -> dict:
+        total = self.accepted + self.duplicates
+        return {
+            "backend": self.backend,
+            "tracked": len(self._seen),
+            "accepted": self.accepted,
+            "duplicates_dropped": self.duplicates,
+            "duplicate_rate": round(self.duplicates / total, 4) if total else 0.0,
+            "redeliveries": self.redeliveries,
+            "released": self.released,
+            "backend_errors": self.backend_errors,
+        }
+
+
+deduplicator = EventDeduplicator()
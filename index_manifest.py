@@ -0,0 +1,75 @@
+import os
+import json
+import hashlib
+
+from langchain.docstore.document import Document
+
+
+# Constants
+
+MANIFEST_FILE = "manifest.json"
+ADD_BATCH_SIZE = 64
+
+
+def chunk_hash(doc: Document) -> str:
+    """content hash of a chunk, also used as its id inside the vector store"""
+    source = doc.metadata.get("source", "")
+    return hashlib.sha1(f"{source}\n{doc.page_content}".encode("utf-8")).hexdigest()
+
+def manifest_path(persist_dir: str) -> str:
+    return os.path.join(persist_dir, MANIFEST_FILE)
+
+def load_manifest(persist_dir: str) -> dict:
+    path = manifest_path(persist_dir)
+    if not os.path.exists(path):
+        return {}
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+def save_manifest(persist_dir: str, manifest: dict) -> None:
+    os.makedirs(persist_dir, exist_ok=True)
+    path = manifest_path(persist_dir)
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=1)
+    os.replace(path + ".tmp", path)
+
+def sync_index(vector_store, docs: list[Document], persist_dir: str) -> dict:
+    """
+    make the vector store match docs, embedding only added / changed chunks
+
+    manifest format: {chunk_hash: source}
+    return value: {'added': int, 'removed': int, 'unchanged': int}
+    """
+    wanted = {}
+    for doc in docs:
+        h = chunk_hash(doc)
+        if h not in wanted:  # 相同內容的 chunk 只需要一份向量
+            wanted[h] = doc
+
+    manifest = load_manifest(persist_dir)
+    if not manifest:
+        # 舊版資料庫沒有 manifest，以資料庫內現有的 id 為準（舊 id 會全部被移除重建）
+        existing_ids = vector_store.get(include=[])["ids"]
+        manifest = {i: "" for i in existing_ids}
+
+    removed = [h for h in manifest if h not in wanted]
+    added = [h for h in wanted if h not in manifest]
+
+    if removed:
+        vector_store.delete(ids=removed)
+    for start in range(0, len(added), ADD_BATCH_SIZE):
+        batch = added[start:start + ADD_BATCH_SIZE]
+        vector_store.add_documents([wanted[h] for h in batch], ids=batch)
+
+    save_manifest(persist_dir, {h: doc.metadata.get("source", "") for h, doc in wanted.items()})
+
+    result = {"added": len(added), "removed": len(removed), "unchanged": len(wanted) - len(added)}
+    print(f"[DEBUG] 索引同步完成：新增 {result['added']}、刪除 {result['removed']}、未變更 {result['unchanged']}")
+    return result
+
+
+# reindex command: python index_manifest.py
+
+if __name__ == "__main__":
+    from rag_module import reindex
+    print(reindex())
@@ -0,0 +1,186 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+
+import numpy as np
+
+from answer_cache import corpus_fingerprint
+from index_manifest import sync_index
+from numpy_store import NumpyVectorStore, INDEX_DTYPE
+from regulations import REGULATION_FILES, read_rules, load_articles
+from section_index import SectionIndex, group_sections, SECTION_LEVEL
+
+
+# Constants
+
+INDEX_ROOT = os.environ.get("INDEX_ROOT", "./index_versions")  # python ingest.py 產生的版本化索引
+CURRENT_FILE = "CURRENT"            # 內容是目前上線的版本名稱
+VERSION_FILE = "version.json"
+DATA_DIR = "data"                   # 建索引用的 ./data 副本（答案快取依此判斷規章是否變更）
+RULES_DIR = "rules"                 # 出題 / fallback 用的規章原檔副本
+ALL_RULES_FILE = "all_rules.txt"
+SECTIONS_FILE = "sections.json"
+SECTIONS_MATRIX_FILE = "sections.npy"
+KEEP_VERSIONS = int(os.environ.get("INDEX_KEEP_VERSIONS", "5"))
+
+
+# layout: <INDEX_ROOT>/<version>/ is never modified after it is renamed into place,
+# <INDEX_ROOT>/CURRENT is replaced atomically to publish (or roll back to) a version
+
+def version_dir(version: str, root: str = INDEX_ROOT) -> str:
+    return os.path.join(root, version)
+
+def read_current(root: str = INDEX_ROOT):
+    try:
+        with open(os.path.join(root, CURRENT_FILE), encoding="utf-8") as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+def write_current(version: str, root: str = INDEX_ROOT) -> None:
+    if not os.path.exists(os.path.join(version_dir(version, root), VERSION_FILE)):
+        raise ValueError(f"index version {version} does not exist under {root}")
+    path = os.path.join(root, CURRENT_FILE)
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        f.write(version + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(path + ".tmp", path)
+
+def read_version_info(path: str) -> dict:
+    with open(os.path.join(path, VERSION_FILE), encoding="utf-8") as f:
+        return json.load(f)
+
+def list_versions(root: str = INDEX_ROOT) -> list[str]:
+    """complete versions, oldest first (names start with the build time)"""
+    if not os.path.isdir(root):
+        return []
+    return sorted(
+        name for name in os.listdir(root)
+        if not name.startswith(".") and os.path.exists(os.path.join(root, name, VERSION_FILE))
+    )
+
+def read_artifact(path: str) -> tuple:
+    """(all_rules, sections, sections_matrix) of a version, nothing is embedded"""
+    with open(os.path.join(path, ALL_RULES_FILE), encoding="utf-8") as f:
+        all_rules = f.read()
+    with open(os.path.join(path, SECTIONS_FILE), encoding="utf-8") as f:
+        sections = json.load(f)
+    return all_rules, sections, np.load(os.path.join(path, SECTIONS_MATRIX_FILE))
+
+
+# build
+
+def build_key(data_dir: str, rule_paths: list[str], settings: list) -> str:
+    """hash of everything a version depends on, an unchanged key means the latest version can be reused"""
+    h = hashlib.sha256(corpus_fingerprint(data_dir).encode("utf-8"))
+    for path in rule_paths:
+        with open(path, "rb") as f:
+            h.update(f.read())
+    h.update(json.dumps(settings).encode("utf-8"))
+    return h.hexdigest()
+
+def build(data_dir: str = "./data", rule_paths: list[str] = REGULATION_FILES, root: str = INDEX_ROOT,
+          force: bool = False) -> str:
+    """build an index version from data_dir and rule_paths, return its name (the latest one if nothing changed)"""
+    from rag_module import EMBED_MODEL_ID, CHUNK_SIZE, CHUNK_OVERLAP, ensure_data, generate_document, get_embeddings
+
+    ensure_data(data_dir)
+    key = build_key(data_dir, rule_paths, [EMBED_MODEL_ID, CHUNK_SIZE, CHUNK_OVERLAP, INDEX_DTYPE, SECTION_LEVEL])
+    versions = list_versions(root)
+    if versions and not force and read_version_info(version_dir(versions[-1], root)).get("build_key") == key:
+        print(f"[Ingest] 內容未變更，沿用 {versions[-1]}")
+        return versions[-1]
+
+    start = time.monotonic()
+    version = time.strftime("%Y%m%d-%H%M%S") + "-" + key[:8]
+    tmp = os.path.join(root, f".{version}.tmp")
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(os.path.join(tmp, DATA_DIR))
+    os.makedirs(os.path.join(tmp, RULES_DIR))
+
+    # 先複製來源，之後只讀副本，建索引途中 ./data 被改也不會混到兩個版本
+    for filename in sorted(os.listdir(data_dir)):
+        if filename.endswith(".txt"):
+            shutil.copy2(os.path.join(data_dir, filename), os.path.join(tmp, DATA_DIR, filename))
+    rules = [shutil.copy2(path, os.path.join(tmp, RULES_DIR, os.path.basename(path))) for path in rule_paths]
+
+    # chunk 向量：embedding 快取（embedding_cache.py）裡有的不再跑模型
+    embeddings = get_embeddings()
+    docs = generate_document(os.path.join(tmp, DATA_DIR))
+    store = NumpyVectorStore(embedding_function=embeddings, persist_directory=tmp)
+    sync_index(store, docs, tmp)
+
+    # fallback 用的章 / 條向量與出題用的全文
+    section_index = SectionIndex(group_sections(load_articles(rules), SECTION_LEVEL), embeddings)
+    with open(os.path.join(tmp, SECTIONS_FILE), "w", encoding="utf-8") as f:
+        json.dump(section_index.sections, f, ensure_ascii=False)
+    np.save(os.path.join(tmp, SECTIONS_MATRIX_FILE), section_index.matrix)
+    with open(os.path.join(tmp, ALL_RULES_FILE), "w", encoding="utf-8") as f:
+        f.write(read_rules(rules))
+
+    info = {
+        "version": version,
+        "build_key": key,
+        "created_at": time.time(),
+        "embed_model": EMBED_MODEL_ID,
+        "dtype": INDEX_DTYPE,
+        "chunk_size": CHUNK_SIZE,
+        "chunk_overlap": CHUNK_OVERLAP,
+        "section_level": SECTION_LEVEL,
+        "chunks": len(store.get()["ids"]),
+        "sections": len(section_index.sections),
+        "sources": sorted(os.listdir(os.path.join(tmp, DATA_DIR))),
+        "corpus_fingerprint": corpus_fingerprint(os.path.join(tmp, DATA_DIR)),
+        "build_s": round(time.monotonic() - start, 3),
+    }
+    with open(os.path.join(tmp, VERSION_FILE), "w", encoding="utf-8") as f:
+        json.dump(info, f, ensure_ascii=False, indent=1)
+
+    # 整個目錄寫完才改名，server 不會看到寫到一半的版本
+    os.rename(tmp, version_dir(version, root))
+    print(f"[Ingest] 已建立 {version}：{info['chunks']} 個 chunk、{info['sections']} 個章節，用時 {info['build_s']:.2f} 秒")
+    return version
+
+def prune(root: str = INDEX_ROOT, keep: int = KEEP_VERSIONS) -> list[str]:
+    """delete all but the newest `keep` versions, never the one CURRENT points at"""
+    current = read_current(root)
+    old = [v for v in list_versions(root)[:-keep or None] if v != current] if keep > 0 else []
+    for version in old:
+        shutil.rmtree(version_dir(version, root), ignore_errors=True)
+    return old
+
+
+# command: python ingest.py [--no-publish] [--force] | --publish <version> | --list
+
+if __name__ == "__main__":
+    import argparse
+
+    arg_parser = argparse.ArgumentParser(description="build a versioned index from ./data and publish it to running servers")
+    arg_parser.add_argument("--data", default="./data")
+    arg_parser.add_argument("--root", default=INDEX_ROOT)
+    arg_parser.add_argument("--force", action="store_true", help="build even if nothing changed")
+    arg_parser.add_argument("--no-publish", action="store_true", help="build only, leave CURRENT as it is")
+    arg_parser.add_argument("--publish", metavar="VERSION", help="point CURRENT at an existing version (rollback)")
+    arg_parser.add_argument("--list", action="store_true")
+    arg_parser.add_argument("--keep", type=int, default=KEEP_VERSIONS, help="versions to keep after publishing")
+    args = arg_parser.parse_args()
+
+    if args.list:
+        current = read_current(args.root)
+        for version in list_versions(args.root):
+            info = read_version_info(version_dir(version, args.root))
+            print(f"{'*' if version == current else ' '} {version}  {info['chunks']} chunks  {info['embed_model']}")
+    elif args.publish:
+        write_current(args.publish, args.root)
+        print(f"[Ingest] CURRENT -> {args.publish}")
+    else:
+        version = build(args.data, root=args.root, force=args.force)
+        if not args.no_publish:
+            write_current(version, args.root)
+            print(f"[Ingest] CURRENT -> {version}")
+            removed = prune(args.root, args.keep)
+            if removed:
+                print(f"[Ingest] 刪除舊版本：{', '.join(removed)}")
@@ -0,0 +1,261 @@
+import os
+import sys
+import json
+import time
+import threading
+import contextvars
+from contextlib import contextmanager, nullcontext
+
+from langchain_core.callbacks import BaseCallbackHandler
+
+
+# Constants
+
+METRICS_ENABLED = os.environ.get("METRICS_ENABLED", "1") == "1"
+TRACE_LOG = os.environ.get("TRACE_LOG", "")  # "" = 關閉, "stdout" 或檔案路徑：每個請求寫一行 JSON
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+PREFIX = "linebot"
+
+_current_trace = contextvars.ContextVar("trace", default=None)
+
+
+class Registry:
+    """counters and histograms rendered in the Prometheus text format"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}    # (name, labels) -> value
+        self._histograms = {}  # (name, labels) -> [bucket counts..., sum, count]
+        self._help = {}
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            entry = self._histograms.get(key)
+            if entry is None:
+                entry = self._histograms[key] = [0] * (len(BUCKETS) + 2)
+            for i, bound in enumerate(BUCKETS):
+                if value <= bound:
+                    entry[i] += 1
+            entry[-2] += value
+            entry[-1] += 1
+
+    def describe(self, name, text):
+        self._help[name] = text
+
+    def render(self) -> str:
+        lines = []
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted(self._histograms.items())
+        seen = set()
+        for (name, labels), value in counters:
+            full = f"{PREFIX}_{name}"
+            if full not in seen:
+                seen.add(full)
+                lines.append(f"# HELP {full} {self._help.get(name, name)}")
+                lines.append(f"# TYPE {full} counter")
+            lines.append(f"{full}{_labels(labels)} {value}")
+        for (name, labels), entry in histograms:
+            full = f"{PREFIX}_{name}"
+            if full not in seen:
+                seen.add(full)
+                lines.append(f"# HELP {full} {self._help.get(name, name)}")
+                lines.append(f"# TYPE {full} histogram")
+            for bound, count in zip(BUCKETS, entry):
+                lines.append(f"{full}_bucket{_labels(labels + (('le', str(bound)),))} {count}")
+            lines.append(f"{full}_bucket{_labels(labels + (('le', '+Inf'),))} {entry[-1]}")
+            lines.append(f"{full}_sum{_labels(labels)} {entry[-2]:.6f}")
+            lines.append(f"{full}_count{_labels(labels)} {entry[-1]}")
+        return "\n".join(lines) + "\n"
+
+
+def _labels(labels) -> str:
+    if not labels:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, v in labels)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(labels, escaped)) + "}"
+
+
+registry = Registry()
+registry.describe("span_duration_seconds", "Duration of each pipeline phase")
+registry.describe("span_errors_total", "Phases that raised an exception")
+registry.describe("rag_answers_total", "RAG answers by result (answered / unsure)")
+registry.describe("answer_cache_total", "Semantic answer cache lookups by result")
+registry.describe("embedding_cache_total", "Embedding cache lookups by result")
+registry.describe("llm_tokens_total", "OpenAI token usage by model and type")
+registry.describe("webhook_events_total", "Webhook events by result (accepted / duplicate)")
+registry.describe("singleflight_total", "Calls that ran (leader) or reused an in-flight result (follower)")
+registry.describe("faq_router_total", "FAQ router decisions (answer / suggest / miss)")
+registry.describe("fallback_prompt_tokens_total", "Prompt tokens sent to the GPT-4o-mini fallback")
+
+_trace_lock = threading.Lock()
+
+
+# public api
+
+def inc(name, value=1, **labels):
+    if METRICS_ENABLED:
+        registry.inc(name, value, **labels)
+
+def observe(name, value, **labels):
+    if METRICS_ENABLED:
+        registry.observe(name, value, **labels)
+
+def record_span(name, seconds, error=False, **attrs):
+    """record a phase measured elsewhere (e.g. by a LangChain callback)"""
+    if not METRICS_ENABLED:
+        return
+    registry.observe("span_duration_seconds", seconds, span=name)
+    if error:
+        registry.inc("span_errors_total", span=name)
+    trace = _current_trace.get()
+    if trace is not None:
+        record = {
+            "name": name,
+            "start_ms": round((time.perf_counter() - seconds - trace["start"]) * 1000, 1),
+            "ms": round(seconds * 1000, 1),
+            **attrs,
+        }
+        if error:
+            record["error"] = True
+        trace["spans"].append(record)
+
+def span(name, **attrs):
+    """time a phase: `with span("firebase.read"): ...`; a no-op when METRICS_ENABLED=0"""
+    if not METRICS_ENABLED:
+        # 每次給新的 dict：關閉時 `with span(...) as attrs` 仍可寫入，但不同請求 / thread 不會寫到同一份
+        return nullcontext({})
+    return _span(name, attrs)
+
+@contextmanager
+def _span(name, attrs):
+    start = time.perf_counter()
+    error = False
+    try:
+        yield attrs  # 呼叫端可以在 span 裡補上屬性
+    except BaseException:
+        error = True
+        raise
+    finally:
+        record_span(name, time.perf_counter() - start, error=error, **attrs)
+
+def trace(name, **attrs):
+    """
+    per-request root span: child spans are collected and, with TRACE_LOG set,
+    written as one JSON line when the request finishes
+    """
+    if not METRICS_ENABLED:
+        return nullcontext({})
+    return _trace(name, attrs)
+
+@contextmanager
+def _trace(name, attrs):
+    current = {"start": time.perf_counter(), "spans": []}
+    token = _current_trace.set(current)
+    error = False
+    try:
+        yield attrs
+    except BaseException:
+        error = True
+        raise
+    finally:
+        _current_trace.reset(token)
+        seconds = time.perf_counter() - current["start"]
+        record_span(name, seconds, error=error)
+        if TRACE_LOG:
+            write_trace({
+                "trace": name,
+                "ts": round(time.time(), 3),
+                "ms": round(seconds * 1000, 1),
+                "error": error,
+                **attrs,
+                "spans": current["spans"],
+            })
+
+def write_trace(record):
+    line = json.dumps(record, ensure_ascii=False, default=str)
+    with _trace_lock:
+        if TRACE_LOG == "stdout":
+            print(line, file=sys.stdout, flush=True)
+        else:
+            with open(TRACE_LOG, "a", encoding="utf-8") as f:
+                f.write(line + "\n")
+
+def record_tokens(model, usage):
+    """usage: OpenAI usage object or dict with prompt_tokens / completion_tokens"""
+    if not METRICS_ENABLED or not usage:
+        return
+    get = usage.get if isinstance(usage, dict) else lambda k: getattr(usage, k, None)
+    for kind in ("prompt_tokens", "completion_tokens"):
+        if get(kind):
+            registry.inc("llm_tokens_total", get(kind), model=model or "", type=kind.replace("_tokens", ""))
+
+def render() -> str:
+    return registry.render()
+
+def process_memory() -> dict:
+    """
+    memory of this process in MB; on Linux PSS splits pages shared with the
+    gunicorn master / other workers evenly, so summing pss_mb over workers is the real total
+    """
+    memory = {"pid": os.getpid()}
+    try:
+        with open("/proc/self/smaps_rollup") as f:
+            lines = f.read().splitlines()[1:]  # 第一行是位址範圍
+        kb = {key: int(value.split()[0]) for key, value in (line.split(":", 1) for line in lines)}
+        memory.update({
+            "rss_mb": round(kb.get("Rss", 0) / 1024, 1),
+            "pss_mb": round(kb.get("Pss", 0) / 1024, 1),
+            "shared_mb": round((kb.get("Shared_Clean", 0) + kb.get("Shared_Dirty", 0)) / 1024, 1),
+            "private_mb": round((kb.get("Private_Clean", 0) + kb.get("Private_Dirty", 0)) / 1024, 1),
+        })
+    except OSError:
+        import resource
+        memory["max_rss_mb"] = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+    return memory
+
+
+class SpanCallbackHandler(BaseCallbackHandler):
+    """LangChain callbacks -> "retrieval" / "llm" spans and token counters for chain.invoke"""
+
+    def __init__(self):
+        self._runs = {}  # run_id -> (span name, start)
+
+    def _start(self, run_id, name):
+        self._runs[run_id] = (name, time.perf_counter())
+
+    def _end(self, run_id, error=False, **attrs):
+        run = self._runs.pop(run_id, None)
+        if run is not None:
+            record_span(run[0], time.perf_counter() - run[1], error=error, **attrs)
+
+    def on_retriever_start(self, serialized, query, *, run_id, parent_run_id=None, **kwargs):
+        # hybrid retriever 內部的向量檢索另外記成 retrieval.dense
+        nested = parent_run_id in self._runs and self._runs[parent_run_id][0].startswith("retrieval")
+        self._start(run_id, "retrieval.dense" if nested else "retrieval")
+
+    def on_retriever_end(self, documents, *, run_id, **kwargs):
+        self._end(run_id, docs=len(documents))
+
+    def on_retriever_error(self, error, *, run_id, **kwargs):
+        self._end(run_id, error=True)
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, **kwargs):
+        self._start(run_id, "llm")
+
+    def on_llm_start(self, serialized, prompts, *, run_id, **kwargs):
+        self._start(run_id, "llm")
+
+    def on_llm_end(self, response, *, run_id, **kwargs):
+        output = response.llm_output or {}
+        self._end(run_id, model=output.get("model_name", ""))
+        record_tokens(output.get("model_name"), output.get("token_usage"))
+
+    def on_llm_error(self, error, *, run_id, **kwargs):
+        self._end(run_id, error=True)
@@ -0,0 +1,338 @@
+# replay signed LINE webhooks against a running app at increasing rates, with OpenAI / LINE / Firebase mocked locally
+# python loadtest.py --spawn "gunicorn -c gunicorn.conf.py main:app" --rates 2,5,10,20 --stage-seconds 30
+# python loadtest.py --target http://127.0.0.1:8080   (app already started with the env printed by mock_services.py)
+import os
+import json
+import time
+import hmac
+import uuid
+import base64
+import random
+import signal
+import asyncio
+import hashlib
+import argparse
+import subprocess
+from collections import defaultdict, deque
+
+import aiohttp
+import numpy as np
+
+from bench_pipeline import QUESTIONS
+from idempotency import ulid_prefix
+from mock_services import start_mocks
+
+
+# Constants
+
+PENDING_TEXTS = ("思考中", "生成試題中")  # 先 reply 提示、答案之後才 push 的訊息
+BUSY_TEXTS = ("詢問的人數較多", "規章寶剛啟動")
+ERROR_TEXTS = ("⚠️", "伺服器錯誤")
+DEGRADED_TEXT = "⏱️"  # main.DEGRADED_TEXT：時間不夠，改送條文（仍算 ok，另外計數）
+ULID_CHARS = "0123456789ABCDEFGHJKMNPQRSTVWXYZ"
+
+
+def webhook_event_id() -> str:
+    return ulid_prefix(int(time.time() * 1000)) + "".join(random.choice(ULID_CHARS) for _ in range(16))
+
+
+def build_event(user_id: str, text: str) -> dict:
+    return {
+        "type": "message",
+        "mode": "active",
+        "timestamp": int(time.time() * 1000),
+        "source": {"type": "user", "userId": user_id},
+        "webhookEventId": webhook_event_id(),
+        "deliveryContext": {"isRedelivery": False},
+        "replyToken": uuid.uuid4().hex,
+        "message": {"type": "text", "id": str(random.randrange(10 ** 17)), "quoteToken": uuid.uuid4().hex, "text": text},
+    }
+
+
+def sign(body: bytes, channel_secret: str) -> str:
+    return base64.b64encode(hmac.new(channel_secret.encode("utf-8"), body, hashlib.sha256).digest()).decode("utf-8")
+
+
+class Workload:
+    """picks the next (user, text): mostly regulation questions, plus FAQ taps, quizzes and quiz answers"""
+
+    def __init__(self, users: int, faq_keys, mix: dict, seed: int = 0):
+        self.rng = random.Random(seed)
+        self.users = [f"Uloadtest{i:05d}" for i in range(users)]
+        self.faq_keys = list(faq_keys) or QUESTIONS
+        self.kinds = list(mix)
+        self.weights = [mix[k] for k in self.kinds]
+        self.in_quiz = set()
+
+    def next(self):
+        user_id = self.rng.choice(self.users)
+        kind = self.rng.choices(self.kinds, self.weights)[0]
+        if kind == "answer" and user_id not in self.in_quiz:
+            kind = "quiz"
+        if kind == "quiz":
+            self.in_quiz.add(user_id)
+            return user_id, kind, "測驗"
+        if kind == "answer":
+            self.in_quiz.discard(user_id)
+            return user_id, kind, self.rng.choice("ABC")
+        if kind == "faq":
+            return user_id, kind, self.rng.choice(self.faq_keys)
+        return user_id, kind, self.rng.choice(QUESTIONS)
+
+
+class Tracker:
+    """
+    Matches LINE calls seen by the mock back to the webhook event that caused them
+
+    a reply is matched by its reply token; a "思考中" / "生成試題中" reply means the
+    answer comes later as a push, matched to that user's oldest waiting event
+    """
+
+    def __init__(self):
+        self.events = {}                     # reply token -> record
+        self.waiting = defaultdict(deque)    # user id -> tokens waiting for a push
+
+    def sent(self, token, user_id, kind, stage, sent_at):
+        self.events[token] = {"user": user_id, "kind": kind, "stage": stage, "sent": sent_at,
+                              "status": None, "outcome": None, "done": None}
+
+    def on_line(self, call, key, received, texts):
+        text = "\n".join(texts)
+        if call == "reply":
+            record = self.events.get(key)
+            if record is None:
+                return
+            if any(t in text for t in PENDING_TEXTS):
+                self.waiting[record["user"]].append(key)
+                return
+            self._finish(record, received, text)
+        else:
+            queue = self.waiting.get(key)
+            if queue:
+                self._finish(self.events[queue.popleft()], received, text)
+
+    @staticmethod
+    def _finish(record, received, text):
+        if any(t in text for t in BUSY_TEXTS):
+            record["outcome"] = "busy"
+        elif any(t in text for t in ERROR_TEXTS):
+            record["outcome"] = "error_reply"
+        else:
+            record["outcome"] = "ok"
+            record["degraded"] = DEGRADED_TEXT in text
+        record["done"] = received
+
+    def stage_records(self, stage):
+        return [r for r in self.events.values() if r["stage"] == stage]
+
+
+def summarize(records, rate, started, sent_seconds) -> dict:
+    ok = [r for r in records if r["outcome"] == "ok"]
+    latencies = np.array([r["done"] - r["sent"] for r in ok]) * 1000
+    last_done = max((r["done"] for r in ok), default=started)
+    total = len(records)
+
+    def count(outcome):
+        return sum(1 for r in records if r["outcome"] == outcome)
+
+    http_errors = sum(1 for r in records if r["status"] != 200)
+    timeouts = sum(1 for r in records if r["outcome"] is None and r["status"] == 200)
+    failed = http_errors + count("busy") + count("error_reply") + timeouts
+    return {
+        "target_rps": rate,
+        "sent": total,
+        "sent_rps": round(total / sent_seconds, 2) if sent_seconds else 0.0,
+        "sustained_rps": round(len(ok) / (last_done - started), 2) if ok and last_done > started else 0.0,
+        "ok": len(ok),
+        "p50_ms": round(float(np.percentile(latencies, 50)), 1) if len(ok) else None,
+        "p95_ms": round(float(np.percentile(latencies, 95)), 1) if len(ok) else None,
+        "p99_ms": round(float(np.percentile(latencies, 99)), 1) if len(ok) else None,
+        "http_errors": http_errors,
+        "degraded": sum(1 for r in ok if r.get("degraded")),
+        "busy": count("busy"),
+        "error_replies": count("error_reply"),
+        "timeouts": timeouts,
+        "error_rate": round(failed / total, 4) if total else 0.0,
+    }
+
+
+async def wait_ready(session, target, timeout, process=None):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process is not None and process.poll() is not None:
+            raise RuntimeError(f"app exited with code {process.returncode}")
+        try:
+            async with session.get(f"{target}/ready") as resp:
+                if resp.status == 200:
+                    return
+        except aiohttp.ClientError:
+            pass
+        await asyncio.sleep(1)
+    raise RuntimeError(f"{target}/ready not 200 after {timeout}s")
+
+
+async def stop_app(process, timeout=30):
+    # shell 會先結束，要等整個 process group 退出；期間 mock 還在，app 可以把 session 寫回 Firebase
+    os.killpg(process.pid, signal.SIGTERM)
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            os.killpg(process.pid, 0)
+        except ProcessLookupError:
+            break
+        await asyncio.sleep(0.2)
+    else:
+        os.killpg(process.pid, signal.SIGKILL)
+    process.wait()
+
+
+async def post_event(session, target, channel_secret, tracker, workload, stage):
+    user_id, kind, text = workload.next()
+    event = build_event(user_id, text)
+    body = json.dumps({"destination": "Uloadtest", "events": [event]}, ensure_ascii=False).encode("utf-8")
+    token = event["replyToken"]
+    tracker.sent(token, user_id, kind, stage, time.perf_counter())
+    try:
+        async with session.post(f"{target}/callback", data=body, headers={
+            "Content-Type": "application/json",
+            "X-Line-Signature": sign(body, channel_secret),
+        }) as resp:
+            tracker.events[token]["status"] = resp.status
+    except (aiohttp.ClientError, asyncio.TimeoutError):
+        tracker.events[token]["status"] = 0
+
+
+async def run_stage(session, args, tracker, workload, stage, rate) -> dict:
+    # open loop：按時間表送出，不等前一個請求完成，才量得到排隊造成的延遲
+    started = time.perf_counter()
+    count = int(rate * args.stage_seconds)
+    tasks = []
+    for i in range(count):
+        delay = started + i / rate - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        tasks.append(asyncio.create_task(post_event(session, args.target, args.channel_secret, tracker, workload, stage)))
+    sent_seconds = time.perf_counter() - started
+    await asyncio.gather(*tasks)
+
+    # 等還沒收到 reply / push 的事件，最多 drain 秒
+    deadline = time.perf_counter() + args.drain
+    while time.perf_counter() < deadline:
+        if all(r["outcome"] is not None or r["status"] != 200 for r in tracker.stage_records(stage)):
+            break
+        await asyncio.sleep(0.2)
+    return summarize(tracker.stage_records(stage), rate, started, sent_seconds)
+
+
+def print_row(result):
+    def ms(value):
+        return f"{value:>8.0f}" if value is not None else f"{'-':>8}"
+    print(f"{result['target_rps']:>7} {result['sent_rps']:>8} {result['sustained_rps']:>10} "
+          f"{ms(result['p50_ms'])} {ms(result['p95_ms'])} {ms(result['p99_ms'])} "
+          f"{result['degraded']:>8} {result['http_errors']:>5} {result['busy']:>5} {result['error_replies']:>6} "
+          f"{result['timeouts']:>8}")
+
+
+async def main(args):
+    mocks, runners, env = await start_mocks(args.openai_ms, args.line_ms, args.firebase_ms,
+                                            fallback_rate=args.fallback_rate, openai_error_rate=args.openai_error_rate)
+    tracker = Tracker()
+    mocks["line"].listeners.append(tracker.on_line)
+
+    process = None
+    if args.spawn:
+        # 自己一個 process group，結束時連 shell 底下的 gunicorn master 一起送 SIGTERM
+        process = subprocess.Popen(args.spawn, shell=True, start_new_session=True,
+                                   env={**os.environ, **env, "PORT": str(args.port)})
+    else:
+        print("app should be running with: " + " ".join(f"{k}={v}" for k, v in env.items()))
+
+    workload = Workload(args.users, faq_keys(), {"question": args.mix[0], "faq": args.mix[1],
+                                                 "quiz": args.mix[2], "answer": args.mix[3]}, args.seed)
+    results = []
+    try:
+        timeout = aiohttp.ClientTimeout(total=args.http_timeout)
+        connector = aiohttp.TCPConnector(limit=0)
+        async with aiohttp.ClientSession(timeout=timeout, connector=connector) as session:
+            await wait_ready(session, args.target, args.ready_timeout, process)
+            print(f"{'rps':>7} {'sent/s':>8} {'sustained':>10} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} "
+                  f"{'degraded':>8} {'http':>5} {'busy':>5} {'error':>6} {'timeout':>8}")
+            for stage, rate in enumerate(args.rates):
+                result = await run_stage(session, args, tracker, workload, stage, rate)
+                results.append(result)
+                print_row(result)
+                if result["error_rate"] > args.max_error_rate:
+                    print(f"stop: error rate {result['error_rate']} > {args.max_error_rate}")
+                    break
+                if args.max_p95 and (result["p95_ms"] is None or result["p95_ms"] > args.max_p95):
+                    print(f"stop: p95 {result['p95_ms']} ms > {args.max_p95} ms")
+                    break
+    finally:
+        if process is not None:
+            await stop_app(process)
+        for runner in runners:
+            await runner.cleanup()
+
+    passing = [r for r in results if r["error_rate"] <= args.max_error_rate
+               and (not args.max_p95 or (r["p95_ms"] is not None and r["p95_ms"] <= args.max_p95))]
+    report = {
+        "target": args.target,
+        "stage_seconds": args.stage_seconds,
+        "users": args.users,
+        "mocks": {"openai_ms": args.openai_ms, "line_ms": args.line_ms, "firebase_ms": args.firebase_ms},
+        "stages": results,
+        "max_sustained_rps": max((r["sustained_rps"] for r in passing), default=0.0),
+        "service_calls": {name: mock.stats() for name, mock in mocks.items()},
+    }
+    print(f"max sustained: {report['max_sustained_rps']} req/s")
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"report written to {args.out}")
+
+
+def faq_keys():
+    try:
+        from config import FAQ_ANSWERS
+        return FAQ_ANSWERS.keys()
+    except ImportError:
+        return []
+
+
+def default_channel_secret():
+    try:
+        from config import CHANNEL_SECRET
+        return CHANNEL_SECRET
+    except ImportError:
+        return os.environ.get("CHANNEL_SECRET", "")
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="open-loop webhook load test against local service mocks")
+    arg_parser.add_argument("--target", default=None, help="app base url (default http://127.0.0.1:<port>)")
+    arg_parser.add_argument("--port", type=int, default=8080)
+    arg_parser.add_argument("--spawn", default=None, help="command that starts the app, run with the mock env")
+    arg_parser.add_argument("--rates", default="1,2,5,10,20", help="comma separated requests/s, one stage each")
+    arg_parser.add_argument("--stage-seconds", type=float, default=30)
+    arg_parser.add_argument("--drain", type=float, default=60, help="seconds to wait for pushes after a stage")
+    arg_parser.add_argument("--users", type=int, default=50)
+    arg_parser.add_argument("--mix", default="0.7,0.1,0.1,0.1", help="question,faq,quiz,answer weights")
+    arg_parser.add_argument("--max-error-rate", type=float, default=0.01)
+    arg_parser.add_argument("--max-p95", type=float, default=0, help="stop once p95 ms exceeds this (0 = off)")
+    arg_parser.add_argument("--openai-ms", type=float, default=800)
+    arg_parser.add_argument("--line-ms", type=float, default=50)
+    arg_parser.add_argument("--firebase-ms", type=float, default=30)
+    arg_parser.add_argument("--fallback-rate", type=float, default=0.2)
+    arg_parser.add_argument("--openai-error-rate", type=float, default=0.0)
+    arg_parser.add_argument("--http-timeout", type=float, default=30)
+    arg_parser.add_argument("--ready-timeout", type=float, default=300)
+    arg_parser.add_argument("--channel-secret", default=None)
+    arg_parser.add_argument("--seed", type=int, default=0)
+    arg_parser.add_argument("--out", default=None, help="write the JSON report here")
+    args = arg_parser.parse_args()
+
+    args.target = (args.target or f"http://127.0.0.1:{args.port}").rstrip("/")
+    args.rates = [float(r) for r in args.rates.split(",")]
+    args.mix = [float(w) for w in args.mix.split(",")]
+    args.channel_secret = args.channel_secret or default_channel_secret()
+    asyncio.run(main(args))
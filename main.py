@@ -1,29 +1,61 @@
 # import functions_framework
+from warmup import Warmer  # 最先 import，記錄 import-to-ready 的起點
 from flask import Flask, abort, request
-from linebot.v3 import WebhookHandler
+from linebot.v3 import WebhookParser
 from linebot.v3.exceptions import InvalidSignatureError
-from linebot.v3.messaging import Configuration, ApiClient, MessagingApi, ReplyMessageRequest, TextMessage, FlexMessage, PushMessageRequest
-from linebot.v3.messaging.models import FlexContainer, QuickReply, QuickReplyItem, MessageAction, ImageMessage
+from linebot.v3.messaging import ReplyMessageRequest, TextMessage, FlexMessage, PushMessageRequest
+from linebot.v3.messaging.models import FlexContainer, QuickReply, QuickReplyItem, MessageAction
 from linebot.v3.webhooks import MessageEvent, TextMessageContent, FollowEvent
 
-import threading
-import requests
 import os
 import time
+import random
+from concurrent.futures import ThreadPoolExecutor
 
 # Key
-from config import ACCESS_TOKEN, CHANNEL_SECRET, OPENAI_API_KEY, FIREBASE_URL, FAQ_FLEX_JSON, FAQ_ANSWERS, TUTORIAL_CAROUSEL
+from config import CHANNEL_SECRET, FIREBASE_URL, FAQ_FLEX_JSON, FAQ_ANSWERS, TUTORIAL_CAROUSEL
 
 # generate the quiz
-from generate import generate_quiz_question, format_options
+from generate import generate_quiz_question
+from quiz_bank import QuizBank, quiz_articles, format_bank_options, REFILL_THRESHOLD
 
 # RAG
-from rag_module import get_response
+from rag_module import (
+    get_response, get_cache_stats, get_embedding_cache_stats, get_section_index, get_all_rules, get_index_status,
+    warm_up_steps,
+)
+from section_index import count_tokens, format_sections
+from conversation import prepare_turn
+from faq_router import ROUTER_ENABLED as FAQ_ROUTER_ENABLED, get_faq_router, get_faq_router_stats
+
+# process-wide pooled LINE / OpenAI clients
+from clients import get_line_bot_api, get_openai_client, stats as client_stats
+from openai import APIStatusError, APIConnectionError, APITimeoutError
+
+# spans / Prometheus metrics
+from instrumentation import trace, span, inc, record_tokens, process_memory, render as render_metrics
+
+# worker pool
+from dispatcher import Dispatcher
+
+# per-question time budget, phases take a cheaper path instead of running past it
+from deadline import Deadline, FALLBACK_MIN, FALLBACK_TIMEOUT
+
+# LINE 重送（同一個 webhookEventId）的事件只處理一次
+from idempotency import deduplicator
+
+# 同時間相同的提問只跑一次 RAG / fallback
+from singleflight import SingleFlight, flight_key
+
+# session state (chat memory / quiz), cached in memory and written back to Firebase in batches
+from session_store import (
+    sessions, get_memory, append_memory, clear_memory, get_current_quiz, set_current_quiz,
+    delete_current_quiz, get_asked_questions, push_quiz_history, clear_quiz_history,
+)
 
 # Firebase
-import json
 import firebase_admin
-from firebase_admin import credentials, db
+from firebase_admin import credentials
 
 cred = credentials.Certificate("firebase_service_key.json")
 if not firebase_admin._apps:
@@ -33,19 +65,53 @@ if not firebase_admin._apps:
 
 # constant
 MAX_HISTORY = 5  # 上下文限制頁數
-
-# read rules 
-with open("Donation-charter.txt", encoding="utf-8") as f:
-    donation_rules = f.read()
-
-with open("Integrity-norm.txt", encoding="utf-8") as f:
-    integrity_rules = f.read()
-
-all_rules = donation_rules + "\n" + integrity_rules
-
-# lineBot Setup
-configuration = Configuration(access_token=ACCESS_TOKEN)
-handler = WebhookHandler(CHANNEL_SECRET)
+BUSY_TEXT = "⚠️ 目前詢問的人數較多，請稍後再試一次！"
+ERROR_TEXT = "⚠️ 很抱歉，目前暫時無法取得規章資訊，請稍後再試。"
+QUIZ_ERROR_TEXT = "⚠️ 很抱歉，目前無法出題，請稍後再試！"
+WARMING_TEXT = "⏳ 規章寶剛啟動，正在載入規章資料，請約一分鐘後再問一次！"
+DEGRADED_TEXT = "⏱️ 目前回覆較慢，先提供最相關的規章條文，完整內容請參考原文。"
+FALLBACK_MODEL = "gpt-4o-mini"
+WEBHOOK_WORKERS = int(os.environ.get("WEBHOOK_WORKERS", "8"))  # 同一個 webhook 內的事件同時處理
+
+INTEGRITY_LINK = "https://drive.google.com/file/d/1NGgZy4wi9Q69YNgTGcxEN0bScwu5Nzo4/view?usp=sharing"
+DONATION_LINK = "https://drive.google.com/file/d/1foZjFAlnAK9g2sQaBO5yzQ3Lip0LmMMO/view?usp=sharing"
+REFERENCE_TERMS = [  "條文", "條款", "條項", "法條", "細則",
+                     "規定", "規範", "規約", "守則", "規矩", "限制", "辦法", "要求", "條件",
+                     "章節", "段落", "部分", "節次", "子章", "篇章",
+                     "條例", "法律", "法規", "規則", "準則", "措施", "制度",
+                     "規章", "章程", "章則", "會章", "組織章程", "規章制度"]
+
+WELCOME_TEXT = (
+    "👋 歡迎加入博幼規章寶！\n\n"
+    "我是你的規章智慧小幫手，幫你快速查詢基金會各項規章制度和工作流程 📚\n\n"
+    "你可以這樣使用我：\n"
+    "🔍 輸入問題查詢規章（例如：我可以請幾天病假？）\n"
+    "📄 查看你過去查詢的紀錄\n"
+    "📸 上傳流程紀錄照片（像是文件、現場紀錄）\n"
+    "🎓 觀看使用教學與常見問答\n\n"
+    "不確定從哪開始？直接輸入問題就對了！\n\n"
+    "別緊張，我相信你很快就會上手的。"
+)
+
+# lineBot Setup（MessagingApi 由 clients.get_line_bot_api() 共用連線池）
+parser = WebhookParser(CHANNEL_SECRET)
+webhook_executor = ThreadPoolExecutor(max_workers=WEBHOOK_WORKERS, thread_name_prefix="webhook")
+
+# 預先生成的題庫，題目用完才即時呼叫 GPT 出題
+quiz_bank = QuizBank()
+bank_articles = quiz_articles()
+
+# embedding 模型、向量庫與 chain 在背景載入，載入完成前的提問直接回覆「暖機中」
+warmer = Warmer(warm_up_steps() + ([("faq router", get_faq_router)] if FAQ_ROUTER_ENABLED else []))
+if os.environ.get("WARMUP_DEFER") != "1":
+    # gunicorn（gunicorn.conf.py）改在 master fork 之前同步暖機，讓 worker 共用載入好的模型
+    warmer.start()
+
+# GPT / quiz 工作都交給固定大小的 worker pool，同一位使用者的訊息依序處理
+dispatcher = Dispatcher()
+
+# 公告發出後很多人同時問同一題：不是追問的相同提問共用一次 RAG / fallback 呼叫
+flight = SingleFlight()
 
 # Flask app for Cloud Run
 app = Flask(__name__)
@@ -56,7 +122,7 @@ def callback():
     body = request.get_data(as_text=True)
 
     try:
-        handler.handle(body, signature)
+        events = parser.parse(body, signature)
     except InvalidSignatureError:
         abort(400)
     except Exception as e:
@@ -64,85 +130,358 @@ def callback():
         logging.exception(f"[Webhook Crash] {str(e)}")
         abort(500)
 
+    # 逾時重送的事件在做任何事之前就丟掉，不會重跑 RAG、重複推播
+    events = [event for event in events if deduplicator.claim_event(event)]
+    if len(events) <= 1:
+        results = [handle_event(event) for event in events]
+    else:
+        results = list(webhook_executor.map(handle_event, events))
+    if not all(results):
+        # 讓 LINE 重送，失敗的事件已從去重紀錄移除
+        abort(500)
+
     return "OK"
 
+@app.route("/healthz", methods=['GET'])
+def healthz():
+    return {"status": "ok", "uptime_s": warmer.status()["uptime_s"]}
+
+@app.route("/ready", methods=['GET'])
+def ready():
+    return warmer.status(), 200 if warmer.ready() else 503
+
+@app.route("/metrics", methods=['GET'])
+def metrics():
+    return render_metrics(), 200, {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+
+@app.route("/stats", methods=['GET'])
+def stats():
+    return {
+        "answer_cache": get_cache_stats(),
+        "embedding_cache": get_embedding_cache_stats(),
+        "faq_router": get_faq_router_stats(),
+        "dispatcher": dispatcher.stats(),
+        "webhook_dedup": deduplicator.stats(),
+        "singleflight": flight.stats(),
+        "index": get_index_status(),
+        "sessions": sessions.stats(),
+        "http": client_stats(),
+        "warmup": warmer.status(),
+        "process": process_memory(),
+    }
+
+
+def handle_event(event) -> bool:
+    """run the handler for one webhook event, return False (and release its id) when it raised"""
+    try:
+        if isinstance(event, FollowEvent):
+            handle_follow(event)
+        elif isinstance(event, MessageEvent) and isinstance(event.message, TextMessageContent):
+            handle_message(event)
+        return True
+    except Exception as e:
+        import logging
+        logging.exception(f"[Webhook Crash] {str(e)}")
+        deduplicator.release(getattr(event, "webhook_event_id", None))
+        return False
 
 # welcome message
-@handler.add(FollowEvent)
 def handle_follow(event):
-    welcome_text = (
-        "👋 歡迎加入博幼規章寶！\n\n"
-        "我是你的規章智慧小幫手，幫你快速查詢基金會各項規章制度和工作流程 📚\n\n"
-        "你可以這樣使用我：\n"
-        "🔍 輸入問題查詢規章（例如：我可以請幾天病假？）\n"
-        "📄 查看你過去查詢的紀錄\n"
-        "📸 上傳流程紀錄照片（像是文件、現場紀錄）\n"
-        "🎓 觀看使用教學與常見問答\n\n"
-        "不確定從哪開始？直接輸入問題就對了！\n\n"
-        "別緊張，我相信你很快就會上手的。"
-    )
-
-    with ApiClient(configuration) as api_client:
-        line_bot_api = MessagingApi(api_client)
-        line_bot_api.reply_message_with_http_info(
-            ReplyMessageRequest(
-                reply_token=event.reply_token,
-                messages=[TextMessage(text=welcome_text)]
-            )
+    line_bot_api = get_line_bot_api()
+    line_bot_api.reply_message_with_http_info(
+        ReplyMessageRequest(
+            reply_token=event.reply_token,
+            messages=[TextMessage(text=WELCOME_TEXT)]
         )
+    )
 
-# 使用者訊息處理函數，仍由 LINE SDK 呼叫
-@handler.add(MessageEvent, message=TextMessageContent)
+# 使用者訊息處理函數
 def handle_message(event):
 
-    # 開新 thread 處理 GPT
+    # 交給 worker pool 處理 GPT
     user_input = event.message.text.strip()
+    user_id = getattr(event.source, 'user_id', None)
     if user_input == "測驗":
+        # 再交給 worker 處理 quiz（背景非同步）
+        if not dispatcher.submit(user_id, generate_quiz_and_push, user_id):
+            reply_busy(event.reply_token)
+            return
         # 先回覆提示訊息 ✅ 這樣 LINE 收到 reply 會立即顯示
-        with ApiClient(configuration) as api_client:
-            line_bot_api = MessagingApi(api_client)
-            line_bot_api.reply_message_with_http_info(
-                ReplyMessageRequest(
-                    reply_token=event.reply_token,
-                    messages=[TextMessage(text="✏️ 生成試題中，請稍候...")]
-                )
+        line_bot_api = get_line_bot_api()
+        line_bot_api.reply_message_with_http_info(
+            ReplyMessageRequest(
+                reply_token=event.reply_token,
+                messages=[TextMessage(text="✏️ 生成試題中，請稍候...")]
             )
-        # 再開 thread 處理 quiz（背景非同步）
-        user_id = getattr(event.source, 'user_id', None)
-        threading.Thread(target=generate_quiz_and_push, args=(user_id,)).start()
+        )
         return
-    
-    threading.Thread(target=process_gpt_and_push, args=(event,)).start()
 
-def get_memory(user_id):
-    ref = db.reference(f"/chat_memory/{user_id}")
-    raw_data = ref.get()
-    if not raw_data:
-        return []
+    # 從收到 webhook 開始計時，排隊等待也算在預算內
+    if not dispatcher.submit(user_id, process_gpt_and_push, event, Deadline()):
+        reply_busy(event.reply_token)
+
+def reply_busy(reply_token):
+    # 佇列已滿，直接請使用者稍後再試，不再排隊
+    line_bot_api = get_line_bot_api()
+    line_bot_api.reply_message_with_http_info(
+        ReplyMessageRequest(
+            reply_token=reply_token,
+            messages=[TextMessage(text=BUSY_TEXT)]
+        )
+    )
+
+def pick_bank_quiz(asked_questions):
+    """return (question, options, answer) from the quiz bank, or None when the user has seen all of it"""
+    unseen = quiz_bank.unseen(asked_questions)
+    if len(unseen) <= REFILL_THRESHOLD:
+        quiz_bank.refill_in_background(bank_articles)
+    if not unseen:
+        return None
+    item = random.choice(unseen)
+    return item["question"], format_bank_options(item), item["answer"]
+
+def save_current_quiz(user_id, question, answer):
+    push_quiz_history(user_id, question)
+    set_current_quiz(user_id, question, answer)
+
+
+#### SPECIAL CASE START ####
+
+def check_quiz_answer(user_id, user_input):
+    quiz_data = get_current_quiz(user_id)
+
+    if not quiz_data:
+        return TextMessage(text="⚠️ 沒有正在進行的題目喔～請輸入「測驗」開始答題！")
+
+    correct = quiz_data["answer"].strip().upper()
+    if user_input.upper() == correct:
+        reply_text = "✅ 恭喜你答對了！"
+    else:
+        reply_text = f"❌ 答錯了，正確答案是 {correct}"
+    delete_current_quiz(user_id)
+    quick_reply = QuickReply(
+        items=[
+            QuickReplyItem(action=MessageAction(label="📘 下一題", text="測驗")),
+            QuickReplyItem(action=MessageAction(label="🛑 結束測驗", text="結束測驗"))
+        ]
+    )
+    return TextMessage(text=reply_text, quick_reply=quick_reply)
+
+def special_case_messages(user_id, user_input):
+    """
+    handle fixed commands and FAQ taps (Firebase side effects included)
+    return the messages to reply, or None when user_input should go through RAG
+    """
+    # 若使用者輸入結束，清除記憶
+    if user_input == "結束":
+        clear_memory(user_id)
+        return [TextMessage(text="✅ 已結束本次問題，我不會再記住剛剛的對話內容囉！")]
+
+    if user_input == "繼續":
+        return [TextMessage(text="請問還有什麼想要詢問的呢？")]
+
+    if user_input == "常見問題":
+        return [FlexMessage(
+            alt_text="📋 常見問題選單",
+            contents=FlexContainer.from_dict(FAQ_FLEX_JSON)
+        )]
+
+    # 若使用者輸入結束測驗，清除測驗記憶
+    if user_input == "結束測驗":
+        clear_memory(user_id)
+        clear_quiz_history(user_id)
+        return [TextMessage(text="✅ 測驗已結束，感謝你的作答！")]
+
+    # 若是常見問題之一，則回覆固定答案
+    if user_input in FAQ_ANSWERS:
+        answer = FAQ_ANSWERS[user_input]
+        append_memory(user_id, user_input, answer)
+        return [TextMessage(text=answer)]
+
+    if user_input == "使用教學":
+        return [FlexMessage(
+            alt_text="📖 使用教學圖片",
+            contents=FlexContainer.from_dict(TUTORIAL_CAROUSEL)
+        )]
+
+    if user_input in ["A", "B", "C"]:
+        return [check_quiz_answer(user_id, user_input)]
+
+    return None
+
+def route_faq(user_input):
+    """nearest FAQ for user_input (see faq_router.FaqRouter.route), None when the router is off or fails"""
+    if not FAQ_ROUTER_ENABLED:
+        return None
     try:
-        # 排序 key（Firebase 的 push key 可排序），轉 list
-        sorted_items = sorted(raw_data.items())  # [(key1, {...}), (key2, {...})...]
-        return [item[1] for item in sorted_items]  # 取 value list
+        return get_faq_router().route(user_input)
     except Exception as e:
         import logging
-        logging.exception(f"[Memory Parse Error] {str(e)}")
-        return []
+        logging.exception(f"[FAQ Router Error] {str(e)}")
+        return None
 
-def append_memory(user_id, user_text, bot_text):
-    ref = db.reference(f"/chat_memory/{user_id}")
-    ref.push({"user": user_text, "bot": bot_text})
+#### SPECIAL CASE END ####
 
-def clear_memory(user_id):
-    db.reference(f"/chat_memory/{user_id}").delete()
 
+#### ANSWER HELPERS ####
 
+def needs_fallback(res):
+    return "unsure" in res["answer"].lower()
 
-# welcome messages
-def process_gpt_and_push(event):
+def fallback_messages(history_context, user_input, retrieval_query=None):
+    # 只帶最相關的幾個完整章 / 條，不再送整份 all_rules
+    with span("fallback.prompt") as attrs:
+        section_index = get_section_index()
+        rules_text = format_sections(section_index.select(retrieval_query or user_input))
+        prompt = (
+            "你是博幼基金會的規章專家，請根據條文內容與使用者上下文進行回答，請避免捏造內容, 可提供你是參考什麼原文。\n"
+            f"條文如下：\n{rules_text}\n\n對話歷史：\n{history_context}\n\n使用者提問：{user_input}"
+        )
+        # token 數記在 trace 上；累計值除以 span 次數就是平均 prompt 大小
+        attrs["prompt_tokens"] = count_tokens(prompt)
+        attrs["rules_tokens"] = count_tokens(rules_text)
+        attrs["all_rules_tokens"] = section_index.total_tokens()
+        inc("fallback_prompt_tokens_total", attrs["prompt_tokens"])
+    return [
+        {"role": "system", "content": "你是博幼基金會規章專家，請根據問題回答相關內容，你知道條文是出自於誠信規章還是捐款條例"},
+        {"role": "user", "content": prompt}
+    ]
+
+def ask_fallback(history_context, user_input, retrieval_query=None, timeout=None):
+    # timeout：只等剩下的時間、不自動重試，逾時由呼叫端改送條文
+    client = get_openai_client()
+    if timeout:
+        client = client.with_options(timeout=timeout, max_retries=0)
+    try:
+        completion = client.chat.completions.create(
+            model=FALLBACK_MODEL,
+            messages=fallback_messages(history_context, user_input, retrieval_query)
+        )
+    except APIStatusError as e:
+        return f"伺服器錯誤：{e.status_code}"
+    record_tokens(FALLBACK_MODEL, completion.usage)
+    return completion.choices[0].message.content.strip()
+
+def fallback_within(deadline, key, history_context, user_input, retrieval_query=None):
+    """ask_fallback limited to the time left, None when it is skipped or runs out"""
+    if not deadline.allows(FALLBACK_MIN):
+        deadline.degrade("skip_fallback")
+        return None
+    timeout = deadline.timeout(FALLBACK_TIMEOUT)
+    try:
+        with span("fallback"):
+            if key:
+                fallback_answer, _ = flight.do(("fallback", key), ask_fallback, "", user_input,
+                                               retrieval_query, timeout=timeout)
+                return fallback_answer
+            return ask_fallback(history_context, user_input, retrieval_query, timeout=timeout)
+    except APITimeoutError:
+        deadline.degrade("fallback_timeout")
+        return None
+    except APIConnectionError as e:
+        import logging
+        logging.exception(f"[Fallback Error] {str(e)}")
+        deadline.degrade("fallback_error")
+        return None
+
+def format_references(docs):
+    # 每段條文前標上出處（規章名稱、章），重複的段落只列一次
+    blocks = []
+    for doc in docs:
+        label = " ".join(p for p in [doc.metadata.get("title"), doc.metadata.get("chapter")] if p)
+        block = f"【{label}】\n{doc.page_content}" if label else doc.page_content
+        if block not in blocks:
+            blocks.append(block)
+    return "\n".join(blocks)
+
+def compose_answer(res, fallback_answer=None):
+    # fallback_answer 為 None 表示 RAG 有找到答案
+    context_text = format_references(res["context"])
+    if fallback_answer is not None:
+        answer = fallback_answer
+    else:
+        answer = res["answer"]
+        if any(term in res["answer"] for term in REFERENCE_TERMS):
+            answer += "\n\n🔎 參考條文：\n" + context_text
+
+    if any(term in res["answer"] for term in ["誠信規章", "誠信", "誠信經營規範"]):
+        answer += "\n\n🔎 誠信規章原文連結：\n" + INTEGRITY_LINK
+
+    if any(term in res["answer"] for term in ["捐款條例", "捐款", "捐助章程"]):
+        answer += "\n\n🔎 捐款條例原文連結：\n" + DONATION_LINK
+    return answer
+
+def degraded_answer(res, faq=None):
+    # 沒時間產生答案：先給相近的常見問題與檢索到的條文，完整內容請使用者看原文
+    answer = DEGRADED_TEXT
+    if faq:
+        answer += f"\n\n💡 相近的常見問題：{faq['question']}\n{faq['answer']}"
+    if res["context"]:
+        answer += "\n\n🔎 相關條文：\n" + format_references(res["context"])
+
+    titles = "".join(doc.metadata.get("title", "") for doc in res["context"])
+    integrity, donation = "誠信" in titles, "捐" in titles
+    if integrity or not donation:
+        answer += "\n\n🔎 誠信規章原文連結：\n" + INTEGRITY_LINK
+    if donation or not integrity:
+        answer += "\n\n🔎 捐款條例原文連結：\n" + DONATION_LINK
+    return answer
+
+def answer_flex_message(answer, suggestion=None):
+    flex_json = {
+        "type": "bubble",
+        "body": {
+            "type": "box",
+            "layout": "vertical",
+            "contents": [
+                {
+                    "type": "text",
+                    "text": "📘 規章查詢結果",
+                    "weight": "bold",
+                    "size": "lg"
+                },
+                {
+                    "type": "text",
+                    "text": answer,
+                    "wrap": True
+                }
+            ]
+        }
+    }
 
-    total_start = time.time()
+    flex_message = FlexMessage(
+        alt_text="📘 規章查詢結果",
+        contents=FlexContainer.from_dict(flex_json)
+    )
+
+    items = [
+        QuickReplyItem(action=MessageAction(label="✅ 繼續追問", text="繼續")),
+        QuickReplyItem(action=MessageAction(label="🛑 結束問題", text="結束"))
+    ]
+    if suggestion:
+        # 相近的常見問題，點了會送出 FAQ 原文、直接拿到固定答案（label 上限 20 字）
+        items.insert(0, QuickReplyItem(action=MessageAction(label=f"💡 {suggestion}"[:20], text=suggestion)))
+    flex_message.quick_reply = QuickReply(items=items)
+    return flex_message
+
+def quiz_message(question, options):
+    quick_reply = QuickReply(
+        items=[
+            QuickReplyItem(action=MessageAction(label="A", text="A")),
+            QuickReplyItem(action=MessageAction(label="B", text="B")),
+            QuickReplyItem(action=MessageAction(label="C", text="C")),
+        ]
+    )
+    return TextMessage(text=f"📖 {question}\n{options}", quick_reply=quick_reply)
 
-    answer = "⚠️ 很抱歉，目前暫時無法取得規章資訊，請稍後再試。"
+
+# welcome messages
+def process_gpt_and_push(event, deadline=None):
+    with trace("process_gpt_and_push") as attrs:
+        _process_gpt_and_push(event, attrs, deadline or Deadline())
+
+def _process_gpt_and_push(event, attrs, deadline):
+    answer = ERROR_TEXT
     user_input = event.message.text.strip()
     user_id = getattr(event.source, 'user_id', None)
     if not user_id:
@@ -150,320 +489,166 @@ def process_gpt_and_push(event):
         logging.warning("⚠️ 無法取得 user_id，跳過處理")
         return
     
-    with ApiClient(configuration) as api_client:
-        line_bot_api = MessagingApi(api_client)
-
-
-#### SPECIAL CASE START ####
-
-        # 若使用者輸入結束，清除記憶
-        if user_input == "結束":
-            clear_memory(user_id)
-            print(f"[DEBUG] 清除chat memory耗時：{time.time() - total_start:.2f} 秒")
-            line_bot_api.reply_message_with_http_info(
-                ReplyMessageRequest(
-                    reply_token=event.reply_token,
-                    messages=[TextMessage(text="✅ 已結束本次問題，我不會再記住剛剛的對話內容囉！")]
-                )
-            )
-            print(f"[DEBUG] LINE 推送結束完成，用時：{time.time() - total_start:.2f} 秒")
-            return
-        if user_input == "繼續":
-            line_bot_api.reply_message_with_http_info(
-                ReplyMessageRequest(
-                    reply_token=event.reply_token,
-                    messages=[TextMessage(text="請問還有什麼想要詢問的呢？")]
-                )
-            )
-            print(f"[DEBUG] LINE 推送繼續完成，用時：{time.time() - total_start:.2f} 秒")
-            return
+    line_bot_api = get_line_bot_api()
 
-        if user_input == "常見問題":
-            faq_message = FlexMessage(
-                alt_text="📋 常見問題選單",
-                contents=FlexContainer.from_dict(FAQ_FLEX_JSON)
-            )
+    messages = special_case_messages(user_id, user_input)
+    if messages is not None:
+        attrs["route"] = "special"
+        with span("line.reply"):
             line_bot_api.reply_message_with_http_info(
                 ReplyMessageRequest(
                     reply_token=event.reply_token,
-                    messages=[faq_message]
+                    messages=messages
                 )
             )
-            print(f"[DEBUG] LINE 推送常見問題完成，用時：{time.time() - total_start:.2f} 秒")
-            return
-        
-        # 若使用者輸入結束測驗，清除測驗記憶
-        if user_input == "結束測驗":
-            clear_memory(user_id)
-            print(f"[DEBUG] 清除quiz history，耗時：{time.time() - total_start:.2f} 秒")
-            clear_quiz_history(user_id)
-            line_bot_api.reply_message_with_http_info(
-                ReplyMessageRequest(
-                    reply_token=event.reply_token,
-                    messages=[TextMessage(text="✅ 測驗已結束，感謝你的作答！")]
-                )
-            )
-            print(f"[DEBUG] LINE 推送結束問題完成，用時：{time.time() - total_start:.2f} 秒")
-            return
-        
-        # 若是常見問題之一，則回覆固定答案
-        if user_input in FAQ_ANSWERS:
-            answer = FAQ_ANSWERS[user_input]
-            append_memory(user_id, user_input, answer)
-            print(f"[DEBUG] 寫入firebase常見問題，耗時：{time.time() - total_start:.2f} 秒")
+        return
 
+    if not warmer.ready():
+        # 還在載入模型，不讓使用者卡在這裡等
+        attrs["route"] = "warming_up"
+        warmer.start()
+        with span("line.reply"):
             line_bot_api.reply_message_with_http_info(
                 ReplyMessageRequest(
                     reply_token=event.reply_token,
-                    messages=[TextMessage(text=answer)]
+                    messages=[TextMessage(text=WARMING_TEXT)]
                 )
             )
-            print(f"[DEBUG] LINE 推送常見問題完成，用時：{time.time() - total_start:.2f} 秒")
-            return
-        
-        if user_input == "使用教學":
-            line_bot_api.reply_message_with_http_info(
-                ReplyMessageRequest(
-                    reply_token=event.reply_token,
-                    messages=[
-                        FlexMessage(
-                            alt_text="📖 使用教學圖片",
-                            contents=FlexContainer.from_dict(TUTORIAL_CAROUSEL)
-                        )
-                    ]
-                )
-            )
-            print(f"[DEBUG] LINE 推送使用教學完成，用時：{time.time() - total_start:.2f} 秒")
-            return
-
-
-        # if user_input == "測驗":
-
-        #     # Step 1: 立即回應提示訊息（不會失敗）
-        #     line_bot_api.reply_message_with_http_info(
-        #         ReplyMessageRequest(
-        #             reply_token=event.reply_token,
-        #             messages=[TextMessage(text="✏️ 生成試題中，請稍候...")]
-        #         )
-        #     )
-        #     # Step 2: 開 thread 非同步生成試題（避免卡在 reply）
-        #     threading.Thread(target=generate_quiz_and_push, args=(user_id,)).start()
-        #     return
-
-        if user_input in ["A", "B", "C"]:
-            quiz_ref = db.reference(f"/quiz/{user_id}/current")
-            quiz_data = quiz_ref.get()
-
-            if not quiz_data:
-                reply_text = "⚠️ 沒有正在進行的題目喔～請輸入「測驗」開始答題！"
-            else:
-                correct = quiz_data["answer"].strip().upper()
-                if user_input.upper() == correct:
-                    reply_text = "✅ 恭喜你答對了！"
-                else:
-                    reply_text = f"❌ 答錯了，正確答案是 {correct}"
-                quiz_ref.delete()
-                print(f"[DEBUG] 刪除quiz current，耗時：{time.time() - total_start:.2f} 秒")
-                quick_reply = QuickReply(
-                    items=[
-                        QuickReplyItem(action=MessageAction(label="📘 下一題", text="測驗")),
-                        QuickReplyItem(action=MessageAction(label="🛑 結束測驗", text="結束測驗"))
-                    ]
-                )
+        return
 
+    # 和常見問題幾乎一樣的提問直接回固定答案，不跑 RAG
+    faq = route_faq(user_input)
+    if faq and faq["action"] == "answer":
+        attrs["route"] = "faq"
+        # 命中次數已由 faq_router_total{result="answer"} 記錄，trace 上補記命中的題目
+        attrs["faq"] = faq["question"]
+        with span("line.reply"):
             line_bot_api.reply_message_with_http_info(
                 ReplyMessageRequest(
                     reply_token=event.reply_token,
-                    messages=[TextMessage(text=reply_text, quick_reply=quick_reply)]
+                    messages=[TextMessage(text=faq["answer"])]
                 )
             )
-            print(f"[DEBUG] LINE 推送揭曉答案完成，用時：{time.time() - total_start:.2f} 秒")
-            return
-
-#### SPECIAL CASE END ####
-
+        append_memory(user_id, user_input, faq["answer"])
+        return
+    if not (faq and faq["action"] == "suggest"):
+        faq = None
+    suggestion = faq and faq["question"]
 
-        try:
+    attrs["route"] = "rag"
+    try:
+        with span("line.reply"):
             line_bot_api.reply_message_with_http_info(
                 ReplyMessageRequest(
                     reply_token=event.reply_token,
                     messages=[TextMessage(text="思考中，請稍候...")]
                 )
             )
-            print(f"[DEBUG] 傳送思考中，耗時：{time.time() - total_start:.2f} 秒")
-
-        except Exception as e:
-            import logging
-            logging.exception(f"[Push Pre-message Error] {str(e)}")
-
-        # ✅ Step 2: Call RAG (--OpenAI（非同步完成後再送--)
-        try:
-            # 取過去 N 筆記憶，拼成 context 一併餵給 RAG
-            history = get_memory(user_id)[-MAX_HISTORY:]  # 限制取最近的幾則
-            print(f"[DEBUG] 取得對話紀錄，耗時：{time.time() - total_start:.2f} 秒")
-            history_context = "\n".join([f"User: {item['user']}\nBot: {item['bot']}" for item in history])
-
-            # 拼成完整查詢字串（你朋友的 RAG 會將這整段丟給 GPT）
-            full_query = f"{history_context}\n\nUser: {user_input}"
-
-            # 調用 RAG 系統
-            res = get_response(full_query)
-            print(f"[DEBUG] 調用RAG，耗時：{time.time() - total_start:.2f} 秒")
-            
-            context_text = "\n".join([doc.page_content for doc in res["context"]])
-
-            # backup : use original GPT
-            if "unsure" in res["answer"].lower():
-                print("[RAG Miss] 使用 fallback 模式")
-                # 改為 all_rules + OpenAI 傳統問法
-
-                prompt = (
-                    "你是博幼基金會的規章專家，請根據條文內容與使用者上下文進行回答，請避免捏造內容, 可提供你是參考什麼原文。\n"
-                    f"條文如下：\n{all_rules}\n\n對話歷史：\n{history_context}\n\n使用者提問：{user_input}"
-                )
 
-                response = requests.post(
-                    "https://api.openai.com/v1/chat/completions",
-                    headers={
-                        "Authorization": f"Bearer {OPENAI_API_KEY}",
-                        "Content-Type": "application/json"
-                    },
-                    json={
-                        "model": "gpt-4o-mini",
-                        "messages": [
-                            {"role": "system", "content": "你是博幼基金會規章專家，請根據問題回答相關內容，你知道條文是出自於誠信規章還是捐款條例"},
-                            {"role": "user", "content": prompt}
-                        ]
-                    },
-                    timeout=30
-                )
-                if response.status_code == 200:
-                    print(f"[DEBUG] 額外調用GPT，耗時：{time.time() - total_start:.2f} 秒")
-                    data = response.json()
-                    answer = data["choices"][0]["message"]["content"].strip()
-
-                else:
-                    answer = f"伺服器錯誤：{response.status_code}"
+    except Exception as e:
+        import logging
+        logging.exception(f"[Push Pre-message Error] {str(e)}")
 
+    # ✅ Step 2: Call RAG (--OpenAI（非同步完成後再送--)
+    try:
+        # 取過去 N 筆記憶：較舊的壓成摘要，檢索只用目前的提問（追問時改寫成獨立問題）
+        with span("firebase.read_memory"):
+            history = get_memory(user_id, MAX_HISTORY)  # 只向 Firebase 取最近的幾則
+        turn = prepare_turn(history, user_input, deadline=deadline)
+        attrs["condensed"] = turn.condensed
+
+        # 調用 RAG 系統：不是追問的提問自成一題，不帶對話歷史回答，才能查語意快取（追問仍帶歷史、不查快取）
+        # 進行中的相同提問（不論有沒有對話歷史）直接等同一份結果（各自推播給自己的 user_id）
+        cache_key = turn.cache_key
+        key = flight_key(cache_key) if cache_key else None
+        rag_start = time.perf_counter()
+        with span("rag"):
+            if key:
+                res, attrs["coalesced"] = flight.do(("rag", key), get_response, user_input,
+                                                     retrieval_query=turn.retrieval_query, cache_key=cache_key,
+                                                     deadline=deadline)
             else:
-                answer = res["answer"]
-                if any(term in res["answer"] for term in [  "條文", "條款", "條項", "法條", "細則",
-                                                            "規定", "規範", "規約", "守則", "規矩", "限制", "辦法", "要求", "條件",
-                                                            "章節", "段落", "部分", "節次", "子章", "篇章",
-                                                            "條例", "法律", "法規", "規則", "準則", "措施", "制度",
-                                                            "規章", "章程", "章則", "會章", "組織章程", "規章制度"]):
-                    answer += "\n\n🔎 參考條文：\n" + context_text
-
-            if any(term in res["answer"] for term in ["誠信規章", "誠信", "誠信經營規範"]):
-                answer += "\n\n🔎 誠信規章原文連結：\n" + "https://drive.google.com/file/d/1NGgZy4wi9Q69YNgTGcxEN0bScwu5Nzo4/view?usp=sharing"
-
-            if any(term in res["answer"] for term in ["捐款條例", "捐款", "捐助章程"]):
-                answer += "\n\n🔎 捐款條例原文連結：\n" + "https://drive.google.com/file/d/1foZjFAlnAK9g2sQaBO5yzQ3Lip0LmMMO/view?usp=sharing"
-            # 存入記憶
+                res = get_response(user_input, history=turn.history_text,
+                                   retrieval_query=turn.retrieval_query, deadline=deadline)
+
+        # backup : use original GPT（時間不夠就略過，改送條文）
+        fallback_answer = None
+        # 流程判斷用區域變數，attrs 只給 trace 記錄
+        fallback = attrs["fallback"] = needs_fallback(res)
+        if fallback:
+            fallback_answer = fallback_within(deadline, key, turn.history_text, user_input, turn.retrieval_query)
+
+        if (res.get("degraded") and not res["answer"]) or (fallback and fallback_answer is None):
+            answer = degraded_answer(res, faq)
+        else:
+            answer = compose_answer(res, fallback_answer)
+        attrs["degraded"] = ",".join(deadline.degraded) or res.get("degraded")  # 合併的提問沿用領頭者的結果
+        if FAQ_ROUTER_ENABLED:
+            get_faq_router().record_rag_seconds(time.perf_counter() - rag_start)
+        # 存入記憶（背景寫回 firebase）
+        with span("firebase.write_memory"):
             append_memory(user_id, user_input, answer)
-            print(f"[DEBUG] 對話紀錄存入firebase，耗時：{time.time() - total_start:.2f} 秒")
-   
-
-        except Exception as e:
-            import logging
-            logging.exception(f"[RAG GPT Error] {str(e)}")
-
-        try:
-            # ✅ Step 3: 推送 Flex card
-            flex_json = {
-                "type": "bubble",
-                "body": {
-                    "type": "box",
-                    "layout": "vertical",
-                    "contents": [
-                        {
-                            "type": "text",
-                            "text": "📘 規章查詢結果",
-                            "weight": "bold",
-                            "size": "lg"
-                        },
-                        {
-                            "type": "text",
-                            "text": answer,
-                            "wrap": True
-                        }
-                    ]
-                }
-            }
-
-            flex_message = FlexMessage(
-                alt_text="📘 規章查詢結果",
-                contents=FlexContainer.from_dict(flex_json)
-            )
 
-            flex_message.quick_reply = QuickReply(
-                items=[
-                    QuickReplyItem(action=MessageAction(label="✅ 繼續追問", text="繼續")),
-                    QuickReplyItem(action=MessageAction(label="🛑 結束問題", text="結束"))
-                ]
-            )
+    except Exception as e:
+        import logging
+        logging.exception(f"[RAG GPT Error] {str(e)}")
 
+    try:
+        # ✅ Step 3: 推送 Flex card
+        with span("line.push"):
             line_bot_api.push_message_with_http_info(
                 PushMessageRequest(
                     to=user_id,
-                    messages=[flex_message]
+                    messages=[answer_flex_message(answer, suggestion)]
                 )
             )
-            print(f"[DEBUG] LINE 推送自然語言回答完成，耗時：{time.time() - total_start:.2f} 秒")
-        except Exception as e:
-            import logging
-            logging.exception(f"[GPT or Flex render Error] {str(e)}")
+    except Exception as e:
+        import logging
+        logging.exception(f"[GPT or Flex render Error] {str(e)}")
 
 
 def generate_quiz_and_push(user_id):
-    start = time.time()
-    with ApiClient(configuration) as api_client:
-        line_bot_api = MessagingApi(api_client)
+    with trace("generate_quiz_and_push") as attrs:
+        line_bot_api = get_line_bot_api()
+
+        with span("firebase.read_quiz_history"):
+            asked_questions = get_asked_questions(user_id)
+
+        with span("quiz.bank"):
+            quiz = pick_bank_quiz(asked_questions)
+        attrs["source"] = "bank" if quiz else "llm"
+        if quiz:
+            q, opt, ans = quiz
+        else:
+            with span("quiz.generate"):
+                q, opt, ans = generate_quiz_question(get_all_rules(), asked_questions)
+        if not q:
+            with span("line.push"):
+                line_bot_api.push_message_with_http_info(
+                    PushMessageRequest(
+                        to=user_id,
+                        messages=[TextMessage(text=QUIZ_ERROR_TEXT)]
+                    )
+                )
+            return
 
-        print(f"[DEBUG] 開始生成 quiz for {user_id}")
-        history_ref = db.reference(f"/quiz/{user_id}/history")
-        history_data = history_ref.get() or {}
-        asked_questions = set(history_data.values())
+        with span("firebase.write_quiz"):
+            save_current_quiz(user_id, q, ans)
 
-        q, opt, ans = generate_quiz_question(all_rules, asked_questions)
-        print(f"[DEBUG] GPT 回應時間：{time.time() - start:.2f} 秒")
-        if not q:
+        with span("line.push"):
             line_bot_api.push_message_with_http_info(
                 PushMessageRequest(
                     to=user_id,
-                    messages=[TextMessage(text="⚠️ 很抱歉，目前無法出題，請稍後再試！")]
+                    messages=[quiz_message(q, opt)]
                 )
             )
-            return
-
-        db.reference(f"/quiz/{user_id}/history").push(q)
-        db.reference(f"/quiz/{user_id}/current").set({
-            "question": q,
-            "answer": ans
-        })
-
-        print(f"[DEBUG] Firebase 寫入完成，用時：{time.time() - start:.2f} 秒")
-
-        quick_reply = QuickReply(
-            items=[
-                QuickReplyItem(action=MessageAction(label="A", text="A")),
-                QuickReplyItem(action=MessageAction(label="B", text="B")),
-                QuickReplyItem(action=MessageAction(label="C", text="C")),
-            ]
-        )
-
-        line_bot_api.push_message_with_http_info(
-            PushMessageRequest(
-                to=user_id,
-                messages=[TextMessage(text=f"📖 {q}\n{opt}", quick_reply=quick_reply)]
-            )
-        )
-        print(f"[DEBUG] LINE 推送完成，用時：{time.time() - start:.2f} 秒")
-
-def clear_quiz_history(user_id):
-    db.reference(f"/quiz/{user_id}/history").delete()
 
 if __name__ == "__main__":
+    # Cloud Run 以 SIGTERM 結束容器，轉成正常結束讓 atexit 把 session 寫回 Firebase
+    import signal
+    import sys
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+
     port = int(os.environ.get("PORT", 8080))
     app.run(host="0.0.0.0", port=port)
 
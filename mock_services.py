@@ -0,0 +1,333 @@
+# local stand-ins for the OpenAI chat API, the LINE Messaging API and the Firebase Realtime Database REST API
+# point the app at them with OPENAI_BASE_URL / LINE_API_HOST / FIREBASE_DATABASE_EMULATOR_HOST (see loadtest.py)
+# usage: python mock_services.py [--openai-ms 800] [--line-ms 50] [--firebase-ms 30]
+import json
+import time
+import random
+import asyncio
+import hashlib
+import argparse
+from collections import Counter
+
+from aiohttp import web
+
+from bench_pipeline import FakeOpenAI
+
+
+# Constants
+
+OPENAI_PORT = 18001
+LINE_PORT = 18002
+FIREBASE_PORT = 18003
+PUSH_CHARS = "-0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ_abcdefghijklmnopqrstuvwxyz"
+
+
+class Latency:
+    """injected service latency: mean ms +- jitter fraction"""
+
+    def __init__(self, ms: float, jitter: float = 0.2, rng: random.Random = None):
+        self.ms = ms
+        self.jitter = jitter
+        self.rng = rng or random.Random(0)
+
+    async def sleep(self):
+        if self.ms > 0:
+            await asyncio.sleep(self.ms * (1 + self.rng.uniform(-self.jitter, self.jitter)) / 1000)
+
+
+class MockOpenAI:
+    """POST /v1/chat/completions, answers like bench_pipeline.FakeOpenAI; error_rate returns 429 / 500"""
+
+    def __init__(self, latency: Latency, fallback_rate: float = 0.2, error_rate: float = 0.0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.fake = FakeOpenAI(None, fallback_rate)
+        self.requests = 0
+        self.errors = 0
+        self.inflight = 0
+        self.max_inflight = 0
+
+    def reply_text(self, body):
+        user = body["messages"][-1]["content"] if body.get("messages") else ""
+        if "使用者最後的提問：" in user:
+            # conversation.condense_query：原樣回傳提問
+            return user.rsplit("使用者最後的提問：", 1)[1].strip()
+        return self.fake.reply_text(body)
+
+    async def chat_completions(self, request):
+        self.requests += 1
+        self.inflight += 1
+        self.max_inflight = max(self.max_inflight, self.inflight)
+        try:
+            body = await request.json()
+            await self.latency.sleep()
+            if self.error_rate and self.latency.rng.random() < self.error_rate:
+                self.errors += 1
+                status = self.latency.rng.choice([429, 500])
+                return web.json_response({"error": {"message": "mock error", "type": "mock", "code": status}}, status=status)
+            content = self.reply_text(body)
+            prompt_tokens = sum(len(m.get("content") or "") for m in body.get("messages", []))
+            return web.json_response({
+                "id": f"chatcmpl-mock-{self.requests}",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": body.get("model", ""),
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+                "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": len(content),
+                          "total_tokens": prompt_tokens + len(content)},
+            })
+        finally:
+            self.inflight -= 1
+
+    def app(self) -> web.Application:
+        app = web.Application(client_max_size=16 * 1024 * 1024)
+        app.router.add_post("/v1/chat/completions", self.chat_completions)
+        app.router.add_post("/chat/completions", self.chat_completions)
+        return app
+
+    def stats(self) -> dict:
+        return {"requests": self.requests, "errors": self.errors, "max_inflight": self.max_inflight}
+
+
+def message_texts(messages) -> list:
+    # Flex message 取 altText 以外的文字內容，方便 loadtest 判斷回覆種類
+    texts = []
+    for message in messages:
+        if message.get("type") == "text":
+            texts.append(message.get("text", ""))
+        elif message.get("type") == "flex":
+            texts.append(json.dumps(message.get("contents", {}), ensure_ascii=False))
+    return texts
+
+
+class MockLine:
+    """POST /v2/bot/message/reply and /push; listeners get (kind, reply token or user id, time, texts)"""
+
+    def __init__(self, latency: Latency):
+        self.latency = latency
+        self.listeners = []
+        self.counts = Counter()
+
+    async def _send(self, request, kind):
+        body = await request.json()
+        await self.latency.sleep()
+        received = time.perf_counter()
+        key = body.get("replyToken") if kind == "reply" else body.get("to")
+        messages = body.get("messages", [])
+        self.counts[kind] += 1
+        for listener in self.listeners:
+            listener(kind, key, received, message_texts(messages))
+        return web.json_response({"sentMessages": [{"id": str(i), "quoteToken": "mock"} for i in range(len(messages))]})
+
+    async def reply(self, request):
+        return await self._send(request, "reply")
+
+    async def push(self, request):
+        return await self._send(request, "push")
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post("/v2/bot/message/reply", self.reply)
+        app.router.add_post("/v2/bot/message/push", self.push)
+        return app
+
+    def stats(self) -> dict:
+        return dict(self.counts)
+
+
+class MockFirebase:
+    """
+    The Realtime Database REST API as used by firebase_admin with FIREBASE_DATABASE_EMULATOR_HOST:
+    GET (orderBy / limitToFirst / limitToLast / startAt / endAt / equalTo / shallow, ETag),
+    PUT (if-match), PATCH (multi-path), POST (push id) and DELETE on <path>.json
+    """
+
+    def __init__(self, latency: Latency):
+        self.latency = latency
+        self.root = {}
+        self.counts = Counter()
+        self._last_push = 0
+
+    @staticmethod
+    def _parts(path: str) -> list:
+        path = path[:-len(".json")] if path.endswith(".json") else path
+        return [p for p in path.split("/") if p]
+
+    def _get(self, parts):
+        node = self.root
+        for part in parts:
+            if not isinstance(node, dict) or part not in node:
+                return None
+            node = node[part]
+        return node
+
+    def _set(self, parts, value):
+        if not parts:
+            self.root = value if isinstance(value, dict) else {}
+            return
+        if value is None:
+            self._delete(parts)
+            return
+        node = self.root
+        for part in parts[:-1]:
+            if not isinstance(node.get(part), dict):
+                node[part] = {}
+            node = node[part]
+        node[parts[-1]] = value
+
+    def _delete(self, parts):
+        # 一路往上刪掉變空的父節點，與 Firebase 一致
+        trail = [self.root]
+        for part in parts[:-1]:
+            node = trail[-1].get(part) if isinstance(trail[-1], dict) else None
+            if not isinstance(node, dict):
+                return
+            trail.append(node)
+        trail[-1].pop(parts[-1], None)
+        for depth in range(len(parts) - 1, 0, -1):
+            if trail[depth]:
+                break
+            trail[depth - 1].pop(parts[depth - 1], None)
+
+    @staticmethod
+    def _etag(value) -> str:
+        return hashlib.md5(json.dumps(value, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+    def _query(self, value, query):
+        if not isinstance(value, dict) or "orderBy" not in query:
+            return value
+        order_by = json.loads(query["orderBy"])
+
+        def compare(item):
+            if order_by == "$key":
+                return item[0]
+            if order_by == "$value":
+                return item[1]
+            return item[1].get(order_by) if isinstance(item[1], dict) else None
+
+        # 沒有該欄位的排最前面；同類型才比較大小
+        items = sorted(value.items(), key=lambda item: (compare(item) is not None, str(type(compare(item))),
+                                                        compare(item) if compare(item) is not None else 0))
+        if "equalTo" in query:
+            target = json.loads(query["equalTo"])
+            items = [item for item in items if compare(item) == target]
+        if "startAt" in query:
+            start = json.loads(query["startAt"])
+            items = [item for item in items if compare(item) is not None and compare(item) >= start]
+        if "endAt" in query:
+            end = json.loads(query["endAt"])
+            items = [item for item in items if compare(item) is not None and compare(item) <= end]
+        if "limitToFirst" in query:
+            items = items[:int(query["limitToFirst"])]
+        if "limitToLast" in query:
+            items = items[-int(query["limitToLast"]):]
+        return dict(items)
+
+    def _push_id(self) -> str:
+        now = max(int(time.time() * 1000), self._last_push + 1)
+        self._last_push = now
+        chars = []
+        for _ in range(8):
+            chars.append(PUSH_CHARS[now % 64])
+            now //= 64
+        return "".join(reversed(chars)) + "".join(random.choice(PUSH_CHARS) for _ in range(12))
+
+    async def handle(self, request):
+        await self.latency.sleep()
+        self.counts[request.method] += 1
+        parts = self._parts(request.path)
+        query = request.query
+        silent = query.get("print") == "silent"
+
+        if request.method == "GET":
+            value = self._get(parts)
+            if query.get("shallow") == "true" and isinstance(value, dict):
+                value = {k: True for k in value}
+            headers = {"ETag": self._etag(value)} if request.headers.get("X-Firebase-ETag") == "true" else {}
+            return web.json_response(self._query(value, query), headers=headers)
+
+        if request.method == "DELETE":
+            self._delete(parts) if parts else self._set(parts, {})
+            return web.Response(status=204) if silent else web.json_response(None)
+
+        body = await request.json()
+        if request.method == "PUT":
+            expected = request.headers.get("if-match")
+            current = self._get(parts)
+            if expected is not None and expected != self._etag(current):
+                return web.json_response(current, status=412, headers={"ETag": self._etag(current)})
+            self._set(parts, body)
+            headers = {"ETag": self._etag(body)}
+            return web.Response(status=204, headers=headers) if silent else web.json_response(body, headers=headers)
+
+        if request.method == "PATCH":
+            for path, value in body.items():
+                self._set(parts + [p for p in path.split("/") if p], value)
+            return web.Response(status=204) if silent else web.json_response(body)
+
+        if request.method == "POST":
+            name = self._push_id()
+            self._set(parts + [name], body)
+            return web.json_response({"name": name})
+
+        return web.Response(status=405)
+
+    def app(self) -> web.Application:
+        app = web.Application(client_max_size=16 * 1024 * 1024)
+        app.router.add_route("*", "/{tail:.*}", self.handle)
+        return app
+
+    def stats(self) -> dict:
+        return dict(self.counts)
+
+
+async def start_mocks(openai_ms=800, line_ms=50, firebase_ms=30, jitter=0.2, fallback_rate=0.2, openai_error_rate=0.0,
+                      host="127.0.0.1", ports=(OPENAI_PORT, LINE_PORT, FIREBASE_PORT), seed=0):
+    """start the three mock servers on the running loop, return (mocks dict, runners, env for the app)"""
+    rng = random.Random(seed)
+    mocks = {
+        "openai": MockOpenAI(Latency(openai_ms, jitter, rng), fallback_rate, openai_error_rate),
+        "line": MockLine(Latency(line_ms, jitter, rng)),
+        "firebase": MockFirebase(Latency(firebase_ms, jitter, rng)),
+    }
+    runners = []
+    for mock, port in zip(mocks.values(), ports):
+        runner = web.AppRunner(mock.app(), access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, host, port).start()
+        runners.append(runner)
+    env = {
+        "OPENAI_BASE_URL": f"http://{host}:{ports[0]}/v1",
+        "LINE_API_HOST": f"http://{host}:{ports[1]}",
+        "FIREBASE_DATABASE_EMULATOR_HOST": f"{host}:{ports[2]}",
+    }
+    return mocks, runners, env
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="run the OpenAI / LINE / Firebase mock servers")
+    arg_parser.add_argument("--openai-ms", type=float, default=800)
+    arg_parser.add_argument("--line-ms", type=float, default=50)
+    arg_parser.add_argument("--firebase-ms", type=float, default=30)
+    arg_parser.add_argument("--jitter", type=float, default=0.2)
+    arg_parser.add_argument("--fallback-rate", type=float, default=0.2)
+    arg_parser.add_argument("--openai-error-rate", type=float, default=0.0)
+    args = arg_parser.parse_args()
+
+    async def serve():
+        mocks, runners, env = await start_mocks(args.openai_ms, args.line_ms, args.firebase_ms, args.jitter,
+                                                args.fallback_rate, args.openai_error_rate)
+        print("start the app with:")
+        print(" ".join(f"{k}={v}" for k, v in env.items()))
+        try:
+            while True:
+                await asyncio.sleep(30)
+                print({name: mock.stats() for name, mock in mocks.items()})
+        finally:
+            for runner in runners:
+                await runner.cleanup()
+
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        pass
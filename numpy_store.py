@@ -0,0 +1,182 @@
+import os
+import json
+import uuid
+from typing import Any, Iterable, Optional
+
+import numpy as np
+
+from langchain.docstore.document import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.vectorstores import VectorStore
+
+
+# Constants
+
+MATRIX_FILE = "embeddings.npy"
+METADATA_FILE = "metadata.json"
+INDEX_DTYPE = os.environ.get("NUMPY_INDEX_DTYPE", "float32")  # float32 / float16
+
+
+def _normalize(matrix: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+def mmr_select(query: np.ndarray, candidates: np.ndarray, k: int, lambda_mult: float) -> list[int]:
+    """
+    vectorized maximal marginal relevance over normalized vectors
+    return indices into candidates, in selection order
+    """
+    if len(candidates) == 0:
+        return []
+    relevance = candidates @ query
+    pairwise = candidates @ candidates.T
+    selected = [int(np.argmax(relevance))]
+    # 每個候選與「已選集合」的最大相似度，逐次更新，不必每輪重算
+    redundancy = pairwise[selected[0]].copy()
+    while len(selected) < min(k, len(candidates)):
+        scores = lambda_mult * relevance - (1 - lambda_mult) * redundancy
+        scores[selected] = -np.inf
+        best = int(np.argmax(scores))
+        selected.append(best)
+        np.maximum(redundancy, pairwise[best], out=redundancy)
+    return selected
+
+
+class NumpyVectorStore(VectorStore):
+    """
+    Small in-memory vector store for a few hundred regulation chunks
+
+    vectors are kept normalized in one float32/float16 matrix saved as .npy
+    (loaded with mmap) next to a json file holding ids, texts and metadata
+    """
+
+    def __init__(self, embedding_function: Embeddings, persist_directory: Optional[str] = None, dtype: str = INDEX_DTYPE):
+        self.embedding_function = embedding_function
+        self.persist_directory = persist_directory
+        self.dtype = np.dtype(dtype)
+        self._matrix = np.zeros((0, 0), dtype=self.dtype)
+        self._ids = []
+        self._docs = []
+        if persist_directory and os.path.exists(os.path.join(persist_directory, METADATA_FILE)):
+            self.load()
+
+    @property
+    def embeddings(self) -> Embeddings:
+        return self.embedding_function
+
+    # persistence
+
+    def load(self) -> None:
+        with open(os.path.join(self.persist_directory, METADATA_FILE), encoding="utf-8") as f:
+            raw = json.load(f)
+        self._ids = [item["id"] for item in raw]
+        self._docs = [Document(page_content=item["page_content"], metadata=item["metadata"]) for item in raw]
+        self._matrix = np.load(os.path.join(self.persist_directory, MATRIX_FILE), mmap_mode="r")
+        self.dtype = self._matrix.dtype
+
+    def save(self) -> None:
+        if not self.persist_directory:
+            return
+        os.makedirs(self.persist_directory, exist_ok=True)
+        matrix_path = os.path.join(self.persist_directory, MATRIX_FILE)
+        metadata_path = os.path.join(self.persist_directory, METADATA_FILE)
+        with open(matrix_path + ".tmp", "wb") as f:
+            np.save(f, np.ascontiguousarray(self._matrix))
+        raw = [
+            {"id": i, "page_content": doc.page_content, "metadata": doc.metadata}
+            for i, doc in zip(self._ids, self._docs)
+        ]
+        with open(metadata_path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(raw, f, ensure_ascii=False)
+        os.replace(matrix_path + ".tmp", matrix_path)
+        os.replace(metadata_path + ".tmp", metadata_path)
+
+    # write
+
+    def add_texts(self, texts: Iterable[str], metadatas: Optional[list[dict]] = None, ids: Optional[list[str]] = None, **kwargs: Any) -> list[str]:
+        texts = list(texts)
+        if not texts:
+            return []
+        metadatas = metadatas or [{} for _ in texts]
+        ids = list(ids) if ids else [str(uuid.uuid4()) for _ in texts]
+
+        vectors = _normalize(np.asarray(self.embedding_function.embed_documents(texts), dtype=np.float32)).astype(self.dtype)
+        # 已存在的 id 直接覆蓋
+        self.delete([i for i in ids if i in set(self._ids)], _save=False)
+        matrix = np.asarray(self._matrix)
+        self._matrix = vectors if matrix.size == 0 else np.vstack([matrix, vectors])
+        self._ids.extend(ids)
+        self._docs.extend(Document(page_content=t, metadata=dict(m)) for t, m in zip(texts, metadatas))
+        self.save()
+        return ids
+
+    def delete(self, ids: Optional[list[str]] = None, _save: bool = True, **kwargs: Any) -> Optional[bool]:
+        if not ids:
+            return True
+        drop = set(ids)
+        keep = [n for n, i in enumerate(self._ids) if i not in drop]
+        self._matrix = np.asarray(self._matrix)[keep]
+        self._ids = [self._ids[n] for n in keep]
+        self._docs = [self._docs[n] for n in keep]
+        if _save:
+            self.save()
+        return True
+
+    def get(self, include: Optional[list[str]] = None, **kwargs: Any) -> dict:
+        """subset of Chroma.get(), enough for index_manifest.sync_index"""
+        return {
+            "ids": list(self._ids),
+            "documents": [doc.page_content for doc in self._docs],
+            "metadatas": [doc.metadata for doc in self._docs],
+        }
+
+    # search
+
+    def _query_vector(self, query: str) -> np.ndarray:
+        vec = np.asarray(self.embedding_function.embed_query(query), dtype=np.float32)
+        return _normalize(vec)
+
+    def _scores(self, vector: np.ndarray) -> np.ndarray:
+        if len(self._ids) == 0:
+            return np.zeros(0, dtype=np.float32)
+        return np.asarray(self._matrix @ vector.astype(self.dtype), dtype=np.float32)
+
+    def _top(self, scores: np.ndarray, k: int) -> np.ndarray:
+        k = min(k, len(scores))
+        if k == 0:
+            return np.zeros(0, dtype=int)
+        top = np.argpartition(-scores, k - 1)[:k]
+        return top[np.argsort(-scores[top])]
+
+    def similarity_search_with_score_by_vector(self, embedding: list[float], k: int = 4, **kwargs: Any) -> list[tuple[Document, float]]:
+        scores = self._scores(_normalize(np.asarray(embedding, dtype=np.float32)))
+        return [(self._docs[n], float(scores[n])) for n in self._top(scores, k)]
+
+    def similarity_search_by_vector(self, embedding: list[float], k: int = 4, **kwargs: Any) -> list[Document]:
+        return [doc for doc, _ in self.similarity_search_with_score_by_vector(embedding, k)]
+
+    def similarity_search_with_score(self, query: str, k: int = 4, **kwargs: Any) -> list[tuple[Document, float]]:
+        return self.similarity_search_with_score_by_vector(self._query_vector(query), k)
+
+    def similarity_search(self, query: str, k: int = 4, **kwargs: Any) -> list[Document]:
+        return [doc for doc, _ in self.similarity_search_with_score(query, k)]
+
+    def _similarity_search_with_relevance_scores(self, query: str, k: int = 4, **kwargs: Any) -> list[tuple[Document, float]]:
+        # cosine 相似度轉成 0~1
+        return [(doc, (score + 1) / 2) for doc, score in self.similarity_search_with_score(query, k)]
+
+    def max_marginal_relevance_search_by_vector(self, embedding: list[float], k: int = 4, fetch_k: int = 20, lambda_mult: float = 0.5, **kwargs: Any) -> list[Document]:
+        query = _normalize(np.asarray(embedding, dtype=np.float32))
+        candidates = self._top(self._scores(query), fetch_k)
+        vectors = np.asarray(self._matrix[candidates], dtype=np.float32)
+        return [self._docs[candidates[n]] for n in mmr_select(query, vectors, k, lambda_mult)]
+
+    def max_marginal_relevance_search(self, query: str, k: int = 4, fetch_k: int = 20, lambda_mult: float = 0.5, **kwargs: Any) -> list[Document]:
+        return self.max_marginal_relevance_search_by_vector(self._query_vector(query), k, fetch_k, lambda_mult)
+
+    @classmethod
+    def from_texts(cls, texts: list[str], embedding: Embeddings, metadatas: Optional[list[dict]] = None, ids: Optional[list[str]] = None, persist_directory: Optional[str] = None, **kwargs: Any) -> "NumpyVectorStore":
+        store = cls(embedding_function=embedding, persist_directory=persist_directory, **kwargs)
+        store.add_texts(texts, metadatas=metadatas, ids=ids)
+        return store
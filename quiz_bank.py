@@ -0,0 +1,186 @@
+import os
+import json
+import time
+import random
+import hashlib
+import argparse
+import threading
+
+from openai import APIStatusError
+
+from clients import get_openai_client
+from instrumentation import record_tokens
+from regulations import load_articles
+
+
+# Constants
+
+BANK_PATH = os.environ.get("QUIZ_BANK_PATH", "./quiz_bank.json")
+BANK_MODEL = "gpt-4o-mini"
+QUESTIONS_PER_ARTICLE = 2
+ARTICLES_PER_BATCH = 5
+REFILL_THRESHOLD = int(os.environ.get("QUIZ_BANK_REFILL_THRESHOLD", "10"))  # 使用者剩下的未作答題數低於此值就背景補題
+REFILL_ARTICLES = 10
+REFILL_INTERVAL = float(os.environ.get("QUIZ_BANK_REFILL_INTERVAL", "3600"))  # 兩次背景補題至少間隔幾秒（整個題庫共用）
+
+
+def question_id(question: str) -> str:
+    return hashlib.sha1(question.encode("utf-8")).hexdigest()[:16]
+
+def build_batch_prompt(articles: list[dict], per_article: int) -> str:
+    article_text = "\n\n".join(f"[{i}] {article['text']}" for i, article in enumerate(articles))
+    return (
+        "你是一位基金會規章老師，請根據以下每一條規章條文，各出 "
+        f"{per_article} 題單選測驗題，每題三個選項（A、B、C）與一個正確答案。"
+        "題目需簡短清楚，選項避免模糊不清，不要加入條文原文，只根據該條文出題。\n\n"
+        f"條文如下（[編號] 條文）：\n{article_text}\n\n"
+        "請只輸出 JSON，格式如下：\n"
+        '{"questions": [{"article_index": 0, "question": "...", '
+        '"options": {"A": "...", "B": "...", "C": "..."}, "answer": "A"}]}'
+    )
+
+def validate_question(raw, articles: list[dict]):
+    """return a bank item built from one raw LLM question, or None when it is malformed"""
+    if not isinstance(raw, dict):
+        return None
+    index = raw.get("article_index")
+    question = raw.get("question")
+    options = raw.get("options")
+    answer = str(raw.get("answer", "")).strip().upper()
+    if not isinstance(index, int) or not 0 <= index < len(articles):
+        return None
+    if not isinstance(question, str) or not question.strip():
+        return None
+    if not isinstance(options, dict) or sorted(options) != ["A", "B", "C"]:
+        return None
+    if not all(isinstance(v, str) and v.strip() for v in options.values()):
+        return None
+    if answer not in ("A", "B", "C"):
+        return None
+
+    article = articles[index]
+    question = question.strip()
+    return {
+        "id": question_id(question),
+        "question": question,
+        "options": {k: options[k].strip() for k in ("A", "B", "C")},
+        "answer": answer,
+        "source": article["source"],
+        "chapter": article["chapter"],
+        "article": article["article"],
+    }
+
+def generate_batch(articles: list[dict], per_article: int = QUESTIONS_PER_ARTICLE) -> list[dict]:
+    try:
+        completion = get_openai_client().chat.completions.create(
+            model=BANK_MODEL,
+            response_format={"type": "json_object"},
+            messages=[{"role": "user", "content": build_batch_prompt(articles, per_article)}],
+            timeout=120
+        )
+    except APIStatusError as e:
+        print(f"[Quiz Bank] 出題失敗：{e.status_code}")
+        return []
+    record_tokens(BANK_MODEL, completion.usage)
+    try:
+        content = json.loads(completion.choices[0].message.content)
+    except (TypeError, ValueError) as e:
+        print(f"[Quiz Bank] 回覆格式錯誤：{str(e)}")
+        return []
+    items = [validate_question(raw, articles) for raw in content.get("questions", [])]
+    return [item for item in items if item]
+
+def format_bank_options(item: dict) -> str:
+    return "\n".join(f"{k}. {item['options'][k]}" for k in ("A", "B", "C"))
+
+
+class QuizBank:
+    """pre-generated quiz questions, served without calling the LLM"""
+
+    def __init__(self, path: str = BANK_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._items = {}  # id -> item
+        self._refilling = False
+        self._last_refill = None  # monotonic time of the last refill start
+        self.load()
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, encoding="utf-8") as f:
+            raw = json.load(f)
+        with self._lock:
+            self._items = {item["id"]: item for item in raw.get("questions", [])}
+
+    def save(self):
+        with self._lock:
+            raw = {"questions": list(self._items.values())}
+        with open(self.path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(raw, f, ensure_ascii=False, indent=1)
+        os.replace(self.path + ".tmp", self.path)
+
+    def add(self, items: list[dict]) -> int:
+        with self._lock:
+            new_items = [item for item in items if item["id"] not in self._items]
+            for item in new_items:
+                self._items[item["id"]] = item
+        return len(new_items)
+
+    def unseen(self, asked_questions) -> list[dict]:
+        with self._lock:
+            return [item for item in self._items.values() if item["question"] not in asked_questions]
+
+    def build(self, articles: list[dict], per_article: int = QUESTIONS_PER_ARTICLE, batch_size: int = ARTICLES_PER_BATCH) -> int:
+        added = 0
+        for start in range(0, len(articles), batch_size):
+            batch = articles[start:start + batch_size]
+            added += self.add(generate_batch(batch, per_article))
+            print(f"[Quiz Bank] {min(start + batch_size, len(articles))}/{len(articles)} 條，新增 {added} 題")
+        self.save()
+        return added
+
+    def refill_in_background(self, articles: list[dict]) -> bool:
+        """start a refill thread unless one is running or the last one started within REFILL_INTERVAL"""
+        # 每位題目快做完的使用者每次按「測驗」都會呼叫，用題庫層級的間隔限制，不是每人一次
+        with self._lock:
+            now = time.monotonic()
+            if self._refilling or (self._last_refill is not None and now - self._last_refill < REFILL_INTERVAL):
+                return False
+            self._refilling = True
+            self._last_refill = now
+
+        def run():
+            try:
+                sample = random.sample(articles, min(REFILL_ARTICLES, len(articles)))
+                added = self.build(sample, per_article=1)
+                print(f"[Quiz Bank] 背景補題完成，新增 {added} 題，共 {len(self)} 題")
+            except Exception as e:
+                import logging
+                logging.exception(f"[Quiz Bank Refill Error] {str(e)}")
+            finally:
+                self._refilling = False
+
+        threading.Thread(target=run, name="quiz-bank-refill", daemon=True).start()
+        return True
+
+    def __len__(self):
+        return len(self._items)
+
+
+def quiz_articles() -> list[dict]:
+    # 只用有條號的段落出題（標題、日期不出題）
+    return [article for article in load_articles() if article["article"]]
+
+
+# offline builder: python quiz_bank.py --per-article 2
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="build the pre-generated quiz bank")
+    arg_parser.add_argument("--per-article", type=int, default=QUESTIONS_PER_ARTICLE)
+    arg_parser.add_argument("--batch-size", type=int, default=ARTICLES_PER_BATCH)
+    args = arg_parser.parse_args()
+
+    bank = QuizBank()
+    added = bank.build(quiz_articles(), per_article=args.per_article, batch_size=args.batch_size)
+    print(f"[Quiz Bank] 新增 {added} 題，題庫共 {len(bank)} 題 -> {bank.path}")
@@ -1,19 +1,37 @@
 import os
+import time
+import asyncio
+import threading
 import gdown
 
 from langchain.chains.combine_documents import create_stuff_documents_chain
 from langchain.chains import create_retrieval_chain
 from langchain_community.vectorstores import Chroma
-from langchain_huggingface import HuggingFaceEmbeddings
+from langchain_core.embeddings import Embeddings
 from langchain.docstore.document import Document
-from langchain_core.prompts import ChatPromptTemplate
+from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
+from langchain_core.runnables import RunnableLambda
 from langchain_openai import ChatOpenAI
+from openai import APIStatusError, APIConnectionError, APITimeoutError
 
 
 from huggingface_hub import login, whoami
 
 from config import OPENAI_API_KEY, HF_TOKEN
 
+from answer_cache import SemanticAnswerCache
+from index_manifest import chunk_hash, sync_index
+from section_index import SectionIndex
+from regulations import split_articles, chunk_articles, read_rules
+from ingest import INDEX_ROOT, DATA_DIR, read_current, read_version_info, read_artifact, version_dir
+from clients import get_httpx_client, get_async_httpx_client, HTTP_RETRIES
+from hybrid_retriever import HybridRetriever
+from numpy_store import NumpyVectorStore
+from embedding_backends import EMBED_BACKEND, load_embeddings
+from embedding_cache import CachedEmbeddings, CACHE_PATH as EMBED_CACHE_PATH
+from instrumentation import span, inc, SpanCallbackHandler, METRICS_ENABLED
+from deadline import LLM_MIN
+
 
 # Constants
 
@@ -21,6 +39,18 @@ folder_url = 'https://drive.google.com/drive/folders/10qfQwhEymw-yOugiO7z3_80cUC
 output_path = './data'
 MODEL_NAME = "gpt-4o"
 EMBED_MODEL = "sentence-transformers/all-MiniLM-L6-v2"
+VECTOR_BACKEND = os.environ.get("VECTOR_BACKEND", "chroma")  # chroma / numpy
+persist_dir = "./numpy_index" if VECTOR_BACKEND == "numpy" else "./chroma_db"
+if EMBED_BACKEND != "torch":
+    persist_dir += f"_{EMBED_BACKEND}"  # 不同 embedding backend 的向量不混用，各自一份索引
+CHUNK_SIZE = int(os.environ.get("CHUNK_SIZE", "200"))  # 單一 chunk 字數上限，超過的條文會切段
+CHUNK_OVERLAP = int(os.environ.get("CHUNK_OVERLAP", "40"))
+if not 0 <= CHUNK_OVERLAP < CHUNK_SIZE:
+    # overlap 不小於 size 時 chunk_text 切不完，啟動 / 建索引會卡住
+    raise ValueError(f"CHUNK_OVERLAP ({CHUNK_OVERLAP}) must be >= 0 and smaller than CHUNK_SIZE ({CHUNK_SIZE})")
+RETRIEVER_MODE = os.environ.get("RETRIEVER_MODE", "hybrid")  # hybrid（BM25 + 向量）/ dense
+EMBED_MODEL_ID = f"{EMBED_MODEL}:{EMBED_BACKEND}"
+INDEX_POLL_INTERVAL = float(os.environ.get("INDEX_POLL_INTERVAL", "30"))  # 多久檢查一次 INDEX_ROOT/CURRENT（秒），0 = 不檢查
 
 system_prompt = (
     "你是規章QA機器人, 目的是為了將複雜的規章用淺顯易懂的方式回答，並熟知規章出處為何，"
@@ -32,6 +62,8 @@ system_prompt = (
 prompt = ChatPromptTemplate.from_messages(
     [
         ("system", system_prompt),
+        # 壓縮過的對話歷史（conversation.compact_history），沒有歷史就不放
+        MessagesPlaceholder("history", optional=True),
         ("human", "{input}"),
     ]
 )
@@ -39,15 +71,48 @@ prompt = ChatPromptTemplate.from_messages(
 model_kwargs = {'trust_remote_code': True}
 encode_kwargs = {'normalize_embeddings': False}
 
+
+
+class IndexState:
+    """
+    Everything built from one version of the regulations, swapped in as a single reference
+
+    a request reads _index once and keeps that state until it finishes, so a swap
+    never changes the vector store / retriever / chain underneath it; version is
+    the ingest.py version name, or "local" when built from ./data and persist_dir
+    """
+
+    def __init__(self, version, docs, vector_store, retriever, chain, all_rules,
+                 section_index=None, data_dir=output_path, path=None, info=None):
+        self.version = version
+        self.docs = docs
+        self.vector_store = vector_store
+        self.retriever = retriever
+        self.chain = chain
+        self.all_rules = all_rules
+        self.section_index = section_index
+        self.data_dir = data_dir
+        self.path = path
+        self.info = info or {}
+        self.loaded_at = time.time()
+
+
 # models init
 
-_docs = None
 _llm = None
+_deadline_llm = None
 _embeddings_model = None
-_vector_store = None
-_retriever = None
 _question_answer_chain = None
-_chain = None
+_index = None
+_index_lock = threading.Lock()
+_answer_cache = None
+_section_index = None
+_all_rules = None
+_watcher_pid = None
+_seen_pointer = None  # 最後一次處理過的 CURRENT 內容，只有它改變時 watcher 才切換
+_index_status = {"swaps": 0, "failures": 0, "last_error": None, "swapped_at": None, "load_s": None, "swap_ms": None}
+# chain 內的 retrieval / llm 階段由 callback 計時
+_callbacks = [SpanCallbackHandler()] if METRICS_ENABLED else []
 
 # functions
 
@@ -64,96 +129,456 @@ def is_login() -> bool:
 def download_drive(folder_url: str, output_path: str):
     gdown.download_folder(url=folder_url, output=output_path, quiet=False, use_cookies=False)
 
-def generate_document() -> list[Document]:
-    refs = []
-    for filename in os.listdir("./data"):
+def ensure_data(data_dir: str = output_path) -> None:
+    # 只有還沒有規章檔時才從 Google Drive 下載，讀檔 / 解析錯誤照常拋出
+    if not os.path.isdir(data_dir) or not any(f.endswith(".txt") for f in os.listdir(data_dir)):
+        download_drive(folder_url, data_dir)
+
+def generate_document(data_dir: str = output_path) -> list[Document]:
+    articles = []
+    for filename in sorted(os.listdir(data_dir)):
         if filename.endswith(".txt"):
-            with open("./data/"+filename, "r", encoding="utf-8") as f:
-                refs.extend(list((filter(lambda x: x,f.read().split('\n')))))
+            with open(os.path.join(data_dir, filename), "r", encoding="utf-8") as f:
+                articles.extend(split_articles(f.read(), filename))
     # remove spaces in every string
-    for i in range(len(refs)):
-        refs[i] = refs[i].replace(" ", "")
+    for article in articles:
+        article["text"] = article["text"].replace(" ", "")
 
-    docs = [Document(page_content=doc, metadata={"id": i}) for i, doc in enumerate(refs)]
+    # 一條一個 chunk，太長的條文才切段（段與段之間有 overlap）
+    docs = [
+        Document(
+            page_content=chunk["text"],
+            metadata={
+                "source": chunk["source"],
+                "title": chunk["title"],
+                "chapter": chunk["chapter"],
+                "article": chunk["article"],
+                "part": chunk["part"],
+            }
+        )
+        for chunk in chunk_articles(articles, CHUNK_SIZE, CHUNK_OVERLAP)
+    ]
+    # id 改用內容 hash，行號變動不會讓未修改的 chunk 重新 embed
+    for doc in docs:
+        doc.metadata["id"] = chunk_hash(doc)
     return docs
 
-def get_chain():
-    global _docs, _llm, _embeddings_model, _vector_store, _retriever, _question_answer_chain, _chain
-    if _docs is None:
-        try:
-            _docs = generate_document()
-        except:
-            download_drive(folder_url, output_path)
-            _docs = generate_document()
-    if _llm is None:
-        _llm = ChatOpenAI(
-            openai_api_key=OPENAI_API_KEY,
-            model_name=MODEL_NAME,
-            temperature=0.7
-        )
+def get_embeddings() -> Embeddings:
+    global _embeddings_model
     if _embeddings_model is None:
-        _embeddings_model = HuggingFaceEmbeddings(
-            model_name=EMBED_MODEL,
+        # EMBED_BACKEND=onnx / onnx-int8 不需要載入 PyTorch
+        _embeddings_model = load_embeddings(
+            EMBED_MODEL,
             model_kwargs=model_kwargs,
             encode_kwargs=encode_kwargs,
         )
-    # if _vector_store is None:
-    #     _vector_store = Chroma.from_documents(
-    #         documents=_docs,
-    #         embedding=_embeddings_model
-    #     )
-    if _vector_store is None:
-        persist_dir = "./chroma_db"
-        if os.path.exists(persist_dir) and os.listdir(persist_dir):
-            # 已存在資料庫就讀取
-            _vector_store = Chroma(
-                embedding_function=_embeddings_model,
-                persist_directory=persist_dir
-            )
-        else:
-            # 第一次生成資料庫
-            _vector_store = Chroma.from_documents(
-                documents=_docs,
-                embedding=_embeddings_model,
-                persist_directory=persist_dir
-            )
-            _vector_store.persist()
-
-    if _retriever is None:
-        _retriever = _vector_store.as_retriever(
-            search_type="mmr",
-            search_kwargs={"k": 3, "fetch_k": 5}
+        if EMBED_CACHE_PATH:
+            # 重建索引、重複的問題都直接讀 sqlite 裡的向量，不必再跑模型
+            _embeddings_model = CachedEmbeddings(_embeddings_model, model_id=EMBED_MODEL_ID)
+    return _embeddings_model
+
+def get_answer_cache() -> SemanticAnswerCache:
+    global _answer_cache
+    if _answer_cache is None:
+        _answer_cache = SemanticAnswerCache(
+            embed_fn=get_embeddings().embed_query,
+            data_dir=_index.data_dir if _index is not None else output_path
+        )
+    return _answer_cache
+
+def open_vector_store():
+    # 語料只有幾百段，VECTOR_BACKEND=numpy 可省掉 Chroma / duckdb 的啟動與磁碟 I/O
+    if VECTOR_BACKEND == "numpy":
+        return NumpyVectorStore(
+            embedding_function=get_embeddings(),
+            persist_directory=persist_dir
         )
+    return Chroma(
+        embedding_function=get_embeddings(),
+        persist_directory=persist_dir
+    )
+
+def get_section_index() -> SectionIndex:
+    # fallback 用的章 / 條層級索引（只在 RAG 回答 unsure 時用到）
+    global _section_index
+    index = _index
+    if index is not None and index.section_index is not None:
+        return index.section_index
+    if _section_index is None:
+        _section_index = SectionIndex.from_files(get_embeddings())
+    return _section_index
+
+def new_llm(max_retries: int) -> ChatOpenAI:
+    return ChatOpenAI(
+        openai_api_key=OPENAI_API_KEY,
+        model_name=MODEL_NAME,
+        temperature=0.7,
+        max_retries=max_retries,
+        # 與 main / generate 共用同一組 keep-alive 連線池
+        http_client=get_httpx_client(),
+        http_async_client=get_async_httpx_client()
+    )
+
+def get_llm() -> ChatOpenAI:
+    global _llm
+    if _llm is None:
+        _llm = new_llm(HTTP_RETRIES)
+    return _llm
+
+def get_deadline_llm() -> ChatOpenAI:
+    # 有 deadline 時用：不讓 SDK 自動重試（重試會讓等待變成 timeout 的數倍），timeout 由每次呼叫依剩餘時間指定
+    global _deadline_llm
+    if _deadline_llm is None:
+        _deadline_llm = new_llm(0)
+    return _deadline_llm
+
+def build_retriever(vector_store, docs: list[Document]):
+    retriever = vector_store.as_retriever(
+        search_type="mmr",
+        search_kwargs={"k": 3, "fetch_k": 5}
+    )
+    if RETRIEVER_MODE == "hybrid":
+        # 字元 n-gram BM25 補足英文 embedding 對中文專有名詞、條號的不足
+        retriever = HybridRetriever.from_documents(retriever, docs, k=3)
+    return retriever
+
+def build_chain(retriever):
+    global _question_answer_chain
     if _question_answer_chain is None:
-        _question_answer_chain = create_stuff_documents_chain(_llm, prompt)
-    if _chain is None:
-        _chain = create_retrieval_chain(_retriever, _question_answer_chain)
+        _question_answer_chain = create_stuff_documents_chain(get_llm(), prompt)
+    # 檢索只用 retrieval_query（目前的提問或改寫後的獨立問題），不把整段對話拿去 embed
+    retrieval_docs = RunnableLambda(lambda x: x.get("retrieval_query") or x["input"]) | retriever
+    return create_retrieval_chain(retrieval_docs, _question_answer_chain)
+
+def load_local_index() -> IndexState:
+    """build the index from ./data, embedding only chunks missing from persist_dir"""
+    ensure_data()
+    docs = generate_document()
+    # 讀取（或建立）資料庫後依 manifest 只 embed 新增 / 修改的 chunk
+    vector_store = open_vector_store()
+    result = sync_index(vector_store, docs, persist_dir)
+    retriever = build_retriever(vector_store, docs)
+    return IndexState("local", docs, vector_store, retriever, build_chain(retriever), read_rules(), info={"sync": result})
+
+def load_index_version(version: str) -> IndexState:
+    """open a version built by ingest.py: memory-mapped vectors, nothing is re-read from ./data or embedded"""
+    path = version_dir(version)
+    info = read_version_info(path)
+    if info.get("embed_model") != EMBED_MODEL_ID:
+        raise ValueError(f"index {version} was built with {info.get('embed_model')}, this server embeds with {EMBED_MODEL_ID}")
+    # 版本一律是 NumPy 格式（唯讀 mmap），與 VECTOR_BACKEND 無關
+    vector_store = NumpyVectorStore(embedding_function=get_embeddings(), persist_directory=path)
+    stored = vector_store.get()
+    docs = [Document(page_content=text, metadata=metadata) for text, metadata in zip(stored["documents"], stored["metadatas"])]
+    retriever = build_retriever(vector_store, docs)
+    all_rules, sections, sections_matrix = read_artifact(path)
+    return IndexState(
+        version, docs, vector_store, retriever, build_chain(retriever), all_rules,
+        section_index=SectionIndex(sections, get_embeddings(), matrix=sections_matrix),
+        data_dir=os.path.join(path, DATA_DIR), path=path, info=info,
+    )
+
+def load_current_index() -> IndexState:
+    global _seen_pointer
+    version = _seen_pointer = read_current(INDEX_ROOT)
+    if version:
+        try:
+            return load_index_version(version)
+        except Exception as e:
+            import logging
+            logging.exception(f"[Index Load Error] {version}: {str(e)}")
+            _index_status["failures"] += 1
+            _index_status["last_error"] = f"{version}: {str(e)}"
+    return load_local_index()
+
+def get_index() -> IndexState:
+    # 第一次呼叫時載入：INDEX_ROOT/CURRENT 指向的版本，沒有的話由 ./data 建立
+    global _index
+    if _index is None:
+        with _index_lock:
+            if _index is None:
+                _index = load_current_index()
+    return _index
+
+def get_chain():
+    return get_index().chain
+
+def get_all_rules() -> str:
+    # 出題用的規章全文，跟著索引版本切換
+    global _all_rules
+    index = _index
+    if index is not None:
+        return index.all_rules
+    if _all_rules is None:
+        _all_rules = read_rules()
+    return _all_rules
 
-    return _chain
+def swap_index(index: IndexState, load_seconds: float = None) -> None:
+    """make index the active state; requests already running finish on the previous one"""
+    global _index
+    start = time.perf_counter()
+    _index = index  # 單一參考的指派是原子的，不需要讓請求等待
+    swap_ms = (time.perf_counter() - start) * 1000
+    if _answer_cache is not None:
+        # 規章內容不同時清掉舊答案
+        _answer_cache.set_data_dir(index.data_dir)
+    _index_status.update(
+        swaps=_index_status["swaps"] + 1,
+        swapped_at=time.time(),
+        load_s=round(load_seconds, 3) if load_seconds is not None else None,
+        swap_ms=round(swap_ms, 4),
+        last_error=None,
+    )
+    inc("index_swaps_total", result="ok")
 
-def get_response(query: str) -> dict:
+def refresh_index(version: str) -> None:
+    """load version off the request path and swap it in, the current state stays on failure"""
+    with _index_lock:
+        start = time.perf_counter()
+        try:
+            with span("index.load") as attrs:
+                attrs["version"] = version
+                index = load_index_version(version)
+        except Exception as e:
+            _index_status["failures"] += 1
+            _index_status["last_error"] = f"{version}: {str(e)}"
+            inc("index_swaps_total", result="failed")
+            raise
+        swap_index(index, time.perf_counter() - start)
+
+def _watch_index() -> None:
+    global _seen_pointer
+    while True:
+        time.sleep(INDEX_POLL_INTERVAL)
+        version = read_current(INDEX_ROOT)
+        # 只在 CURRENT 改變時切換：reindex() 換上的本機索引不會被舊的 CURRENT 蓋回去，
+        # 載入失敗的版本也不會每次輪詢都重試（等 CURRENT 再改）
+        if _index is None or not version or version == _seen_pointer:
+            continue
+        _seen_pointer = version
+        if version == _index.version:
+            continue
+        try:
+            refresh_index(version)
+        except Exception as e:
+            import logging
+            logging.exception(f"[Index Swap Error] {version}: {str(e)}")
+
+def start_index_watcher() -> None:
+    """poll INDEX_ROOT/CURRENT on a background thread, once per process (threads do not survive a fork)"""
+    global _watcher_pid
+    if INDEX_POLL_INTERVAL <= 0 or _watcher_pid == os.getpid():
+        return
+    _watcher_pid = os.getpid()
+    threading.Thread(target=_watch_index, name="index-watcher", daemon=True).start()
+
+def get_index_status() -> dict:
+    index = _index
+    return {
+        "version": index.version if index is not None else None,
+        "current_pointer": read_current(INDEX_ROOT),
+        "chunks": len(index.docs) if index is not None else 0,
+        "loaded_at": index.loaded_at if index is not None else None,
+        "built_at": index.info.get("created_at") if index is not None else None,
+        "poll_interval_s": INDEX_POLL_INTERVAL,
+        **_index_status,
+    }
+
+def reopen_after_fork() -> None:
+    """
+    called in a worker after gunicorn forks it from the preloaded master: Chroma's
+    sqlite handles must not be shared across processes, so the store is reopened
+    (the NumPy store is a read-only mmap and stays shared); the LLMs hold the master's
+    httpx connection pools, so they and the chain built on them are created again here;
+    threads do not survive fork, the caller starts the index watcher afterwards
+    """
+    global _index, _index_lock, _llm, _deadline_llm, _question_answer_chain
+    _index_lock = threading.Lock()  # fork 時若 master 的 watcher 正在載入，鎖會停在已取得的狀態
+    _llm = _deadline_llm = _question_answer_chain = None  # 下次取用時以這個 process 的連線池重建
+    index = _index
+    if index is None:
+        return
+    vector_store, retriever = index.vector_store, index.retriever
+    if VECTOR_BACKEND == "chroma" and index.version == "local":
+        vector_store = open_vector_store()  # master 已經同步過索引，這裡不再 sync
+        retriever = build_retriever(vector_store, index.docs)
+    _index = IndexState(index.version, index.docs, vector_store, retriever, build_chain(retriever),
+                        index.all_rules, index.section_index, index.data_dir, index.path, index.info)
+
+def reindex() -> dict:
+    """
+    re-read ./data, sync the persisted index and swap it in, return {'added', 'removed', 'unchanged'};
+    the local index stays active until INDEX_ROOT/CURRENT is changed
+    """
+    with _index_lock:
+        start = time.perf_counter()
+        index = load_local_index()
+        swap_index(index, time.perf_counter() - start)
+    return index.info["sync"]
+
+def chain_input(query: str, history: str = "", retrieval_query: str = None) -> dict:
+    return {
+        "input": query,
+        "retrieval_query": retrieval_query or query,
+        "history": [("system", "先前的對話：\n" + history)] if history else [],
+    }
+
+def degraded_response(query: str, docs: list[Document], reason: str, deadline) -> dict:
+    deadline.degrade(reason)
+    return {"input": query, "context": docs, "answer": "", "degraded": reason}
+
+def deadline_chain(deadline):
+    # 每次依剩餘時間綁定 timeout，prompt 與 get_chain() 相同
+    return create_stuff_documents_chain(get_deadline_llm().bind(timeout=deadline.timeout()), prompt)
+
+def llm_failure(e: Exception) -> str:
+    # 逾時是預期中的降級，只有其他錯誤才記下 traceback
+    if isinstance(e, APITimeoutError):
+        return "llm_timeout"
+    import logging
+    logging.exception(f"[RAG GPT Error] {str(e)}")
+    return "llm_error"
+
+def answer_within(query: str, history: str, retrieval_query: str, deadline) -> dict:
+    """retrieval, then the LLM only if the deadline still allows it, limited to the time left"""
+    inputs = chain_input(query, history, retrieval_query)
+    docs = get_index().retriever.invoke(inputs["retrieval_query"], config={"callbacks": _callbacks})
+    if not deadline.allows(LLM_MIN):
+        return degraded_response(query, docs, "skip_llm", deadline)
+    try:
+        answer = deadline_chain(deadline).invoke(dict(inputs, context=docs), config={"callbacks": _callbacks})
+    except (APIStatusError, APIConnectionError) as e:
+        return degraded_response(query, docs, llm_failure(e), deadline)
+    return {"input": query, "context": docs, "answer": answer}
+
+async def aanswer_within(query: str, history: str, retrieval_query: str, deadline) -> dict:
+    """async version of answer_within"""
+    inputs = chain_input(query, history, retrieval_query)
+    index = await asyncio.get_running_loop().run_in_executor(None, get_index)
+    docs = await index.retriever.ainvoke(inputs["retrieval_query"], config={"callbacks": _callbacks})
+    if not deadline.allows(LLM_MIN):
+        return degraded_response(query, docs, "skip_llm", deadline)
+    try:
+        answer = await deadline_chain(deadline).ainvoke(dict(inputs, context=docs), config={"callbacks": _callbacks})
+    except (APIStatusError, APIConnectionError) as e:
+        return degraded_response(query, docs, llm_failure(e), deadline)
+    return {"input": query, "context": docs, "answer": answer}
+
+def cached_fallback(res: dict, query: str) -> dict:
+    # 追問不查快取；沒時間產生答案時，改寫後的獨立問題若命中快取，仍比只給條文好
+    hit, _ = get_answer_cache().lookup(query)
+    if not hit:
+        return res
+    inc("deadline_degraded_total", reason="cached_answer")
+    return dict(res, context=hit["context"], answer=hit["answer"])
+
+def get_response(query: str, cache_key: str = None, history: str = "", retrieval_query: str = None,
+                 deadline=None) -> dict:
     """
     return value format
     {
         'input': query
         'context': top k related context
         'answer': response from llm
+        'degraded': (only with a deadline) why the llm was skipped, 'answer' is then '' or a cached answer
     }
+    history is the (compacted) conversation shown to the llm, retrieval_query
+    replaces query for retrieval; if cache_key is given, semantically similar
+    cache_key seen before returns the cached answer and context without calling the chain;
+    with a deadline.Deadline the llm gets the time left as its timeout and is skipped when
+    too little is left, the retrieved context is still returned for the caller to send
     """
-    chain = get_chain()
-    return chain.invoke({"input": query})
+    if cache_key:
+        cache = get_answer_cache()
+        with span("answer_cache.lookup") as attrs:
+            hit, embedding = cache.lookup(cache_key)
+            attrs["hit"] = bool(hit)
+            if hit:
+                attrs["score"] = round(hit["score"], 3)
+        inc("answer_cache_total", result="hit" if hit else "miss")
+        if hit:
+            return {"input": query, "context": hit["context"], "answer": hit["answer"]}
 
+    if deadline is not None:
+        res = answer_within(query, history, retrieval_query, deadline)
+        if res.get("degraded"):
+            return res if cache_key else cached_fallback(res, retrieval_query or query)
+    else:
+        chain = get_chain()
+        res = chain.invoke(chain_input(query, history, retrieval_query), config={"callbacks": _callbacks})
+    unsure = "unsure" in res["answer"].lower()
+    inc("rag_answers_total", result="unsure" if unsure else "answered")
 
-# main code
+    # 'unsure' 會走 fallback，不放進快取
+    if cache_key and not unsure:
+        cache.store(cache_key, res["answer"], res["context"], embedding=embedding)
+    return res
+
+async def aget_response(query: str, cache_key: str = None, history: str = "", retrieval_query: str = None,
+                        deadline=None) -> dict:
+    """async version of get_response, same return value format"""
+    loop = asyncio.get_running_loop()
+    if cache_key:
+        # embedding 是 CPU 工作，丟到 executor 避免卡住 event loop
+        cache = await loop.run_in_executor(None, get_answer_cache)
+        with span("answer_cache.lookup") as attrs:
+            hit, embedding = await loop.run_in_executor(None, cache.lookup, cache_key)
+            attrs["hit"] = bool(hit)
+            if hit:
+                attrs["score"] = round(hit["score"], 3)
+        inc("answer_cache_total", result="hit" if hit else "miss")
+        if hit:
+            return {"input": query, "context": hit["context"], "answer": hit["answer"]}
+
+    if deadline is not None:
+        res = await aanswer_within(query, history, retrieval_query, deadline)
+        if res.get("degraded"):
+            return res if cache_key else await loop.run_in_executor(None, cached_fallback, res, retrieval_query or query)
+    else:
+        chain = await loop.run_in_executor(None, get_chain)
+        res = await chain.ainvoke(chain_input(query, history, retrieval_query), config={"callbacks": _callbacks})
+    unsure = "unsure" in res["answer"].lower()
+    inc("rag_answers_total", result="unsure" if unsure else "answered")
 
-if(not is_login()):
-    hf_login()
+    if cache_key and not unsure:
+        await loop.run_in_executor(None, lambda: cache.store(cache_key, res["answer"], res["context"], embedding=embedding))
+    return res
 
-res = get_response("基金會叫什麼名字")
+def get_cache_stats() -> dict:
+    return get_answer_cache().stats() if _answer_cache is not None else {}
 
+def flush_answer_cache():
+    if _answer_cache is not None:
+        _answer_cache.flush()
+
+def get_embedding_cache_stats() -> dict:
+    return _embeddings_model.stats() if isinstance(_embeddings_model, CachedEmbeddings) else {}
+
+
+def ensure_hf_login() -> None:
+    if not is_login():
+        hf_login()
+
+def warm_up_steps() -> list:
+    """(name, fn) pairs run once at boot by warmup.Warmer, nothing here runs on import"""
+    return [
+        ("huggingface login", ensure_hf_login),
+        ("embedding model", lambda: get_embeddings().embed_query("暖機")),
+        ("vector store / chain", get_chain),
+        ("deadline llm", get_deadline_llm),
+        ("answer cache", get_answer_cache),
+        ("fallback sections", get_section_index),
+        ("index watcher", start_index_watcher),
+    ]
+
+
+# main code
 
-print()
-print(res)
+if __name__ == "__main__":
+    ensure_hf_login()
+    res = get_response("基金會叫什麼名字")
+    print()
+    print(res)
 
 
 # /////////////////////////////////////////////////////////////////////////////////////
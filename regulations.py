@@ -0,0 +1,126 @@
+import re
+
+
+# Constants
+
+REGULATION_FILES = ["Donation-charter.txt", "Integrity-norm.txt"]
+REGULATION_TITLES = {
+    "Donation-charter.txt": "捐助章程",
+    "Integrity-norm.txt": "誠信經營規範",
+}
+
+NUM = "一二三四五六七八九十百零"
+# 捐助章程原文有「第四幸會議」的錯字，章也接受「幸」
+CHAPTER_RE = re.compile(rf"^第[{NUM}]+[章幸]")
+ARTICLE_RE = re.compile(rf"^(第[{NUM}]+條(?:之[{NUM}]+)?)")
+# 誠信經營規範用「一、」「十一、」編號
+POINT_RE = re.compile(rf"^([{NUM}]+)、")
+PAGE_NUMBER_RE = re.compile(r"^\d+$")
+
+
+def split_articles(text: str, source: str) -> list[dict]:
+    """
+    split a regulation file into articles
+
+    return value format
+    [
+        {'source': file name, 'title': regulation name, 'chapter': '第一章總則' or '',
+         'article': '第一條' / '十一' / '', 'text': article text}
+    ]
+    text before the first article (title, dates) is returned with article ''
+    """
+    lines = [line.strip() for line in text.split("\n")]
+    lines = [line for line in lines if line and not PAGE_NUMBER_RE.match(line)]
+
+    # 有「第X條」的檔案以條為單位，否則以「一、」為單位（條文內的「一、」是款，不切開）
+    uses_articles = any(ARTICLE_RE.match(line) for line in lines)
+
+    articles = []
+    chapter = ""
+    current = {"source": source, "chapter": chapter, "article": "", "lines": []}
+    for line in lines:
+        if CHAPTER_RE.match(line):
+            chapter = line.replace(" ", "")
+            continue
+        match = ARTICLE_RE.match(line) if uses_articles else POINT_RE.match(line)
+        if match:
+            articles.append(current)
+            current = {"source": source, "chapter": chapter, "article": match.group(1), "lines": []}
+        current["lines"].append(line)
+    articles.append(current)
+
+    return [
+        {
+            "source": item["source"],
+            "title": REGULATION_TITLES.get(item["source"], item["source"]),
+            "chapter": item["chapter"],
+            "article": item["article"],
+            "text": "\n".join(item["lines"]),
+        }
+        for item in articles if item["lines"]
+    ]
+
+def read_rules(paths: list[str] = REGULATION_FILES) -> str:
+    """full text of the regulation files joined by newlines (all_rules in the quiz prompt)"""
+    texts = []
+    for path in paths:
+        with open(path, encoding="utf-8") as f:
+            texts.append(f.read())
+    return "\n".join(texts)
+
+def load_articles(paths: list[str] = REGULATION_FILES) -> list[dict]:
+    articles = []
+    for path in paths:
+        with open(path, encoding="utf-8") as f:
+            articles.extend(split_articles(f.read(), path.split("/")[-1]))
+    return articles
+
+def chunk_text(text: str, size: int, overlap: int) -> list[str]:
+    """
+    split text into pieces of at most size characters, cutting at line ends when possible;
+    each piece starts with up to overlap characters from the end of the previous one,
+    fewer when the next line would not fit otherwise
+    """
+    if not 0 <= overlap < size:
+        raise ValueError(f"chunk overlap ({overlap}) must be >= 0 and smaller than chunk size ({size})")
+    if len(text) <= size:
+        return [text]
+
+    pieces = []
+    current = ""
+    for line in text.split("\n"):
+        # 單行就超過上限時直接依字數切
+        while len(line) > size:
+            if current:
+                pieces.append(current)
+                current = ""
+            pieces.append(line[:size])
+            line = line[size - overlap:]
+        if current and len(current) + 1 + len(line) > size:
+            pieces.append(current)
+            # 下一段帶上前一段結尾 overlap 個字，放不下下一行時少帶一些
+            carry = min(overlap, size - 1 - len(line))
+            current = current[-carry:] if carry > 0 else ""
+        current = f"{current}\n{line}" if current else line
+    if current:
+        pieces.append(current)
+    return pieces
+
+def chunk_articles(articles: list[dict], size: int, overlap: int) -> list[dict]:
+    """
+    one chunk per article, long articles split into overlapping parts with the same metadata;
+    parts after the first start with '<article>（續）' and still stay within size characters
+    """
+    chunks = []
+    for article in articles:
+        prefix = f"{article['article']}（續）\n" if article["article"] else ""
+        pieces = chunk_text(article["text"], size, overlap)
+        if len(pieces) > 1 and prefix:
+            # 先扣掉續段標頭的長度再切，加上標頭後才不會超過 size
+            budget = size - len(prefix)
+            pieces = chunk_text(article["text"], budget, min(overlap, budget - 1))
+        for part, piece in enumerate(pieces):
+            if part:
+                piece = prefix + piece
+            chunks.append(dict(article, text=piece, part=part))
+    return chunks
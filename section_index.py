@@ -0,0 +1,85 @@
+import os
+
+import numpy as np
+import tiktoken
+
+from regulations import load_articles
+
+
+# Constants
+
+TOKEN_BUDGET = int(os.environ.get("FALLBACK_TOKEN_BUDGET", "3000"))  # fallback prompt 裡條文的 token 上限
+TOP_K = int(os.environ.get("FALLBACK_TOP_K", "4"))
+SECTION_LEVEL = os.environ.get("FALLBACK_SECTION_LEVEL", "article")  # article / chapter
+TOKEN_MODEL = "gpt-4o-mini"
+
+_encoding = None
+
+
+def count_tokens(text: str) -> int:
+    global _encoding
+    if _encoding is None:
+        _encoding = tiktoken.encoding_for_model(TOKEN_MODEL)
+    return len(_encoding.encode(text))
+
+def section_header(section: dict) -> str:
+    parts = [section.get("title", section["source"]), section["chapter"], section["article"]]
+    return "【" + " ".join(p for p in parts if p) + "】"
+
+def group_sections(articles: list[dict], level: str = SECTION_LEVEL) -> list[dict]:
+    """article level keeps one section per article, chapter level merges articles of the same chapter"""
+    if level != "chapter":
+        return [dict(article, text=section_header(article) + "\n" + article["text"]) for article in articles]
+
+    sections = []
+    for article in articles:
+        key = (article["source"], article["chapter"])
+        # 沒有章的檔案（誠信經營規範）仍以條為單位
+        if sections and article["chapter"] and (sections[-1]["source"], sections[-1]["chapter"]) == key:
+            sections[-1]["text"] += "\n" + article["text"]
+            continue
+        section = dict(article, article="" if article["chapter"] else article["article"])
+        section["text"] = section_header(section) + "\n" + article["text"]
+        sections.append(section)
+    return sections
+
+def format_sections(sections: list[dict]) -> str:
+    return "\n\n".join(section["text"] for section in sections)
+
+
+class SectionIndex:
+    """coarse section-level index used to pick whole sections for the fallback prompt"""
+
+    def __init__(self, sections: list[dict], embeddings, matrix: np.ndarray = None):
+        self.sections = sections
+        self.embeddings = embeddings
+        self.tokens = [count_tokens(section["text"]) for section in sections]
+        if matrix is None:
+            # ingest.py 建好的版本直接帶入已存的向量
+            matrix = np.asarray(embeddings.embed_documents([section["text"] for section in sections]), dtype=np.float32)
+        self.matrix = matrix / np.linalg.norm(matrix, axis=1, keepdims=True)
+
+    @classmethod
+    def from_files(cls, embeddings, level: str = SECTION_LEVEL):
+        return cls(group_sections(load_articles(), level), embeddings)
+
+    def search(self, query: str) -> list[int]:
+        vec = np.asarray(self.embeddings.embed_query(query), dtype=np.float32)
+        vec = vec / np.linalg.norm(vec)
+        return list(np.argsort(-(self.matrix @ vec)))
+
+    def select(self, query: str, budget: int = TOKEN_BUDGET, top_k: int = TOP_K) -> list[dict]:
+        """best matching whole sections, at most top_k and within budget tokens, in document order"""
+        chosen = []
+        used = 0
+        for i in self.search(query):
+            if len(chosen) >= top_k:
+                break
+            if used + self.tokens[i] > budget:
+                continue
+            chosen.append(i)
+            used += self.tokens[i]
+        return [self.sections[i] for i in sorted(chosen)]
+
+    def total_tokens(self) -> int:
+        return sum(self.tokens)
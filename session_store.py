@@ -0,0 +1,304 @@
+import os
+import time
+import atexit
+import random
+import threading
+from collections import OrderedDict
+
+from firebase_admin import db
+
+from chat_memory import MEMORY_RETENTION, get_memory_items, schedule_trim
+from instrumentation import span
+
+
+# Constants
+
+SESSION_CACHE_SIZE = int(os.environ.get("SESSION_CACHE_SIZE", "1000"))  # 記憶體中最多保留幾位使用者
+FLUSH_INTERVAL = float(os.environ.get("SESSION_FLUSH_INTERVAL", "1.0"))  # 寫回 Firebase 的間隔（秒）
+
+PUSH_CHARS = "-0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ_abcdefghijklmnopqrstuvwxyz"
+
+
+class PushIdGenerator:
+    """Firebase-compatible push ids generated locally, so writes can be queued without a round trip"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._last_time = 0
+        self._last_random = [0] * 12
+
+    def __call__(self) -> str:
+        with self._lock:
+            now = int(time.time() * 1000)
+            if now == self._last_time:
+                # 同一毫秒內遞增亂數部分，維持排序
+                for i in range(11, -1, -1):
+                    if self._last_random[i] < 63:
+                        self._last_random[i] += 1
+                        break
+                    self._last_random[i] = 0
+            else:
+                self._last_time = now
+                self._last_random = [random.randrange(64) for _ in range(12)]
+            time_chars = []
+            for _ in range(8):
+                time_chars.append(PUSH_CHARS[now % 64])
+                now //= 64
+            return "".join(reversed(time_chars)) + "".join(PUSH_CHARS[i] for i in self._last_random)
+
+
+class UserSession:
+    def __init__(self):
+        self.memory = None         # OrderedDict push key -> {"user", "bot"}
+        self.quiz_current = None   # {"question", "answer"} or None
+        self.quiz_loaded = False
+        self.quiz_history = None   # dict push key -> question
+
+
+class SessionStore:
+    """
+    Per-user session state (chat memory, current quiz, quiz history) cached in a bounded LRU
+
+    writes update the cache immediately and are queued as paths for one
+    multi-path update() that a background thread flushes every FLUSH_INTERVAL
+    seconds and at exit, so reads within this process see their own writes
+    """
+
+    def __init__(self, capacity: int = SESSION_CACHE_SIZE, flush_interval: float = FLUSH_INTERVAL):
+        self.capacity = capacity
+        self.flush_interval = flush_interval
+        self.push_id = PushIdGenerator()
+
+        self._lock = threading.RLock()
+        self._sessions = OrderedDict()
+        self._pending = {}   # "quiz/u/current" -> value (None deletes)
+        self._dirty = set()  # 還有寫入沒送到 Firebase 的使用者，不會被 LRU 淘汰
+        self._flush_event = threading.Event()
+        self._pid = None
+
+        self.hits = 0
+        self.misses = 0
+        self.flushes = 0
+        self.flushed_paths = 0
+        self.flush_errors = 0
+
+    # cache
+
+    def _session(self, user_id) -> UserSession:
+        with self._lock:
+            session = self._sessions.get(user_id)
+            if session is None:
+                session = self._sessions[user_id] = UserSession()
+            self._sessions.move_to_end(user_id)
+            self._evict()
+            return session
+
+    def _evict(self):
+        if len(self._sessions) <= self.capacity:
+            return
+        for user_id in list(self._sessions):
+            if len(self._sessions) <= self.capacity:
+                break
+            if user_id not in self._dirty:
+                del self._sessions[user_id]
+
+    # write-behind queue
+
+    def _queue(self, user_id, path, value):
+        with self._lock:
+            self._merge(path, value)
+            self._dirty.add(user_id)
+        self._ensure_started()
+
+    def _merge(self, path, value):
+        # 呼叫端持有 self._lock
+        # 子路徑已排入的寫入由這次覆蓋
+        for pending_path in [p for p in self._pending if p.startswith(path + "/")]:
+            del self._pending[pending_path]
+        # 父路徑已經排入（例如剛清空），就改寫父路徑的值，避免 update() 路徑衝突
+        parts = path.split("/")
+        for i in range(len(parts) - 1, 0, -1):
+            parent = "/".join(parts[:i])
+            if parent in self._pending:
+                node = self._pending[parent]
+                if node is None:
+                    node = self._pending[parent] = {}
+                for part in parts[i:-1]:
+                    node = node.setdefault(part, {})
+                if value is None:
+                    node.pop(parts[-1], None)
+                else:
+                    node[parts[-1]] = value
+                break
+        else:
+            self._pending[path] = value
+
+    def _ensure_started(self):
+        # flush thread 不會跟著 fork 過去，換了 process 就重新啟動
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            threading.Thread(target=self._flush_loop, name="session-flush", daemon=True).start()
+
+    def _flush_loop(self):
+        while True:
+            self._flush_event.wait(self.flush_interval)
+            self._flush_event.clear()
+            self.flush()
+
+    def flush(self) -> int:
+        with self._lock:
+            if not self._pending:
+                return 0
+            batch, self._pending = self._pending, {}
+            users = set(self._dirty)
+        try:
+            with span("firebase.flush", paths=len(batch)):
+                db.reference("/").update(batch)
+        except Exception as e:
+            import logging
+            logging.exception(f"[Session Flush Error] {str(e)}")
+            self.flush_errors += 1
+            with self._lock:
+                # 失敗的批次放回佇列，再依序套上之後的新寫入（新寫入優先，父子路徑照 _queue 的規則合併）
+                newer, self._pending = self._pending, dict(batch)
+                for path, value in newer.items():
+                    self._merge(path, value)
+            return 0
+        with self._lock:
+            users_still_pending = {p.split("/")[1] for p in self._pending}
+            self._dirty -= users - users_still_pending
+            self.flushes += 1
+            self.flushed_paths += len(batch)
+        return len(batch)
+
+    # chat memory
+
+    def _memory(self, user_id) -> OrderedDict:
+        session = self._session(user_id)
+        if session.memory is None:
+            self.misses += 1
+            memory = OrderedDict()
+            for key, value in get_memory_items(user_id, MEMORY_RETENTION):
+                memory[key] = value
+            with self._lock:
+                if session.memory is None:
+                    session.memory = memory
+        else:
+            self.hits += 1
+        return session.memory
+
+    def get_memory(self, user_id, limit=None):
+        memory = self._memory(user_id)
+        with self._lock:
+            values = list(memory.values())
+        return values[-limit:] if limit else values
+
+    def append_memory(self, user_id, user_text, bot_text):
+        memory = self._memory(user_id)
+        key = self.push_id()
+        value = {"user": user_text, "bot": bot_text}
+        with self._lock:
+            memory[key] = value
+            while len(memory) > MEMORY_RETENTION:
+                memory.popitem(last=False)
+        self._queue(user_id, f"chat_memory/{user_id}/{key}", value)
+        schedule_trim(user_id)
+
+    def clear_memory(self, user_id):
+        session = self._session(user_id)
+        with self._lock:
+            session.memory = OrderedDict()
+        self._queue(user_id, f"chat_memory/{user_id}", None)
+
+    # quiz
+
+    def get_current_quiz(self, user_id):
+        session = self._session(user_id)
+        if not session.quiz_loaded:
+            self.misses += 1
+            current = db.reference(f"/quiz/{user_id}/current").get()
+            with self._lock:
+                if not session.quiz_loaded:
+                    session.quiz_current = current
+                    session.quiz_loaded = True
+        else:
+            self.hits += 1
+        return session.quiz_current
+
+    def set_current_quiz(self, user_id, question, answer):
+        session = self._session(user_id)
+        value = {"question": question, "answer": answer}
+        with self._lock:
+            session.quiz_current = value
+            session.quiz_loaded = True
+        self._queue(user_id, f"quiz/{user_id}/current", value)
+
+    def delete_current_quiz(self, user_id):
+        session = self._session(user_id)
+        with self._lock:
+            session.quiz_current = None
+            session.quiz_loaded = True
+        self._queue(user_id, f"quiz/{user_id}/current", None)
+
+    def _quiz_history(self, user_id) -> dict:
+        session = self._session(user_id)
+        if session.quiz_history is None:
+            self.misses += 1
+            history = db.reference(f"/quiz/{user_id}/history").get() or {}
+            with self._lock:
+                if session.quiz_history is None:
+                    session.quiz_history = dict(history)
+        else:
+            self.hits += 1
+        return session.quiz_history
+
+    def get_asked_questions(self, user_id):
+        history = self._quiz_history(user_id)
+        with self._lock:
+            return set(history.values())
+
+    def push_quiz_history(self, user_id, question):
+        history = self._quiz_history(user_id)
+        key = self.push_id()
+        with self._lock:
+            history[key] = question
+        self._queue(user_id, f"quiz/{user_id}/history/{key}", question)
+
+    def clear_quiz_history(self, user_id):
+        session = self._session(user_id)
+        with self._lock:
+            session.quiz_history = {}
+        self._queue(user_id, f"quiz/{user_id}/history", None)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "users": len(self._sessions),
+                "capacity": self.capacity,
+                "hits": self.hits,
+                "misses": self.misses,
+                "pending_paths": len(self._pending),
+                "dirty_users": len(self._dirty),
+                "flushes": self.flushes,
+                "flushed_paths": self.flushed_paths,
+                "flush_errors": self.flush_errors,
+            }
+
+
+sessions = SessionStore()
+# 結束前把還沒寫回的資料送出
+atexit.register(sessions.flush)
+
+get_memory = sessions.get_memory
+append_memory = sessions.append_memory
+clear_memory = sessions.clear_memory
+get_current_quiz = sessions.get_current_quiz
+set_current_quiz = sessions.set_current_quiz
+delete_current_quiz = sessions.delete_current_quiz
+get_asked_questions = sessions.get_asked_questions
+push_quiz_history = sessions.push_quiz_history
+clear_quiz_history = sessions.clear_quiz_history
@@ -0,0 +1,102 @@
+import asyncio
+import threading
+
+from embedding_cache import normalize_text
+from instrumentation import inc
+
+
+def flight_key(question: str) -> str:
+    # 只差在全形 / 空白 / 句尾標點的提問視為同一題
+    return normalize_text(question).rstrip("？?！!。.～~ ").lower()
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+    Concurrent calls with the same key share one in-flight computation
+
+    the first caller (leader) runs fn, callers arriving before it finishes
+    wait for and return the same result (or exception); nothing is cached
+    after the call completes, that is left to the answer cache
+    """
+
+    def __init__(self, name: str = "singleflight"):
+        self.name = name
+        self._lock = threading.Lock()
+        self._calls = {}     # key -> _Call（thread）
+        self._futures = {}   # key -> asyncio.Future（event loop）
+
+        self.leaders = 0
+        self.followers = 0
+        self.max_inflight = 0
+
+    def _count(self, leader: bool, kind):
+        if leader:
+            self.leaders += 1
+            self.max_inflight = max(self.max_inflight, len(self._calls) + len(self._futures))
+        else:
+            self.followers += 1
+        inc("singleflight_total", flight=self.name, kind=kind, role="leader" if leader else "follower")
+
+    def do(self, key, fn, *args, **kwargs):
+        """return (fn(*args, **kwargs), shared), shared is True when another caller's result was reused"""
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+            self._count(leader, key[0] if isinstance(key, tuple) else "")
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+
+        try:
+            call.result = fn(*args, **kwargs)
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result, False
+
+    async def ado(self, key, fn, *args, **kwargs):
+        """async version of do, fn returns an awaitable; callers must share one event loop"""
+        task = self._futures.get(key)
+        if task is not None:
+            self._count(False, key[0] if isinstance(key, tuple) else "")
+            # shield：某個 follower 被取消時不影響 leader 與其他人
+            return await asyncio.shield(task), True
+
+        # fn 在自己的 task 裡跑，leader 被取消時 follower 仍會拿到結果（或一般的例外），不會收到 CancelledError
+        task = asyncio.get_running_loop().create_task(fn(*args, **kwargs))
+        self._futures[key] = task
+        task.add_done_callback(lambda done: self._finish(key, done))
+        self._count(True, key[0] if isinstance(key, tuple) else "")
+        return await asyncio.shield(task), False
+
+    def _finish(self, key, task):
+        if self._futures.get(key) is task:
+            del self._futures[key]
+        if not task.cancelled():
+            task.exception()  # 沒有人在等時避免 "exception was never retrieved"
+
+    def stats(self) -> dict:
+        total = self.leaders + self.followers
+        return {
+            "inflight": len(self._calls) + len(self._futures),
+            "max_inflight": self.max_inflight,
+            "leaders": self.leaders,
+            "followers": self.followers,
+            "coalesced_rate": round(self.followers / total, 3) if total else 0.0,
+        }
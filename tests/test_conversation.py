@@ -0,0 +1,42 @@
+import pytest
+
+pytest.importorskip("config", reason="conversation needs config.py (see README)")
+
+from conversation import is_follow_up, should_condense, prepare_turn
+
+HISTORY = [{"user": "病假要請幾天？", "bot": "病假一年以三十日為限。"}]
+
+
+@pytest.mark.parametrize("question", [
+    "其他假別有哪些",
+    "如果遲到怎麼辦",
+    "病假要請幾天？",
+    "他人代簽到要怎麼處理",
+    "這個月的薪水什麼時候發",
+    "它適用約聘人員嗎",  # 「它」單字不夠當成追問
+    "請問加班費怎麼算呢",
+    "喪假",
+])
+def test_standalone_questions_are_not_condensed(question):
+    assert not is_follow_up(question)
+    assert not should_condense(HISTORY, question, mode="auto")
+
+
+@pytest.mark.parametrize("question", [
+    "病假呢",
+    "那事假呢？",
+    "為什麼？",
+    "剛剛說的第三條是什麼",
+    "上述規定適用約聘人員嗎",
+    "這樣的話要扣薪嗎",
+    "所以要先跟主管報備嗎",
+])
+def test_follow_ups_are_condensed(question):
+    assert is_follow_up(question)
+    assert should_condense(HISTORY, question, mode="auto")
+
+
+def test_standalone_turn_uses_the_answer_cache():
+    turn = prepare_turn(HISTORY, "其他假別有哪些", mode="auto")
+    assert not turn.condensed
+    assert turn.cache_key == "其他假別有哪些"
@@ -0,0 +1,36 @@
+import os
+
+import pytest
+
+from embedding_backends import ONNX_DIR, ONNX_FILES, parity
+
+EMBED_MODEL = "sentence-transformers/all-MiniLM-L6-v2"  # rag_module.EMBED_MODEL
+MIN_COSINE = {"onnx": 0.999, "onnx-int8": 0.99}
+
+TEXTS = [
+    "第十三條 病假：員工因疾病或安全衛生上之必要休養者，得請病假，一年內合計不得超過三十日。",
+    "事假一年以七日為限，超過者應以特別休假抵充。",
+    "Donations shall be recorded and receipts issued within thirty days.",
+    "加班費怎麼算？",
+    "暖機",
+]
+
+
+def torch_model_cached() -> bool:
+    try:
+        import langchain_huggingface  # noqa: F401
+        from huggingface_hub import try_to_load_from_cache
+    except ImportError:
+        return False
+    return isinstance(try_to_load_from_cache(EMBED_MODEL, "config.json"), str)
+
+
+@pytest.mark.parametrize("backend", list(ONNX_FILES))
+def test_onnx_vectors_match_torch(backend):
+    path = os.path.join(ONNX_DIR, ONNX_FILES[backend])
+    if not os.path.exists(path):
+        pytest.skip(f"{path} not found, run: python embedding_backends.py export")
+    if not torch_model_cached():
+        pytest.skip(f"{EMBED_MODEL} is not in the local HuggingFace cache")
+
+    assert parity(EMBED_MODEL, backend, TEXTS, MIN_COSINE[backend])
@@ -0,0 +1,13 @@
+import instrumentation
+from instrumentation import span, trace
+
+
+def test_disabled_spans_do_not_share_attrs(monkeypatch):
+    monkeypatch.setattr(instrumentation, "METRICS_ENABLED", False)
+    with trace("outer") as outer:
+        outer["fallback"] = True
+        with trace("inner") as inner:
+            inner["fallback"] = False
+        with span("phase") as attrs:
+            attrs["fallback"] = False
+    assert outer == {"fallback": True}
@@ -0,0 +1,42 @@
+import pytest
+
+from regulations import chunk_text, chunk_articles
+
+
+def long_article(lines=30, width=37):
+    # 長短不一的款，逼出「前段結尾 + 下一行」剛好超過上限的情況
+    return "\n".join(f"{i + 1}、" + "條文內容" * (width // 4 + i % 5) for i in range(lines))
+
+
+@pytest.mark.parametrize("size, overlap", [(200, 40), (120, 100), (60, 0)])
+def test_chunk_text_respects_size(size, overlap):
+    text = long_article()
+    pieces = chunk_text(text, size, overlap)
+
+    assert len(pieces) > 1
+    assert all(len(piece) <= size for piece in pieces)
+    # 每一行都完整出現在某一段裡
+    for line in text.split("\n"):
+        if len(line) <= size:
+            assert any(line in piece for piece in pieces)
+
+
+def test_chunk_text_splits_a_single_long_line():
+    pieces = chunk_text("字" * 450, 200, 40)
+    assert [len(piece) for piece in pieces] == [200, 200, 130]
+
+
+def test_chunk_articles_continuation_parts_stay_within_size():
+    article = {"source": "Integrity-norm.txt", "title": "誠信經營規範", "chapter": "",
+               "article": "第十三條", "text": long_article()}
+    chunks = chunk_articles([article], 200, 40)
+
+    assert len(chunks) > 1
+    assert all(len(chunk["text"]) <= 200 for chunk in chunks)
+    assert [chunk["part"] for chunk in chunks] == list(range(len(chunks)))
+    assert all(chunk["text"].startswith("第十三條（續）\n") for chunk in chunks[1:])
+
+
+def test_short_article_is_one_chunk():
+    article = {"source": "a.txt", "title": "", "chapter": "", "article": "第一條", "text": "第一條 本章程依法訂定。"}
+    assert [chunk["text"] for chunk in chunk_articles([article], 200, 40)] == ["第一條 本章程依法訂定。"]
@@ -0,0 +1,69 @@
+import os
+
+import pytest
+
+import session_store
+from session_store import SessionStore
+
+
+class FakeReference:
+    """db.reference("/") stand-in: update() fails while `failures` > 0, runs `during` inside the call"""
+
+    def __init__(self, failures=0, during=None):
+        self.failures = failures
+        self.during = during
+        self.updates = []
+
+    def update(self, batch):
+        if self.during:
+            during, self.during = self.during, None
+            during()
+        if self.failures:
+            self.failures -= 1
+            raise RuntimeError("firebase unavailable")
+        # Firebase 拒絕同一批裡同時有父路徑與子路徑
+        paths = list(batch)
+        assert not any(a.startswith(b + "/") for a in paths for b in paths), paths
+        self.updates.append(dict(batch))
+
+
+@pytest.fixture
+def store(monkeypatch):
+    ref = FakeReference()
+    monkeypatch.setattr(session_store.db, "reference", lambda path="/": ref)
+    store = SessionStore()
+    store._pid = os.getpid()  # 不啟動背景 flush thread
+    store.ref = ref
+    return store
+
+
+def test_clear_during_failed_flush_drops_stale_child(store):
+    store._queue("u", "chat_memory/u/k1", {"user": "q", "bot": "a"})
+    store.ref.failures = 1
+    store.ref.during = lambda: store.clear_memory("u")
+
+    assert store.flush() == 0
+    assert store.flush() == 1
+    assert store.ref.updates == [{"chat_memory/u": None}]
+    assert store.flush() == 0
+
+
+def test_flush_fails_then_clear_then_flush(store):
+    store._queue("u", "chat_memory/u/k1", {"user": "q", "bot": "a"})
+    store.ref.failures = 1
+
+    assert store.flush() == 0
+    store.clear_memory("u")
+    assert store.flush() == 1
+    assert store.ref.updates == [{"chat_memory/u": None}]
+
+
+def test_failed_clear_keeps_newer_child_writes(store):
+    store.clear_memory("u")
+    store.ref.failures = 1
+    store.ref.during = lambda: store._queue("u", "chat_memory/u/k2", {"user": "q2", "bot": "a2"})
+
+    assert store.flush() == 0
+    assert store.flush() == 1
+    assert store.ref.updates == [{"chat_memory/u": {"k2": {"user": "q2", "bot": "a2"}}}]
+    assert "u" not in store._dirty
@@ -0,0 +1,95 @@
+import os
+import time
+import threading
+
+from instrumentation import span, record_span
+
+
+# Constants
+
+RETRY_INTERVAL = float(os.environ.get("WARMUP_RETRY_INTERVAL", "30"))  # 暖機失敗後隔多久重試（秒）
+
+# 第一個 import 此模組的時間，當作 import-to-ready 的起點
+IMPORT_TIME = time.monotonic()
+
+
+class Warmer:
+    """
+    Runs the given (name, fn) steps once on a background thread at boot
+
+    the server answers right away; callers check ready() and reply
+    "warming up" until every step has finished, failures are retried
+    """
+
+    def __init__(self, steps, retry_interval: float = RETRY_INTERVAL):
+        self.steps = steps
+        self.retry_interval = retry_interval
+        self.state = "idle"  # idle / warming / ready / failed
+        self.error = None
+        self.step_seconds = {}
+        self.ready_seconds = None
+        self._ready = threading.Event()
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def start(self):
+        # 已經在 fork 之前暖好就不必重來；thread 不會跟著 fork 過去，換了 process 才重新啟動
+        if self._ready.is_set() or self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._ready.is_set() or self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            threading.Thread(target=self._run, name="warmup", daemon=True).start()
+
+    def run(self, attempts: int = None) -> bool:
+        """warm up on the calling thread, e.g. before forking workers; give up after `attempts` failures"""
+        self._pid = os.getpid()
+        self._run(attempts)
+        return self.ready()
+
+    def _run(self, attempts=None):
+        failures = 0
+        while not self._ready.is_set():
+            self.state = "warming"
+            try:
+                for name, fn in self.steps:
+                    if name in self.step_seconds:
+                        continue
+                    start = time.monotonic()
+                    with span(f"warmup.{name}"):
+                        fn()
+                    self.step_seconds[name] = round(time.monotonic() - start, 3)
+            except Exception as e:
+                import logging
+                logging.exception(f"[Warmup Error] {str(e)}")
+                self.state = "failed"
+                self.error = str(e)
+                failures += 1
+                if attempts is not None and failures >= attempts:
+                    # 交給之後的 start()（例如 fork 出來的 worker）重試
+                    self._pid = None
+                    return
+                time.sleep(self.retry_interval)
+                continue
+            self.ready_seconds = round(time.monotonic() - IMPORT_TIME, 3)
+            self.state = "ready"
+            self.error = None
+            self._ready.set()
+            record_span("warmup", self.ready_seconds)  # import 到 ready，含失敗重試的時間
+
+    def ready(self) -> bool:
+        return self._ready.is_set()
+
+    def wait(self, timeout=None) -> bool:
+        return self._ready.wait(timeout)
+
+    def status(self) -> dict:
+        return {
+            "ready": self.ready(),
+            "state": self.state,
+            "error": self.error,
+            "steps": dict(self.step_seconds),
+            "import_to_ready_s": self.ready_seconds,
+            "uptime_s": round(time.monotonic() - IMPORT_TIME, 3),
+        }